@@ -0,0 +1,395 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Benchmarks a Session holding thousands of torrents, against the simulated
+libtorrent in rarity.simulation, and prints the results as JSON:
+
+    python -m rarity.benchmark [--torrents 1000,10000,100000]
+        [--output results.json] [--baseline old.json] [--tolerance 0.25]
+
+Each result names a benchmark and the number of torrents it ran with, and
+gives the operations per second and the latency percentiles of single
+operations in seconds.  With --baseline, results that got slower by more
+than tolerance are listed under 'regressions' and the exit status is 1.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import random
+import platform
+import argparse
+import tempfile
+import multiprocessing
+
+from rarity import simulation
+simulation.install()
+
+from twisted.internet import reactor, defer, task
+from twisted.spread import pb
+
+from rarity.session import Session
+from rarity.storage import Volume
+from rarity.remote import ClientRemote
+from rarity.resume import ResumeStorage, DirectoryBackend, LogBackend
+
+FORMAT_VERSION = 1
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(name, torrents, samples, seconds=None, operations=None, **extra):
+    """
+    samples are the seconds single operations took; seconds and
+    operations default to their sum and count.
+    """
+    ordered = sorted(samples)
+    if seconds is None:
+        seconds = sum(ordered)
+    if operations is None:
+        operations = len(ordered)
+    result = {
+            'name': name,
+            'torrents': torrents,
+            'operations': operations,
+            'seconds': seconds,
+            'per_second': operations / seconds if seconds else 0.0,
+            'mean': sum(ordered) / len(ordered) if ordered else 0.0,
+            'p50': percentile(ordered, 0.5),
+            'p90': percentile(ordered, 0.9),
+            'p99': percentile(ordered, 0.99),
+            'max': ordered[-1] if ordered else 0.0,
+        }
+    result.update(extra)
+    return result
+
+def timed(func, repeat):
+    samples = list()
+    for _ in xrange(repeat):
+        started = time.time()
+        func()
+        samples.append(time.time() - started)
+    return samples
+
+def sleep(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+@defer.inlineCallbacks
+def wait_until(condition, timeout, interval=0.01):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("timed out after %ss" % timeout)
+        yield sleep(interval)
+
+
+class Bench(object):
+    """
+    Grows one Session through the torrent counts asked for and runs every
+    benchmark at each count.
+    """
+    def __init__(self, options):
+        self.options = options
+        self.workdir = tempfile.mkdtemp(prefix='rarity-bench-')
+        data_dir = os.path.join(self.workdir, 'data')
+        os.makedirs(data_dir)
+        self.session = Session(os.path.join(self.workdir, 'state'),
+                [Volume(data_dir, usage=lambda path: (1 << 60, 1 << 60))])
+        self.ses = self.session._ses
+        self.ses.alert_queue_size = 4 * max(options.torrents)
+        self.infohashes = list()
+        self._random = random.Random(options.seed)
+        self.results = list()
+
+    def _drained(self):
+        return self.session._alert_pump.alerts >= self.ses.posted_alerts
+
+    @defer.inlineCallbacks
+    def populate(self, count):
+        """
+        adds synthetic torrents until the session holds count, with random
+        progress and rates, and waits for their alerts to be processed.
+        """
+        started = time.time()
+        for number in xrange(len(self.infohashes), count):
+            info = simulation.torrent_info(simulation.make_torrent(number))
+            handle = self.session._add_parsed_torrent(info)
+            handle._progress = self._random.random()
+            handle._upload_rate = self._random.randrange(1 << 20)
+            handle._download_rate = self._random.randrange(1 << 20)
+            self.infohashes.append(str(info.info_hash()))
+        yield wait_until(self._drained, 600)
+        defer.returnValue(time.time() - started)
+
+    def bench_dispatch(self, torrents):
+        """
+        _process_alert with storage_moved_alert waiters pending on every
+        torrent and read_piece_alert waiters on a piece of each.
+        """
+        session = self.session
+        for infohash in self.infohashes:
+            session._add_indexed_deferred(infohash, simulation.storage_moved_alert)
+            session._add_piece_deferred(infohash, 0, simulation.read_piece_alert)
+        waiters = len(session._dispatcher)
+        storm = simulation.AlertStorm(self.ses, self.options.alerts, seed=self.options.seed)
+        handles = self.ses.get_torrents()
+        alerts = [storm._make(self._random.choice(handles))
+                for _ in xrange(self.options.alerts)]
+        samples = list()
+        for alert in alerts:
+            started = time.time()
+            session._process_alert(alert)
+            samples.append(time.time() - started)
+        for handle in handles:
+            session._dispatcher.dispatch(simulation.storage_moved_alert(handle))
+            session._dispatcher.dispatch(simulation.read_piece_alert(handle, 0, ''))
+        self.results.append(summarize('dispatch', torrents, samples, waiters=waiters))
+
+    @defer.inlineCallbacks
+    def bench_storm(self, torrents):
+        """
+        an AlertStorm at --storm-rate alerts a second, through the alert
+        pump; latency is the time from posting an alert to handling it.
+        """
+        storm = simulation.AlertStorm(self.ses, self.options.alerts,
+                self.options.storm_rate, seed=self.options.seed)
+        lags = list()
+        def record(alert):
+            if getattr(alert, 'storm', None) is storm:
+                lags.append(time.time() - alert.posted)
+        self.session._static_alert_handlers.append(record)
+        dropped = self.ses.dropped_alerts
+        started = time.time()
+        storm.start()
+        try:
+            yield wait_until(lambda: storm.posted == storm.count and self._drained(),
+                    60 + 2.0 * storm.count / (self.options.storm_rate or 10000))
+        finally:
+            self.session._static_alert_handlers.remove(record)
+        self.results.append(summarize('alert_storm', torrents, lags,
+                time.time() - started, rate=self.options.storm_rate,
+                dropped=self.ses.dropped_alerts - dropped))
+
+    def bench_snapshots(self, torrents):
+        session = self.session
+        repeat = self.options.repeat
+        query = re.escape('synthetic torrent 00') + '.*'
+        for name, func in (
+                ('find_torrents', lambda: session.find_torrents(query)),
+                ('torrent_state', session.torrent_state),
+                ('torrent_metainfo', session.torrent_metainfo),
+                ('torrent_columns', lambda: session.torrent_columns().encode())):
+            self.results.append(summarize(name, torrents, timed(func, repeat)))
+
+    def bench_peers(self, torrents):
+        """
+        PeerSampler samples of up to --peer-samples torrents, and peer
+        summaries over them.
+        """
+        peers = self.session._peers
+        entries = self.infohashes[:self.options.peer_samples]
+        self.results.append(summarize('peer_sample', torrents,
+                [timed(lambda: peers.sample(ih), 1)[0] for ih in entries],
+                peers=int(peers.totals[0])))
+        self.results.append(summarize('peer_summary', torrents,
+                timed(peers.summary, self.options.repeat)))
+
+    @defer.inlineCallbacks
+    def bench_resume(self, torrents):
+        """
+        saves then loads one resume entry per torrent, up to
+        --resume-entries, with each ResumeStorage backend.
+        """
+        entries = self.infohashes[:self.options.resume_entries]
+        handles = [self.session._find_handle(ih) for ih in entries]
+        for name, make_backend in (
+                ('directory', lambda path: DirectoryBackend(path, self.options.sync)),
+                ('log', lambda path: LogBackend(os.path.join(path, 'resume.log'),
+                    self.options.sync))):
+            path = tempfile.mkdtemp(prefix='resume-', dir=self.workdir)
+            storage = ResumeStorage(make_backend(path))
+            samples = list()
+            def saved(_, started):
+                samples.append(time.time() - started)
+            started = time.time()
+            for infohash, handle in zip(entries, handles):
+                data = {'file-format': 'libtorrent resume file',
+                        'info-hash': infohash.decode('hex'),
+                        'save_path': handle._save_path,
+                        'pieces': '\x01' * handle._info.num_pieces()}
+                storage.save(infohash, data).addCallback(saved, time.time())
+            yield storage.flush()
+            self.results.append(summarize('resume_save_' + name, torrents, samples,
+                    time.time() - started))
+            started = time.time()
+            loaded = yield storage.load_all()
+            self.results.append(summarize('resume_load_all_' + name, torrents,
+                    [time.time() - started], operations=len(loaded)))
+            samples = list()
+            for infohash in entries[:self.options.repeat * 10]:
+                started = time.time()
+                yield storage.load(infohash)
+                samples.append(time.time() - started)
+            self.results.append(summarize('resume_load_' + name, torrents, samples))
+            shutil.rmtree(path, True)
+
+    @defer.inlineCallbacks
+    def bench_pb(self, torrents):
+        """
+        PB calls to a ClientRemote over loopback: small calls one at a time
+        and --concurrency at a time, and the whole torrent list as columns.
+        """
+        port = reactor.listenTCP(0, pb.PBServerFactory(ClientRemote(self.session)),
+                interface='127.0.0.1')
+        factory = pb.PBClientFactory()
+        connector = reactor.connectTCP('127.0.0.1', port.getHost().port, factory)
+        try:
+            root = yield factory.getRootObject()
+            rounds = self.options.repeat * 50
+            samples = list()
+            for i in xrange(rounds):
+                started = time.time()
+                yield root.callRemote('get_torrent_name', self.infohashes[i % torrents])
+                samples.append(time.time() - started)
+            self.results.append(summarize('pb_round_trip', torrents, samples))
+
+            samples = list()
+            def answered(_, started):
+                samples.append(time.time() - started)
+            started = time.time()
+            for i in xrange(0, rounds, self.options.concurrency):
+                yield defer.gatherResults([
+                    root.callRemote('get_torrent_info', ih).addCallback(answered, time.time())
+                    for ih in self.infohashes[i:i + self.options.concurrency]])
+            self.results.append(summarize('pb_concurrent', torrents, samples,
+                    time.time() - started, concurrency=self.options.concurrency))
+
+            samples = list()
+            for _ in xrange(self.options.repeat):
+                started = time.time()
+                yield root.callRemote('get_torrent_columns')
+                samples.append(time.time() - started)
+            self.results.append(summarize('pb_columns', torrents, samples))
+        finally:
+            connector.disconnect()
+            yield port.stopListening()
+
+    @defer.inlineCallbacks
+    def run(self):
+        only = self.options.only
+        for torrents in sorted(self.options.torrents):
+            added = torrents - len(self.infohashes)
+            seconds = yield self.populate(torrents)
+            self.results.append(summarize('populate', torrents, [seconds],
+                    operations=added))
+            for name in ('dispatch', 'storm', 'snapshots', 'peers', 'resume', 'pb'):
+                if only and name not in only:
+                    continue
+                yield getattr(self, 'bench_' + name)(torrents)
+        shutil.rmtree(self.workdir, True)
+        defer.returnValue(self.results)
+
+
+def compare(results, baseline, tolerance):
+    """
+    returns the results slower than their baseline by more than tolerance,
+    in throughput or in p99 latency.
+    """
+    before = dict(((r['name'], r['torrents']), r) for r in baseline['results'])
+    regressions = list()
+    for result in results:
+        old = before.get((result['name'], result['torrents']))
+        if old is None:
+            continue
+        if result['per_second'] < old['per_second'] * (1 - tolerance):
+            regressions.append({'name': result['name'], 'torrents': result['torrents'],
+                'metric': 'per_second', 'baseline': old['per_second'],
+                'value': result['per_second']})
+        if result['p99'] > old['p99'] * (1 + tolerance):
+            regressions.append({'name': result['name'], 'torrents': result['torrents'],
+                'metric': 'p99', 'baseline': old['p99'], 'value': result['p99']})
+    return regressions
+
+def parse_args(argv):
+    counts = lambda value: [int(n) for n in value.split(',')]
+    parser = argparse.ArgumentParser(description="Benchmark a simulated Session.")
+    parser.add_argument('--torrents', type=counts, default=[1000, 10000])
+    parser.add_argument('--alerts', type=int, default=20000,
+            help="alerts per dispatch and storm run")
+    parser.add_argument('--storm-rate', type=int, default=20000,
+            help="alerts per second; 0 posts as fast as possible")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--resume-entries', type=int, default=5000)
+    parser.add_argument('--peer-samples', type=int, default=2000)
+    parser.add_argument('--no-sync', dest='sync', action='store_false',
+            help="skip fsync on resume writes")
+    parser.add_argument('--only', type=lambda v: v.split(','), default=None,
+            help="dispatch, storm, snapshots, peers, resume or pb")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    options = parser.parse_args(argv)
+    options.storm_rate = options.storm_rate or None
+    return options
+
+def main(argv):
+    options = parse_args(argv)
+    report = {
+            'version': FORMAT_VERSION,
+            'started': time.time(),
+            'host': {
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'cpus': multiprocessing.cpu_count(),
+            },
+            'options': dict((k, v) for k, v in vars(options).iteritems()
+                if k not in ('output', 'baseline')),
+        }
+    status = [1]
+    def finished(results):
+        report['results'] = results
+        if options.baseline is not None:
+            with open(options.baseline) as f:
+                report['regressions'] = compare(results, json.load(f), options.tolerance)
+        status[0] = 1 if report.get('regressions') else 0
+        text = json.dumps(report, indent=1, sort_keys=True)
+        if options.output is None:
+            print text
+        else:
+            with open(options.output, 'w') as f:
+                f.write(text + '\n')
+    def failed(reason):
+        reason.printTraceback(file=sys.stderr)
+    def run():
+        d = Bench(options).run()
+        d.addCallbacks(finished, failed)
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
+    return status[0]
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
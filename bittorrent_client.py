@@ -27,98 +27,61 @@ import functools
 import itertools
 
 from twisted.internet import reactor
-from twisted.internet import defer
 from twisted.spread import pb
+from twisted.web import server
 import twisted.web.client
 import sshsimpleserver
 
 from rarity.utils import serialize_torrent_metainfo, \
         serialize_torrent_status, serialize_torrent
-from rarity.session import Session
+from rarity.metrics import MetricsResource
+from rarity.stream import StreamResource
+from rarity.remote import ClientRemote
+from rarity.node import start_session
+from rarity.shard import ShardRouter
+from rarity.profiling import StallWatchdog, SamplingProfiler, CallTimers
 
 FORMAT = '%(asctime)-15s %(message)s'
 logging.basicConfig(format=FORMAT)
 logger = logging.getLogger('ClientCore')
 logger.setLevel(logging.INFO)
 
-def alert_to_infohash(func):
-    def decorated(*args, **kwargs):
-        d = defer.Deferred()
-        def convert(item):
-            d.callback(str(item.handle.info_hash()))
-        tmp = func(*args, **kwargs)
-        tmp.addCallbacks(convert, d.errback)
-        return d
-    return decorated
-
-# View
-class ClientRemote(pb.Root):
-    def __init__(self, session):
-        self.session = session
-
-    @alert_to_infohash
-    def remote_add_torrent(self, url):
-        return self.session.add_torrent(url)
-
-    @alert_to_infohash
-    def remote_pause_torrent(self, infohash):
-        return self.session.pause_torrent(infohash)
-
-    @alert_to_infohash
-    def remote_resume_torrent(self, infohash):
-        return self.session.resume_torrent(infohash)
-
-    @alert_to_infohash
-    def remote_remove_torrent(self, infohash):
-        return self.session.remove_torrent(infohash)
-
-    @alert_to_infohash
-    def remote_get_torrent_info(self, infohash):
-        return self.session.torrent_state()[infohash]
-
-    def remote_get_torrent_metainfo(self, infohash):
-        return self.session.torrent_metainfo()[infohash]
-
-    def remote_find_torrent(self, regexp):
-        return self.session.find_torrents(regexp)
-
-    def remote_get_torrent_name(self, infohash):
-        tmp = self.session.torrent_metainfo()
-        print repr(tmp)
-        return tmp[infohash]['name']
-
-session = Session()
-session._ses.listen_on(23866, 23866)
-session._ses.add_dht_router('router.bittorrent.com', 6881)
-session._ses.load_country_db('/home/sell/dev/rarity/GeoIP.dat')
-session._ses.start_lsd()
-
-try:
-    with open('/tmp/dht-info.b', 'r') as f:
-        info = libtorrent.bdecode(f.read())
-        if 'nodes' in info:
-            session._ses.start_dht(info)
-            logger.info("started DHT with %d nodes" % len(info['nodes']))
-except IOError:
-    session._ses.start_dht({})
-    logger.info("started DHT without any nodes.")
-
-def write_dht_info():
-    with open('/tmp/dht-info.b', 'w') as f:
-        f.write(libtorrent.bencode(session._ses.dht_state()))
-        logger.info("Wrote DHT info")
-    reactor.callLater(60, write_dht_info)
-
-reactor.callLater(120, write_dht_info)
-reactor.listenTCP(8800, pb.PBServerFactory(ClientRemote(session)))
-reactor.listenTCP(5022, sshsimpleserver.getManholeFactory({
+METRICS_PORT = 8801 # Prometheus text format on localhost; None to disable
+SHARDS = 0 # worker processes behind a ShardRouter; 0 runs one Session here
+VOLUMES = [] # 'path' or 'path:allocate'; none saves to Session.DEFAULT_SAVE_PATH
+STREAM_PORT = 8802 # /<infohash>/<file index> over HTTP on localhost; None to disable
+
+if SHARDS:
+    router = ShardRouter(SHARDS, volumes=VOLUMES)
+    router.start()
+    root, metrics = router, router._metrics
+    namespace = {'router': router, 'metrics': metrics}
+else:
+    session = start_session(volumes=VOLUMES)
+    root, metrics = ClientRemote(session), session._metrics
+    namespace = {
         'session': session,
         'libtorrent': libtorrent,
-    }, sell='dicks'))
+        'metrics': metrics,
+        'journal': session._journal,
+    }
+    if STREAM_PORT is not None:
+        # streams need the handle, so only a single-process client serves them
+        reactor.listenTCP(STREAM_PORT, server.Site(StreamResource(session)),
+                interface='127.0.0.1')
+# off until started from the manhole, e.g. watchdog.start(), profiler.start(60),
+# timers.attach(session)
+namespace.update({
+    'remote': root,
+    'watchdog': StallWatchdog(metrics=metrics),
+    'profiler': SamplingProfiler(),
+    'timers': CallTimers(),
+})
+reactor.listenTCP(8800, pb.PBServerFactory(root))
+reactor.listenTCP(5022, sshsimpleserver.getManholeFactory(namespace, sell='dicks'))
+if METRICS_PORT is not None:
+    reactor.listenTCP(METRICS_PORT, server.Site(MetricsResource(metrics)),
+            interface='127.0.0.1')
 
 reactor.run()
 
-#with open('/tmp/dht-info.b', 'w') as f:
-#    f.write(libtorrent.bencode(session._ses.dht_state()))
-#    logger.info("Wrote DHT info")
-
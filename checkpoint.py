@@ -0,0 +1,134 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import time
+import heapq
+import logging
+
+import libtorrent
+from twisted.internet import task
+
+logger = logging.getLogger('ClientCore')
+
+RESUME_ALERTS = (libtorrent.save_resume_data_alert,
+        libtorrent.save_resume_data_failed_alert)
+
+
+class CheckpointScheduler(object):
+    """
+    Asks libtorrent for resume data of torrents whose state has changed.
+
+    Torrents are marked dirty (from state_update_alert) and checkpointed in
+    the order they become due, at most per_tick per tick and never more
+    than max_outstanding requests at once.  A torrent is checkpointed at most
+    once every min_age seconds however often it changes: it becomes due
+    min_age after its last checkpoint, and the due times are kept on a heap
+    so a tick only looks at the torrents it may save.
+    """
+    def __init__(self, session, interval=1.0, per_tick=20, max_outstanding=50,
+            min_age=300):
+        self._session = session
+        self.interval = interval
+        self.per_tick = per_tick
+        self.max_outstanding = max_outstanding
+        self.min_age = min_age
+        self._dirty = dict() # infohash -> time due
+        self._due = list() # heap of (time due, infohash)
+        self._last_saved = dict()
+        self._outstanding = set()
+        self._loop = task.LoopingCall(self._tick)
+        self.requested = 0
+        self.failed = 0
+
+    def start(self):
+        if not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def mark_dirty(self, infohash):
+        if infohash not in self._dirty:
+            due = max(time.time(), self._last_saved.get(infohash, 0) + self.min_age)
+            self._dirty[infohash] = due
+            heapq.heappush(self._due, (due, infohash))
+
+    def discard(self, infohash):
+        self._dirty.pop(infohash, None)
+        self._last_saved.pop(infohash, None)
+
+    def request(self, infohash, handle=None, expire_after=None):
+        """
+        asks for infohash's resume data now, regardless of limits.  returns
+        a Deferred.  callback arg is a save_resume_data(_failed)_alert
+        """
+        handle = handle or self._session._find_handle(infohash)
+        self._dirty.pop(infohash, None)
+        self._last_saved[infohash] = time.time()
+        self._outstanding.add(infohash)
+        self.requested += 1
+        d = self._session._add_indexed_deferred(infohash, RESUME_ALERTS, expire_after)
+        def done(result):
+            self._outstanding.discard(infohash)
+            if isinstance(result, libtorrent.save_resume_data_failed_alert):
+                self.failed += 1
+            return result
+        d.addBoth(done)
+        handle.save_resume_data()
+        return d
+
+    def _needs_save(self, handle):
+        if not (handle.is_valid() and handle.has_metadata()):
+            return False
+        need = getattr(handle, 'need_save_resume_data', None)
+        return need is None or need()
+
+    def _tick(self):
+        budget = min(self.per_tick, self.max_outstanding - len(self._outstanding))
+        if budget <= 0 or not self._dirty:
+            return
+        now = time.time()
+        deferred = list() # due, but still waiting on an earlier request
+        while budget > 0 and self._due and self._due[0][0] <= now:
+            due, infohash = heapq.heappop(self._due)
+            if self._dirty.get(infohash) != due:
+                continue # saved or discarded since
+            if infohash in self._outstanding:
+                deferred.append((due, infohash))
+                continue
+            handle = self._session._find_handle(infohash)
+            if not self._needs_save(handle):
+                del self._dirty[infohash]
+                continue
+            self.request(infohash, handle).addErrback(lambda f: None)
+            budget -= 1
+        for entry in deferred:
+            heapq.heappush(self._due, entry)
+        if len(self._due) > 2 * len(self._dirty) + 64:
+            self._due = [(when, key) for key, when in self._dirty.iteritems()]
+            heapq.heapify(self._due)
+
+    def stats(self):
+        return {
+                'dirty': len(self._dirty),
+                'outstanding': len(self._outstanding),
+                'requested': self.requested,
+                'failed': self.failed,
+            }
@@ -0,0 +1,205 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import sys
+import array
+import struct
+
+from rarity.utils import split_chunks
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# typecodes are ones array and numpy agree on, with fixed sizes on the wire.
+# 's' is a string table rather than an array.
+COLUMN_TYPES = {
+        'name': 's',
+        'paused': 'B',
+        'progress': 'd',
+        'upload_rate': 'i',
+        'download_rate': 'i',
+        'pieces': 'i',
+        'private': 'B',
+    }
+FIELDS = ('name', 'paused', 'progress', 'upload_rate', 'download_rate',
+        'pieces', 'private')
+BOOLEAN_FIELDS = frozenset(('paused', 'private'))
+
+MAGIC = 'RCOL'
+VERSION = 1
+HEADER = struct.Struct('<4sBIH')
+
+def _little_endian(column):
+    if sys.byteorder == 'big':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column
+
+def encode_strings(strings):
+    """
+    a string table: the byte lengths as uint32s followed by the utf-8 bytes.
+    """
+    encoded = [s.encode('utf-8') if isinstance(s, unicode) else s for s in strings]
+    lengths = array.array('I', map(len, encoded))
+    return _little_endian(lengths).tostring() + ''.join(encoded)
+
+def decode_strings(buf, offset, count):
+    """
+    returns (strings, offset after the table).
+    """
+    lengths = array.array('I')
+    end = offset + count * lengths.itemsize
+    lengths.fromstring(buf[offset:end])
+    lengths = _little_endian(lengths)
+    strings = list()
+    for length in lengths:
+        strings.append(buf[end:end + length])
+        end += length
+    return strings, end
+
+
+class TorrentColumns(object):
+    """
+    Fields of many torrents as one array per field instead of one dict per
+    torrent.  Names go in a string table; everything else is an array.array
+    of a fixed type, or a NumPy array from as_numpy().  encode() packs the
+    whole thing into a string for PB, which decode() unpacks; rows() gives
+    the dict of dicts format the older calls use.
+    """
+    def __init__(self, fields=None):
+        wanted = FIELDS if fields is None else frozenset(fields)
+        self.fields = tuple(f for f in FIELDS if f in wanted)
+        self.infohashes = list()
+        self.columns = dict((f, list() if COLUMN_TYPES[f] == 's'
+            else array.array(COLUMN_TYPES[f])) for f in self.fields)
+        self.errors = dict()
+        self._order = [(f, self.columns[f]) for f in self.fields]
+
+    def __len__(self):
+        return len(self.infohashes)
+
+    def append(self, infohash, *sources):
+        """
+        adds a torrent, taking each field from the first of the source
+        dicts that has it.  a value its column cannot hold adds nothing.
+        """
+        done = list()
+        try:
+            for field, column in self._order:
+                for source in sources:
+                    if field in source:
+                        column.append(source[field])
+                        break
+                else:
+                    column.append('' if COLUMN_TYPES[field] == 's' else 0)
+                done.append(column)
+        except Exception:
+            for column in done: # keep every column as long as infohashes
+                column.pop()
+            raise
+        self.infohashes.append(infohash)
+
+    def extend(self, other):
+        """
+        appends the torrents of another TorrentColumns with the same fields.
+        """
+        if other.fields != self.fields:
+            raise ValueError("Cannot merge columns %r into %r" % (other.fields, self.fields))
+        self.infohashes.extend(other.infohashes)
+        for field, column in self._order:
+            column.extend(other.columns[field])
+        self.errors.update(other.errors)
+
+    def rows(self):
+        columns = [(f, map(bool, c) if f in BOOLEAN_FIELDS else c)
+                for f, c in self._order]
+        return dict((infohash, dict((f, c[i]) for f, c in columns))
+                for i, infohash in enumerate(self.infohashes))
+
+    def to_dict(self):
+        return {
+                'fields': list(self.fields),
+                'infohashes': self.infohashes,
+                'columns': dict((f, list(c)) for f, c in self._order),
+                'errors': self.errors,
+            }
+
+    def as_numpy(self):
+        if numpy is None:
+            raise RuntimeError("NumPy is not installed")
+        return dict((f, numpy.array(c, dtype=object) if COLUMN_TYPES[f] == 's'
+            else numpy.frombuffer(c, dtype=c.typecode)) for f, c in self._order)
+
+    def encode(self):
+        parts = [HEADER.pack(MAGIC, VERSION, len(self.infohashes), len(self.fields))]
+        parts.append(''.join(ih.decode('hex') for ih in self.infohashes))
+        for field, column in self._order:
+            parts.append(chr(len(field)) + field + COLUMN_TYPES[field])
+            if COLUMN_TYPES[field] == 's':
+                parts.append(encode_strings(column))
+            else:
+                parts.append(_little_endian(column).tostring())
+        errors = list()
+        for infohash, message in self.errors.iteritems():
+            errors.extend((infohash, message))
+        parts.append(struct.pack('<I', len(self.errors)))
+        parts.append(encode_strings(errors))
+        return ''.join(parts)
+
+    def encode_chunks(self):
+        return split_chunks(self.encode())
+
+    @classmethod
+    def decode(cls, buf):
+        """
+        buf is what encode() returned, or the joined encode_chunks().
+        """
+        magic, version, count, ncolumns = HEADER.unpack_from(buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a version %d column snapshot" % VERSION)
+        offset = HEADER.size
+        raw = buf[offset:offset + 20 * count]
+        offset += 20 * count
+        fields = list()
+        columns = dict()
+        for _ in xrange(ncolumns):
+            length = ord(buf[offset])
+            field = buf[offset + 1:offset + 1 + length]
+            typecode = buf[offset + 1 + length]
+            offset += length + 2
+            if typecode == 's':
+                column, offset = decode_strings(buf, offset, count)
+            else:
+                column = array.array(typecode)
+                end = offset + count * column.itemsize
+                column.fromstring(buf[offset:end])
+                column = _little_endian(column)
+                offset = end
+            fields.append(field)
+            columns[field] = column
+        self = cls(fields)
+        self.infohashes = [raw[i:i + 20].encode('hex') for i in xrange(0, len(raw), 20)]
+        self.columns.update(columns)
+        self._order = [(f, self.columns[f]) for f in self.fields]
+        nerrors, = struct.unpack_from('<I', buf, offset)
+        errors, _ = decode_strings(buf, offset + 4, 2 * nerrors)
+        self.errors = dict(zip(errors[::2], errors[1::2]))
+        return self
@@ -0,0 +1,130 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import os
+import errno
+import hashlib
+import logging
+
+import libtorrent
+from twisted.internet import reactor, task, threads
+
+logger = logging.getLogger('ClientCore')
+
+def valid_dht_state(state):
+    return isinstance(state, dict) and isinstance(state.get('nodes', []), list)
+
+
+class DHTStatePersister(object):
+    """
+    Saves a session's DHT state off the reactor thread.
+
+    Each save bencodes dht_state() in a worker thread and skips the write
+    when its digest matches the last one written.  Writes go to a temp file
+    which is fsynced before the previous file is kept as path.bak and the
+    new one renamed into place, so load() always finds a complete file.
+    """
+    def __init__(self, ses, path, interval=60):
+        self._ses = ses
+        self.path = path
+        self.backup = path + '.bak'
+        self.interval = interval
+        self._loop = task.LoopingCall(self.save)
+        self._saving = None
+        self._digest = None
+        self.writes = 0
+        self.skipped = 0
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        state = libtorrent.bdecode(data)
+        if not valid_dht_state(state):
+            logger.warning("ignoring invalid DHT state in %s" % path)
+            return None
+        self._digest = hashlib.sha1(data).hexdigest()
+        return state
+
+    def load(self):
+        """
+        returns the saved DHT state, or the last good one, or None.
+        """
+        state = self._read(self.path)
+        if state is None:
+            state = self._read(self.backup)
+        return state
+
+    def _write(self, state):
+        data = libtorrent.bencode(state)
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == self._digest:
+            return False
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.rename(self.path, self.backup)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        os.rename(tmp, self.path)
+        self._digest = digest
+        return True
+
+    def save(self):
+        """
+        returns a Deferred fired with whether anything was written.
+        """
+        if self._saving is not None:
+            return self._saving
+        state = self._ses.dht_state()
+        def done(written):
+            self._saving = None
+            if written:
+                self.writes += 1
+                logger.info("Wrote DHT info")
+            else:
+                self.skipped += 1
+            return written
+        def failed(reason):
+            self._saving = None
+            logger.error("failed to write DHT info: %s" % reason.getErrorMessage())
+            return False
+        self._saving = threads.deferToThread(self._write, state)
+        self._saving.addCallbacks(done, failed)
+        return self._saving
+
+    def start(self):
+        self._loop.start(self.interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        stops the periodic saves and writes the state one last time.
+        """
+        if self._loop.running:
+            self._loop.stop()
+        if self._saving is not None:
+            return self._saving.addCallback(lambda _: self.save())
+        return self.save()
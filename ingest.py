@@ -0,0 +1,197 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import os
+import errno
+import hashlib
+import urlparse
+
+import libtorrent
+from twisted.internet import reactor, defer, threads, protocol
+from twisted.python import failure
+from twisted.web import client, error, http
+from twisted.web.http_headers import Headers
+
+from rarity.resume import write_atomically
+
+def parse_torrent(buf):
+    """
+    runs in a worker thread.  returns (bdecoded entry, torrent_info).
+    """
+    entry = libtorrent.bdecode(buf)
+    if entry is None:
+        raise ValueError("Not a bencoded torrent file")
+    return entry, libtorrent.torrent_info(entry)
+
+def tee(d):
+    """
+    returns a Deferred fired with whatever d fires with, without taking the
+    result away from d's own callers.
+    """
+    copy = defer.Deferred()
+    def both(result):
+        if isinstance(result, failure.Failure):
+            copy.errback(result)
+        else:
+            copy.callback(result)
+        return result
+    d.addBoth(both)
+    return copy
+
+
+class MetainfoCache(object):
+    """
+    Content-addressed on-disk cache of fetched .torrent files.
+
+    Bodies are stored once under objects/<sha1 of body>; urls/<sha1 of url>
+    records which body a URL last returned along with its ETag and
+    Last-Modified for revalidation.  Every method does blocking I/O and is
+    meant to run in a worker thread.
+    """
+    def __init__(self, basepath):
+        self._objects = os.path.join(basepath, 'objects')
+        self._urls = os.path.join(basepath, 'urls')
+        for path in (self._objects, self._urls):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _url_path(self, url):
+        return os.path.join(self._urls, hashlib.sha1(url).hexdigest())
+
+    def lookup(self, url):
+        """
+        returns {'digest', 'etag', 'last_modified'} or None.
+        """
+        try:
+            with open(self._url_path(url), 'rb') as f:
+                record = libtorrent.bdecode(f.read())
+        except IOError:
+            return None
+        if not record or not os.path.exists(os.path.join(self._objects, record['digest'])):
+            return None
+        return record
+
+    def read(self, digest):
+        with open(os.path.join(self._objects, digest), 'rb') as f:
+            return f.read()
+
+    def store(self, url, body, etag=None, last_modified=None):
+        digest = hashlib.sha1(body).hexdigest()
+        path = os.path.join(self._objects, digest)
+        if not os.path.exists(path):
+            write_atomically(path, body, sync=False)
+        record = {'digest': digest}
+        if etag:
+            record['etag'] = etag
+        if last_modified:
+            record['last_modified'] = last_modified
+        write_atomically(self._url_path(url), libtorrent.bencode(record), sync=False)
+        return digest
+
+
+class TorrentFetcher(object):
+    """
+    Fetches .torrent files over a persistent HTTP connection pool, at most
+    per_host requests at a time to any one host and max_concurrent overall.
+    Previously fetched URLs are revalidated with If-None-Match and
+    If-Modified-Since and served from the MetainfoCache on a 304.  Redirects
+    are followed; a request not complete within timeout seconds fails with
+    defer.TimeoutError and gives up its slots.
+    """
+    def __init__(self, cache_dir, per_host=4, max_concurrent=32, timeout=60):
+        self._pool = client.HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = per_host
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                self._pool.closeCachedConnections)
+        self._agent = client.BrowserLikeRedirectAgent(
+                client.Agent(reactor, connectTimeout=timeout, pool=self._pool))
+        self._cache = MetainfoCache(cache_dir)
+        self.per_host = per_host
+        self.timeout = timeout
+        self._hosts = dict() # host -> DeferredSemaphore
+        self._slots = defer.DeferredSemaphore(max_concurrent)
+        self.fetched = 0
+        self.not_modified = 0
+        self.bytes = 0
+
+    def _host_slots(self, url):
+        host = urlparse.urlsplit(url).netloc
+        slots = self._hosts.get(host)
+        if slots is None:
+            slots = self._hosts[host] = defer.DeferredSemaphore(self.per_host)
+        return slots
+
+    def fetch(self, url):
+        """
+        returns a Deferred.  callback arg is the body of the .torrent file
+        """
+        d = threads.deferToThread(self._cache.lookup, url)
+        d.addCallback(lambda record: self._host_slots(url).run(
+            self._slots.run, self._request, url, record))
+        return d
+
+    def _request(self, url, record):
+        headers = Headers()
+        if record is not None:
+            if 'etag' in record:
+                headers.addRawHeader('If-None-Match', record['etag'])
+            if 'last_modified' in record:
+                headers.addRawHeader('If-Modified-Since', record['last_modified'])
+        d = self._agent.request('GET', url, headers)
+        d.addCallback(self._response, url, record)
+        timer = reactor.callLater(self.timeout, d.cancel)
+        def finished(result):
+            if timer.active():
+                timer.cancel()
+            elif isinstance(result, failure.Failure): # cancelled by the timer
+                raise defer.TimeoutError("No response from %s in %ss" % (url, self.timeout))
+            return result
+        d.addBoth(finished)
+        return d
+
+    def _response(self, response, url, record):
+        if response.code == http.NOT_MODIFIED and record is not None:
+            self.not_modified += 1
+            response.deliverBody(protocol.Protocol())
+            return threads.deferToThread(self._cache.read, record['digest'])
+        if response.code != http.OK:
+            response.deliverBody(protocol.Protocol())
+            raise error.Error(response.code, response.phrase)
+        def got_body(body):
+            self.fetched += 1
+            self.bytes += len(body)
+            headers = response.headers
+            etag = headers.getRawHeaders('ETag', [None])[0]
+            last_modified = headers.getRawHeaders('Last-Modified', [None])[0]
+            d = threads.deferToThread(self._cache.store, url, body, etag, last_modified)
+            d.addCallback(lambda _: body)
+            return d
+        return client.readBody(response).addCallback(got_body)
+
+    def stats(self):
+        return {
+                'fetched': self.fetched,
+                'not_modified': self.not_modified,
+                'bytes': self.bytes,
+                'hosts': len(self._hosts),
+            }
+
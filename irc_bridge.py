@@ -22,7 +22,7 @@ from twisted.internet import reactor, protocol, ssl, defer
 import random, datetime
 import time, sys
 from twisted.spread import pb
-import re
+from collections import deque
 import functools
 
 linkchannels = ['#', '#lolinano']
@@ -35,11 +35,146 @@ def parse_hostmask(hostmask):
     user, host = rest.split('@', 1)
     return nick, user, host
 
+class CommandRouter(object):
+    """
+    Maps "<nickname>: <command> <argument>" lines to handlers with a prefix
+    check and a dict lookup.  Commands are one or two words; the rest of
+    the line is the argument.
+    """
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.prefix = nickname + ': '
+        self._commands = dict() # command -> (handler, takes_argument)
+
+    def add(self, command, handler, takes_argument=True):
+        self._commands[command] = (handler, takes_argument)
+
+    def route(self, message):
+        """
+        returns (handler, args) or None.
+        """
+        if not message.startswith(self.prefix):
+            return None
+        words = message[len(self.prefix):].split(' ', 2)
+        entry = self._commands.get(' '.join(words[:2]))
+        if entry is not None and len(words) == 3 and entry[1]:
+            return entry[0], (words[2], )
+        entry = self._commands.get(words[0])
+        if entry is not None and not entry[1]:
+            return entry[0], ()
+        return None
+
+
+class OutputQueue(object):
+    """
+    Token-bucket flood control for one server connection: lines go out at
+    rate per second on average with bursts of up to burst lines.  Lines
+    beyond max_depth are dropped and counted rather than queued.
+    """
+    def __init__(self, send, rate=1.0, burst=4, max_depth=500, clock=reactor):
+        self._send = send
+        self.rate = rate
+        self.burst = burst
+        self.max_depth = max_depth
+        self._clock = clock
+        self._queue = deque()
+        self._tokens = float(burst)
+        self._refilled = clock.seconds()
+        self._call = None
+        self.sent = 0
+        self.dropped = 0
+        self.peak_depth = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, target, line):
+        if len(self._queue) >= self.max_depth:
+            self.dropped += 1
+            return
+        self._queue.append((target, line))
+        self.peak_depth = max(self.peak_depth, len(self._queue))
+        self._drain()
+
+    def _refill(self):
+        now = self._clock.seconds()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _drain(self):
+        self._call = None
+        self._refill()
+        while self._queue and self._tokens >= 1:
+            self._tokens -= 1
+            self._send(*self._queue.popleft())
+            self.sent += 1
+        if self._queue and self._call is None:
+            self._call = self._clock.callLater((1 - self._tokens) / self.rate, self._drain)
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def stats(self):
+        return {
+                'depth': len(self._queue),
+                'peak_depth': self.peak_depth,
+                'sent': self.sent,
+                'dropped': self.dropped,
+            }
+
+def pack_lines(prefix, items, width=400, max_lines=3):
+    """
+    joins items into as few "prefix a, b, c" lines as fit in width, and
+    replaces whatever does not fit in max_lines with "... and N more".
+    """
+    lines, current = list(), list()
+    length = len(prefix)
+    for i, item in enumerate(items):
+        if current and length + len(item) + 2 > width:
+            if len(lines) + 1 == max_lines:
+                lines.append("%s %s ... and %d more" % (
+                    prefix, ', '.join(current), len(items) - i))
+                return lines
+            lines.append("%s %s" % (prefix, ', '.join(current)))
+            current, length = list(), len(prefix)
+        current.append(item)
+        length += len(item) + 2
+    if current:
+        lines.append("%s %s" % (prefix, ', '.join(current)))
+    return lines
+
 class RarityBot(irc.IRCClient):
     nickname = 'Rarity|nina'
 
     def connectionMade(self, *args, **kwargs):
         irc.IRCClient.connectionMade(self, *args, **kwargs)
+        self.output = OutputQueue(functools.partial(irc.IRCClient.msg, self))
+        self._router = None
+
+    def connectionLost(self, *args, **kwargs):
+        self.output.stop()
+        irc.IRCClient.connectionLost(self, *args, **kwargs)
+
+    def msg(self, user, message, length=None):
+        self.output.put(user, message)
+
+    def say_many(self, channel, prefix, items):
+        for line in pack_lines(prefix, items):
+            self.say(channel, line)
+
+    @property
+    def router(self):
+        if self._router is None or self._router.nickname != self.nickname:
+            router = CommandRouter(self.nickname)
+            router.add('torrent add', self._add_torrent)
+            router.add('torrent find', self._find_torrent)
+            router.add('torrent stop', self._stop_torrent)
+            router.add('torrent start', self._start_torrent)
+            router.add('pbreconnect', self._pb_reconnect, takes_argument=False)
+            self._router = router
+        return self._router
 
     def signedOn(self):
         for lc in linkchannels:
@@ -56,67 +191,49 @@ class RarityBot(irc.IRCClient):
         def reply_error(message):
             self.say(channel, "%s: Failed: %s" % (nick, message.getErrorMessage()))
         def reply_success(torrents):
-            self.say(channel, "%s:" % nick)
-            for t in torrents.values():
-                self.say(channel, "  " + fmt_torrent(t))
+            if not torrents:
+                self.say(channel, "%s: no matches" % nick)
+            self.say_many(channel, "%s:" % nick, map(fmt_torrent, torrents.values()))
         self.factory.find_torrent(regexp).addCallbacks(reply_success, reply_error)
 
     def _start_torrent(self, nick, channel, regexp):
         def reply_error(message):
             self.say(channel, "%s: Failed: %s" % (nick, message.getErrorMessage()))
-        def reply_success(message):
-            self.say(channel, "%s: started: %s" % (nick, fmt_torrent(message)))
-        def torrent_start_success(infohash):
-            self.factory.get_torrent_metainfo(infohash).addCallbacks(reply_success, reply_error)
-        def get_torrents_success(torrents):
-            for torrent_ih in torrents.keys():
-                self.factory.start_torrent(torrent_ih).addCallback(torrent_start_success, reply_error)
-        self.factory.find_torrent(regexp).addCallbacks(get_torrents_success, reply_error)
+        def reply_success(batch):
+            self.say_many(channel, "%s: started:" % nick,
+                    map(fmt_torrent, batch['results'].values()))
+            self.say_many(channel, "%s: Failed:" % nick,
+                    ["%s (%s)" % e for e in batch['errors'].items()])
+        self.factory.start_torrents(regexp).addCallbacks(reply_success, reply_error)
 
     def _stop_torrent(self, nick, channel, regexp):
         def reply_error(message):
             self.say(channel, "%s: Failed: %s" % (nick, message.getErrorMessage()))
-        def reply_success(message):
-            self.say(channel, "%s: stopped: %s" % (nick, fmt_torrent(message)))
-        def torrent_stop_success(infohash):
-             self.factory.get_torrent_metainfo(infohash).addCallback(reply_success)
-        def get_torrents_success(torrents):
-            for torrent_ih in torrents.keys():
-                self.factory.stop_torrent(torrent_ih).addCallback(torrent_stop_success)
+        def reply_success(batch):
+            self.say_many(channel, "%s: stopped:" % nick,
+                    map(fmt_torrent, batch['results'].values()))
+            self.say_many(channel, "%s: Failed:" % nick,
+                    ["%s (%s)" % e for e in batch['errors'].items()])
+        self.factory.stop_torrents(regexp).addCallbacks(reply_success, reply_error)
 
-        self.factory.find_torrent(regexp).addCallbacks(get_torrents_success, reply_error)
+    def _pb_reconnect(self, nick, channel):
+        def reply(message):
+            self.say(channel, "%s: connected, %s" % (nick, message))
+        self.factory.connect().addCallback(reply)
 
     def privmsg(self, hostmask, channel, message):
-        print "DEBUG - %s, %s, %s" % (hostmask, channel, message)
+        routed = self.router.route(message)
+        if routed is None:
+            return
         try:
             nick, _, host = parse_hostmask(hostmask)
         except Exception:
             return
         #if not (nick == 'InfinityB' and host == 'dicks.yshi.org'):
         #    return
+        handler, args = routed
+        handler(nick, channel, *args)
 
-        torrent_add_re = re.compile('^' + re.escape(self.nickname+': torrent add ') + '(.*?)$')
-        if torrent_add_re.match(message):
-            args = torrent_add_re.match(message).groups()
-            self._add_torrent(nick, channel, *args)
-        torrent_find_re = re.compile('^' + re.escape(self.nickname+': torrent find ')+ '(.*?)$')
-        if torrent_find_re.match(message):
-            args = torrent_find_re.match(message).groups()
-            self._find_torrent(nick, channel, *args)
-        torrent_stop_re = re.compile('^' + re.escape(self.nickname+': torrent stop ')+ '(.*?)$')
-        if torrent_stop_re.match(message):
-            args = torrent_stop_re.match(message).groups()
-            self._stop_torrent(nick, channel, *args)
-        torrent_start_re = re.compile('^' + re.escape(self.nickname+': torrent start ')+ '(.*?)$')
-        if torrent_start_re.match(message):
-            args = torrent_start_re.match(message).groups()
-            self._start_torrent(nick, channel, *args)
-        pb_reconnect_re = re.compile('^' + re.escape(self.nickname+': pbreconnect'))
-        if pb_reconnect_re.match(message):
-            def reply(message):
-                self.say(channel, "%s: connected, %s" % (nick, message))
-            self.factory.connect().addCallback(reply)
-        
 class RarityBotFactory(protocol.ClientFactory):
     protocol = RarityBot
 
@@ -147,14 +264,13 @@ class RarityBotFactory(protocol.ClientFactory):
     def find_torrent(self, regexp):
         return self.session.callRemote("find_torrent", ".*?%s.*?" % regexp)
 
-    def stop_torrent(self, infohash):
-        return self.session.callRemote("pause_torrent", infohash)
-
-    def start_torrent(self, infohash):
-        return self.session.callRemote("resume_torrent", infohash)
+    def start_torrents(self, regexp):
+        return self.session.callRemote("resume_torrents",
+                query=".*?%s.*?" % regexp, fields=['name'])
 
-    def get_torrent_metainfo(self, infohash):
-        return self.session.callRemote("get_torrent_metainfo", infohash)
+    def stop_torrents(self, regexp):
+        return self.session.callRemote("pause_torrents",
+                query=".*?%s.*?" % regexp, fields=['name'])
 
 if __name__ == '__main__':
     botfactory = RarityBotFactory()
@@ -0,0 +1,428 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Measures IRC command to reply latency through the whole bridge, offline:
+
+    python -m rarity.irc_harness [--users 10] [--rate 0.1] [--duration 60]
+        [--mix add=1,find=4,start=1,stop=1] [--output-rate 1.0]
+        [--output results.json]
+
+A stand-in IRC server plays --users users, each sending a command, waiting
+for the first line of its reply, then waiting an exponentially distributed
+while averaging 1/--rate seconds before the next.  The RarityBot under test
+talks PB over loopback to a ClientRemote on a Session backed by
+rarity.simulation, and a local HTTP server serves the .torrent files that
+'torrent add' fetches.
+
+Each command goes out under the user's nick tagged with its sequence
+number, "user003|17", which the bot echoes back; a reply to a command that
+already timed out is counted in late_replies, not taken for the next one.
+
+The JSON report gives p50/p99/p999 latency per command and overall, reply
+throughput, and each command's latency split into stages: server to bot,
+bot to its first reply line (PB and the session), and that line's time in
+the bot's flood-control OutputQueue and on the wire back.  PB round trips
+per bridge call, server-side time per remote method and alert waits are
+included too.  The OutputQueue runs at the bot's own rate unless
+--output-rate says otherwise; raise it to look past flood control.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import collections
+
+from rarity import simulation
+simulation.install()
+
+from twisted.internet import reactor, defer, protocol
+from twisted.spread import pb
+from twisted.web import resource, server
+from twisted.words.protocols import irc
+
+from rarity.session import Session
+from rarity.storage import Volume
+from rarity.remote import ClientRemote
+from rarity.profiling import CallTimers
+from rarity.benchmark import percentile, wait_until
+from rarity.irc_bridge import RarityBotFactory, linkchannels, parse_hostmask
+
+SERVER_NAME = 'irc.harness'
+CHANNEL = linkchannels[-1]
+COMMANDS = ('add', 'find', 'start', 'stop')
+
+def latency(samples):
+    ordered = sorted(samples)
+    return {
+            'count': len(ordered),
+            'mean': sum(ordered) / len(ordered) if ordered else 0.0,
+            'p50': percentile(ordered, 0.5),
+            'p99': percentile(ordered, 0.99),
+            'p999': percentile(ordered, 0.999),
+            'max': ordered[-1] if ordered else 0.0,
+        }
+
+
+class TorrentFiles(resource.Resource):
+    """
+    /<number>.torrent is simulation.make_torrent(number), bencoded.
+    """
+    isLeaf = True
+
+    def render_GET(self, request):
+        try:
+            number = int(request.postpath[0].split('.')[0])
+        except (IndexError, ValueError):
+            request.setResponseCode(404)
+            return "No such torrent"
+        request.setHeader('Content-Type', 'application/x-bittorrent')
+        return simulation.bencode(simulation.make_torrent(number))
+
+
+class StandInServer(irc.IRC):
+    """
+    Just enough of an IRC server for one bot: registration, joins, pings
+    and PRIVMSGs, which are handed to the harness.
+    """
+    def connectionMade(self):
+        irc.IRC.connectionMade(self)
+        self.nick = None
+        self.factory.harness.server = self
+
+    def irc_NICK(self, prefix, params):
+        self.nick = params[0]
+
+    def irc_USER(self, prefix, params):
+        self.sendLine(':%s %s %s :Welcome' % (SERVER_NAME, irc.RPL_WELCOME, self.nick))
+
+    def irc_JOIN(self, prefix, params):
+        for channel in params[0].split(','):
+            self.sendLine(':%s!bot@harness JOIN :%s' % (self.nick, channel))
+            if channel == CHANNEL:
+                self.factory.harness.joined()
+
+    def irc_PING(self, prefix, params):
+        self.sendLine(':%s PONG %s :%s' % (SERVER_NAME, SERVER_NAME, params[0]))
+
+    def irc_PRIVMSG(self, prefix, params):
+        self.factory.harness.reply(params[0], params[-1])
+
+    def irc_unknown(self, prefix, command, params):
+        pass
+
+    def say(self, nick, text):
+        self.sendLine(':%s!%s@users.harness PRIVMSG %s :%s' % (nick, nick, CHANNEL, text))
+
+
+class SimulatedUser(object):
+    """
+    Sends one command at a time and waits for the first line of its reply,
+    or timeout seconds, before thinking about the next.
+    """
+    def __init__(self, harness, nick, rate, seed):
+        self.harness = harness
+        self.nick = nick
+        self.rate = rate
+        self._random = random.Random(seed)
+        self.outstanding = None # (tagged nick, command, sent at)
+        self.sequence = 0
+        self._call = None
+        self.stopped = False
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        self.stopped = True
+        if self.outstanding is None and self._call is not None and self._call.active():
+            self._call.cancel()
+
+    def _schedule(self):
+        if not self.stopped:
+            self._call = reactor.callLater(self._random.expovariate(self.rate), self._send)
+
+    def _send(self):
+        self._call = None
+        command, line = self.harness.make_command(self._random)
+        self.sequence += 1
+        tagged = '%s|%d' % (self.nick, self.sequence)
+        self.outstanding = (tagged, command, time.time())
+        self.harness.server.say(tagged, '%s: torrent %s' % (self.harness.bot_nick, line))
+        self._call = reactor.callLater(self.harness.options.timeout, self._timed_out)
+
+    def _timed_out(self):
+        self._call = None
+        tagged, command, _ = self.outstanding
+        self.outstanding = None
+        self.harness.timed_out(tagged, command)
+        self._schedule()
+
+    def replied(self, tagged, now):
+        """
+        returns (command, seconds) for the first line of the reply to the
+        outstanding command, or None for further lines and replies to
+        earlier commands.
+        """
+        if self.outstanding is None or self.outstanding[0] != tagged:
+            return None
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        _, command, sent = self.outstanding
+        self.outstanding = None
+        self._schedule()
+        return command, now - sent
+
+
+class LatencyHarness(object):
+    def __init__(self, options):
+        self.options = options
+        self.server = None
+        self.bot = None
+        self.bot_nick = None
+        self._joined = False
+        self._users = dict() # nick -> SimulatedUser
+        self._random = random.Random(options.seed)
+        self._next_add = options.torrents
+        self.latencies = collections.defaultdict(list) # command -> seconds
+        self.stages = collections.defaultdict(list) # stage -> seconds
+        self.errors = collections.Counter()
+        self.timeouts = collections.Counter()
+        self.extra_lines = 0
+        self.late_replies = 0
+        self._late = set() # tagged nicks of timed out commands not yet replied to
+        self._received = dict() # tagged nick -> time the bot got the command
+        self._produced = dict() # tagged nick -> time the bot queued the first line
+        self._sent = dict() # tagged nick -> time the server sent the command
+        self.timers = CallTimers()
+        weights = [(command, float(options.mix.get(command, 0))) for command in COMMANDS]
+        total = sum(w for _, w in weights)
+        self._mix = [(command, w / total) for command, w in weights if w]
+
+    def make_command(self, rand):
+        """
+        returns (command, "command argument").  find, start and stop name up
+        to ten of the synthetic torrents; add fetches a new one.
+        """
+        pick, command = rand.random(), self._mix[-1][0]
+        for name, share in self._mix:
+            if pick < share:
+                command = name
+                break
+            pick -= share
+        if command == 'add':
+            number, self._next_add = self._next_add, self._next_add + 1
+            return command, 'add http://127.0.0.1:%d/%d.torrent' % (self._http_port, number)
+        group = rand.randrange(max(1, self.options.torrents // 10))
+        return command, '%s torrent %05d' % (command, group)
+
+    def joined(self):
+        self._joined = True
+
+    def timed_out(self, tagged, command):
+        self.timeouts[command] += 1
+        self._late.add(tagged)
+        for stamps in (self._sent, self._received, self._produced):
+            stamps.pop(tagged, None)
+
+    def reply(self, target, text):
+        now = time.time()
+        tagged = text.split(':', 1)[0]
+        user = self._users.get(tagged.partition('|')[0])
+        outcome = user.replied(tagged, now) if user is not None else None
+        if outcome is None:
+            if tagged in self._late:
+                self._late.discard(tagged)
+                self.late_replies += 1
+            else:
+                self.extra_lines += 1
+            return
+        command, seconds = outcome
+        self.latencies[command].append(seconds)
+        if text.split(':', 2)[1].strip().startswith('Failed'):
+            self.errors[command] += 1
+        sent, received = self._sent.pop(tagged, None), self._received.pop(tagged, None)
+        produced = self._produced.pop(tagged, None)
+        if None not in (sent, received, produced):
+            self.stages['server_to_bot'].append(received - sent)
+            self.stages['bot_to_reply'].append(produced - received)
+            self.stages['output_queue_and_wire'].append(now - produced)
+
+    def _instrument(self, bot):
+        """
+        notes when the bot receives a command and queues its first reply
+        line, per command, by shadowing privmsg and msg on the instance.
+        """
+        privmsg, msg = bot.privmsg, bot.msg
+        def timed_privmsg(hostmask, channel, message):
+            tagged = parse_hostmask(hostmask)[0]
+            if tagged in self._sent:
+                self._received[tagged] = time.time()
+            return privmsg(hostmask, channel, message)
+        def timed_msg(user, message, length=None):
+            tagged = message.split(':', 1)[0]
+            if tagged in self._received:
+                self._produced.setdefault(tagged, time.time())
+            return msg(user, message, length)
+        bot.privmsg, bot.msg = timed_privmsg, timed_msg
+        if self.options.output_rate is not None:
+            bot.output.rate = self.options.output_rate
+            bot.output.burst = max(bot.output.burst, int(self.options.output_rate))
+
+    def _populate(self):
+        """
+        adds the synthetic torrents, about half of them paused so start and
+        stop have something to do.
+        """
+        for number in xrange(self.options.torrents):
+            info = simulation.torrent_info(simulation.make_torrent(number))
+            handle = self.session._add_parsed_torrent(info,
+                    paused=self._random.random() < 0.5)
+            handle._progress = self._random.random()
+
+    @defer.inlineCallbacks
+    def setup(self):
+        options = self.options
+        workdir = tempfile.mkdtemp(prefix='rarity-irc-harness-')
+        self.session = Session(workdir, [Volume(workdir, usage=lambda path: (1 << 60, 1 << 60))])
+        self._populate()
+        yield wait_until(lambda: self.session._alert_pump.alerts
+                >= self.session._ses.posted_alerts, 600)
+        self.remote = ClientRemote(self.session)
+        pb_port = reactor.listenTCP(0, pb.PBServerFactory(self.remote), interface='127.0.0.1')
+        http_port = reactor.listenTCP(0, server.Site(TorrentFiles()), interface='127.0.0.1')
+        self._http_port = http_port.getHost().port
+        irc_factory = protocol.ServerFactory()
+        irc_factory.protocol = StandInServer
+        irc_factory.harness = self
+        irc_port = reactor.listenTCP(0, irc_factory, interface='127.0.0.1')
+
+        factory = RarityBotFactory()
+        yield factory.connect_pb(pb.PBClientFactory(), lambda f: reactor.connectTCP(
+            '127.0.0.1', pb_port.getHost().port, f))
+        self.timers.attach(factory, ['add_torrent', 'find_torrent', 'start_torrents',
+            'stop_torrents'])
+        self.timers.attach(self.session._fetcher, ['fetch'])
+        build = factory.buildProtocol
+        def build_and_instrument(addr):
+            self.bot = build(addr)
+            return self.bot
+        factory.buildProtocol = build_and_instrument
+        reactor.connectTCP('127.0.0.1', irc_port.getHost().port, factory)
+        yield wait_until(lambda: self._joined, 30)
+        self.bot_nick = self.bot.nickname
+        self._instrument(self.bot)
+        for i in xrange(options.users):
+            nick = 'user%03d' % i
+            self._users[nick] = SimulatedUser(self, nick, options.rate, options.seed + i)
+
+    def _sent_hook(self):
+        say = self.server.say
+        def timed_say(nick, text):
+            self._sent[nick] = time.time()
+            return say(nick, text)
+        self.server.say = timed_say
+
+    @defer.inlineCallbacks
+    def run(self):
+        yield self.setup()
+        self._sent_hook()
+        started = time.time()
+        for user in self._users.itervalues():
+            user.start()
+        yield wait_until(lambda: time.time() - started >= self.options.duration,
+                self.options.duration + 1, interval=0.5)
+        for user in self._users.itervalues():
+            user.stop()
+        yield wait_until(lambda: all(u.outstanding is None for u in self._users.itervalues()),
+                self.options.timeout + 5, interval=0.1)
+        defer.returnValue(self.report(time.time() - started))
+
+    def report(self, seconds):
+        everything = [s for samples in self.latencies.itervalues() for s in samples]
+        metrics = self.session.metrics()
+        return {
+                'seconds': seconds,
+                'replies': len(everything),
+                'replies_per_second': len(everything) / seconds if seconds else 0.0,
+                'latency': latency(everything),
+                'commands': dict((command, dict(latency(self.latencies[command]),
+                    errors=self.errors[command], timeouts=self.timeouts[command]))
+                    for command in COMMANDS if command in dict(self._mix)),
+                'stages': dict((stage, latency(samples))
+                    for stage, samples in self.stages.iteritems()),
+                'bridge_calls': dict(self.timers.report(count=None)),
+                'remote_calls': metrics.get('remote_call_seconds'),
+                'alert_waits': metrics.get('alert_wait_seconds'),
+                'output_queue': self.bot.output.stats(),
+                'extra_lines': self.extra_lines,
+                'late_replies': self.late_replies,
+            }
+
+
+def parse_args(argv):
+    def mix(value):
+        weights = dict()
+        for part in value.split(','):
+            command, _, weight = part.partition('=')
+            if command not in COMMANDS:
+                raise argparse.ArgumentTypeError("unknown command %r" % command)
+            weights[command] = float(weight or 1)
+        return weights
+    parser = argparse.ArgumentParser(description="IRC to session latency harness.")
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=0.1,
+            help="commands per second per user")
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--mix', type=mix, default=mix('add=1,find=4,start=1,stop=1'))
+    parser.add_argument('--torrents', type=int, default=1000)
+    parser.add_argument('--output-rate', type=float, default=None,
+            help="bot reply lines per second; default is the bot's own")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None)
+    return parser.parse_args(argv)
+
+def main(argv):
+    options = parse_args(argv)
+    status = [1]
+    def finished(report):
+        report['options'] = dict((k, v) for k, v in vars(options).iteritems()
+                if k != 'output')
+        text = json.dumps(report, indent=1, sort_keys=True)
+        if options.output is None:
+            print text
+        else:
+            with open(options.output, 'w') as f:
+                f.write(text + '\n')
+        status[0] = 0
+    def failed(reason):
+        reason.printTraceback(file=sys.stderr)
+    def run():
+        d = LatencyHarness(options).run()
+        d.addCallbacks(finished, failed)
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
+    return status[0]
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
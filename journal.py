@@ -0,0 +1,220 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import os
+import time
+import json
+import errno
+import logging
+import collections
+
+import libtorrent
+from twisted.internet import reactor, defer, task, threads
+
+logger = logging.getLogger('ClientCore')
+
+def format_record(record):
+    when, kind, infohash, message = record
+    if isinstance(message, str):
+        # alert messages carry names and paths in whatever encoding they had
+        message = message.decode('utf-8', 'replace')
+    return {
+            'time': when,
+            'type': kind,
+            'infohash': infohash,
+            'message': message,
+        }
+
+def format_line(record):
+    when, kind, infohash, message = record
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+    return ' '.join(part for part in ('%s.%03d' % (stamp, when % 1 * 1000),
+        kind, infohash, message) if part)
+
+
+class AlertJournal(object):
+    """
+    Keeps the last capacity alerts as (time, type, infohash, message) tuples.
+
+    Each alert type may be sampled (keep one in sample[type]) and is limited
+    to limits.get(type, max_per_second) records a second; what is left out
+    is counted in suppressed.  alert.message(), the expensive part, is only
+    taken for the alerts that are kept, and records become dicts or lines
+    when read.  Records are also handed to writer, if any.
+    """
+    def __init__(self, infohash_of, capacity=10000, max_per_second=50,
+            sample=None, limits=None, writer=None):
+        self._infohash_of = infohash_of
+        self._records = collections.deque(maxlen=capacity)
+        self.max_per_second = max_per_second
+        self.sample = dict(sample or ())
+        self.limits = dict(limits or ())
+        self.writer = writer
+        self._seen = collections.defaultdict(int)
+        self._windows = dict() # type -> [second, records in that second]
+        self.suppressed = collections.defaultdict(int)
+
+    def __len__(self):
+        return len(self._records)
+
+    def record(self, alert):
+        """
+        returns whether the alert was kept.
+        """
+        kind = type(alert).__name__
+        self._seen[kind] += 1
+        every = self.sample.get(kind, 1)
+        if every > 1 and self._seen[kind] % every:
+            self.suppressed[kind] += 1
+            return False
+        now = time.time()
+        window = self._windows.get(kind)
+        if window is None or window[0] != int(now):
+            window = self._windows[kind] = [int(now), 0]
+        limit = self.limits.get(kind, self.max_per_second)
+        if limit is not None and window[1] >= limit:
+            self.suppressed[kind] += 1
+            return False
+        window[1] += 1
+        infohash = None
+        if isinstance(alert, libtorrent.torrent_alert):
+            try:
+                infohash = self._infohash_of(alert)
+            except RuntimeError:
+                pass
+        record = (now, kind, infohash, alert.message())
+        self._records.append(record)
+        if self.writer is not None:
+            self.writer.put(record)
+        return True
+
+    def _select(self, infohash=None, since=None, until=None, types=None, limit=100):
+        selected = list()
+        for record in reversed(self._records):
+            if since is not None and record[0] < since:
+                break
+            if until is not None and record[0] > until:
+                continue
+            if infohash is not None and record[2] != infohash:
+                continue
+            if types is not None and record[1] not in types:
+                continue
+            selected.append(record)
+            if limit is not None and len(selected) >= limit:
+                break
+        selected.reverse()
+        return selected
+
+    def query(self, infohash=None, since=None, until=None, types=None, limit=100):
+        """
+        returns the newest limit matching records, oldest first, as dicts.
+        """
+        return map(format_record, self._select(infohash, since, until, types, limit))
+
+    def tail(self, count=20, infohash=None, types=None):
+        """
+        returns the last count records as lines, for the manhole.
+        """
+        return map(format_line, self._select(infohash, types=types, limit=count))
+
+    def stats(self):
+        return {
+                'records': len(self._records),
+                'seen': dict(self._seen),
+                'suppressed': dict(self.suppressed),
+                'written': self.writer.written if self.writer is not None else 0,
+            }
+
+
+class JournalWriter(object):
+    """
+    Appends journal records to path as JSON lines from a worker thread,
+    once every interval seconds.  path is rotated to path.1 .. path.backups
+    when it grows past max_bytes.  If records come in faster than they are
+    written, more than max_pending of them are dropped and counted.
+    """
+    def __init__(self, path, max_bytes=64 << 20, backups=3, interval=1.0,
+            max_pending=100000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = list()
+        self._writing = None
+        self._loop = task.LoopingCall(self.flush)
+        self.written = 0
+        self.dropped = 0
+
+    def put(self, record):
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append(record)
+
+    def start(self):
+        self._loop.start(self.interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+        if self._writing is not None:
+            return self._writing.addCallback(lambda _: self.flush())
+        return self.flush()
+
+    def _rotate(self):
+        for i in xrange(self.backups - 1, 0, -1):
+            try:
+                os.rename('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        os.rename(self.path, self.path + '.1')
+
+    def _write(self, records):
+        lines = ''.join(json.dumps(format_record(r)) + '\n' for r in records)
+        with open(self.path, 'ab') as f:
+            f.write(lines)
+            size = f.tell()
+        if size > self.max_bytes:
+            self._rotate()
+        return len(records)
+
+    def flush(self):
+        """
+        returns a Deferred fired once the pending records are written.
+        """
+        if self._writing is not None:
+            return self._writing
+        if not self._pending:
+            return defer.succeed(0)
+        records, self._pending = self._pending, list()
+        def done(count):
+            self._writing = None
+            self.written += count
+            return count
+        def failed(reason):
+            self._writing = None
+            self.dropped += len(records)
+            logger.error("failed to write alert journal: %s" % reason.getErrorMessage())
+            return 0
+        self._writing = threads.deferToThread(self._write, records)
+        self._writing.addCallbacks(done, failed)
+        return self._writing
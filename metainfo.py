@@ -0,0 +1,57 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+from rarity.utils import serialize_metainfo
+
+
+class MetainfoStore(object):
+    """
+    Serialized metainfo per infohash.  A torrent's metainfo never changes
+    once its metadata is known, so each entry is built exactly once and only
+    dropped when the torrent is removed.  With detailed=True entries also
+    carry the file list, total size and piece length.
+    """
+    def __init__(self, detailed=False):
+        self.detailed = detailed
+        self._entries = dict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, infohash):
+        return infohash in self._entries
+
+    def __getitem__(self, infohash):
+        return self._entries[infohash]
+
+    def get(self, infohash, default=None):
+        return self._entries.get(infohash, default)
+
+    def add(self, infohash, torrent_info):
+        entry = self._entries.get(infohash)
+        if entry is None:
+            entry = self._entries[infohash] = serialize_metainfo(
+                    torrent_info, self.detailed)
+        return entry
+
+    def remove(self, infohash):
+        self._entries.pop(infohash, None)
+
+    def snapshot(self):
+        return dict(self._entries)
@@ -0,0 +1,288 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import time
+import bisect
+import collections
+
+from twisted.internet import reactor
+from twisted.web import resource
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+        0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+SIZE_BUCKETS = tuple(4 ** i for i in xrange(3, 13)) # 64 bytes to 16M
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+def format_value(value):
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\')
+        .replace('"', r'\"').replace('\n', r'\n')) for name, value in pairs)
+
+
+class Counter(object):
+    """
+    A monotonically increasing count, optionally split by one label.  The
+    registry samples it every tick so snapshot() can report a per-second
+    rate over the last window ticks.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, doc, label=None, window=60):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.values = collections.defaultdict(int) # label value -> count
+        self._samples = collections.deque(maxlen=window)
+
+    def inc(self, amount=1, key=None):
+        self.values[key] += amount
+
+    def sample(self, now):
+        self._samples.append((now, dict(self.values)))
+
+    def rates(self):
+        if len(self._samples) < 2:
+            return dict()
+        then, old = self._samples[0]
+        now, new = self._samples[-1]
+        elapsed = now - then
+        return dict((key, (value - old.get(key, 0)) / elapsed)
+                for key, value in new.iteritems())
+
+    def snapshot(self):
+        rates = self.rates()
+        values = dict((key, {'total': value, 'rate': rates.get(key, 0.0)})
+                for key, value in self.values.iteritems())
+        if self.label is None:
+            return values.get(None, {'total': 0, 'rate': 0.0})
+        return values
+
+    def lines(self):
+        for key, value in sorted(self.values.iteritems()):
+            labels = [(self.label, key)] if self.label is not None else []
+            yield self.name, labels, value
+
+
+class HistogramSeries(object):
+    __slots__ = ('counts', 'sum', 'count', 'max')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0
+        self.count = 0
+        self.max = 0
+
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets, optionally split by one label.
+    observe() is a bisect and four additions, cheap enough for hot paths.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets=LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = dict() # label value -> HistogramSeries
+
+    def observe(self, value, key=None):
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = HistogramSeries(len(self.buckets) + 1)
+        series.counts[bisect.bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
+        if value > series.max:
+            series.max = value
+
+    def _quantile(self, series, q):
+        rank = q * series.count
+        seen = 0
+        for bound, count in zip(self.buckets, series.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, series.max)
+        return series.max
+
+    def _summary(self, series):
+        return {
+                'count': series.count,
+                'sum': series.sum,
+                'mean': float(series.sum) / series.count if series.count else 0.0,
+                'max': series.max,
+                'p50': self._quantile(series, 0.5),
+                'p99': self._quantile(series, 0.99),
+            }
+
+    def snapshot(self):
+        if self.label is None:
+            series = self._series.get(None)
+            return self._summary(series or HistogramSeries(len(self.buckets) + 1))
+        return dict((key, self._summary(series))
+                for key, series in self._series.iteritems())
+
+    def lines(self):
+        for key, series in sorted(self._series.iteritems()):
+            labels = [(self.label, key)] if self.label is not None else []
+            seen = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), series.counts):
+                seen += count
+                yield self.name + '_bucket', labels + [('le', format_value(float(bound)))], seen
+            yield self.name + '_sum', labels, series.sum
+            yield self.name + '_count', labels, series.count
+
+
+class Gauge(object):
+    """
+    A value read when the metrics are: func returns a number, or a dict of
+    label value -> number if label is given.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, doc, func, label=None):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self._func = func
+
+    def snapshot(self):
+        return self._func()
+
+    def lines(self):
+        value = self._func()
+        if self.label is None:
+            yield self.name, [], value
+            return
+        for key, v in sorted(value.iteritems()):
+            yield self.name, [(self.label, key)], v
+
+
+class MetricsRegistry(object):
+    """
+    Named counters, histograms and gauges for one process.
+
+    Once started, a tick every interval seconds samples the counters for
+    rates and records how late the reactor ran it, so a blocked reactor
+    shows up in reactor_lag_seconds.  snapshot() returns plain dicts for PB
+    and the manhole; render() returns the Prometheus text format.
+    """
+    def __init__(self, prefix='rarity', interval=1.0, clock=reactor):
+        self.prefix = prefix
+        self.interval = interval
+        self._clock = clock
+        self._metrics = collections.OrderedDict()
+        self._call = None
+        self._expected = None
+        self.reactor_lag = self.histogram('reactor_lag_seconds',
+                "How late the reactor ran a timed call.")
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def __iter__(self):
+        return iter(self._metrics)
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, label=None):
+        return self._register(Counter(name, doc, label))
+
+    def histogram(self, name, doc, buckets=LATENCY_BUCKETS, label=None):
+        return self._register(Histogram(name, doc, buckets, label))
+
+    def gauge(self, name, doc, func, label=None):
+        return self._register(Gauge(name, doc, func, label))
+
+    def start(self):
+        if self._call is None:
+            self._schedule()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        self._expected = self._clock.seconds() + self.interval
+        self._call = self._clock.callLater(self.interval, self._tick)
+
+    def _tick(self):
+        now = self._clock.seconds()
+        self.reactor_lag.observe(max(0.0, now - self._expected))
+        for metric in self._metrics.itervalues():
+            if metric.kind == 'counter':
+                metric.sample(now)
+        self._schedule()
+
+    def snapshot(self):
+        snapshot = dict()
+        for name, metric in self._metrics.iteritems():
+            try:
+                snapshot[name] = metric.snapshot()
+            except Exception as e:
+                snapshot[name] = {'error': str(e)}
+        snapshot['time'] = time.time()
+        return snapshot
+
+    def render(self):
+        out = list()
+        for metric in self._metrics.itervalues():
+            name = '%s_%s' % (self.prefix, metric.name)
+            out.append('# HELP %s %s' % (name, metric.doc))
+            out.append('# TYPE %s %s' % (name, metric.kind))
+            try:
+                for suffix, labels, value in metric.lines():
+                    out.append('%s_%s%s %s' % (self.prefix, suffix,
+                        format_labels(labels), format_value(value)))
+            except Exception:
+                continue
+        out.append('')
+        return '\n'.join(out)
+
+
+class MetricsResource(resource.Resource):
+    """
+    Serves a MetricsRegistry in the Prometheus text format.
+    """
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self._registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self._registry.render()
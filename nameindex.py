@@ -0,0 +1,196 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import re
+import bisect
+import sre_parse
+import sre_constants
+import collections
+
+GRAM = 3
+
+def ngrams(text, n=GRAM):
+    return set(text[i:i+n] for i in xrange(len(text) - n + 1))
+
+def required_literals(pattern):
+    """
+    returns the runs of literal text every match of pattern must contain,
+    lowercased.  only the top-level sequence is inspected, so alternations
+    and groups contribute nothing; that is conservative, not wrong.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, OverflowError):
+        return []
+    runs, current = list(), list()
+    for op, arg in parsed:
+        if op is sre_constants.LITERAL:
+            current.append(unichr(arg) if arg > 0xff else chr(arg))
+            continue
+        if current:
+            runs.append(''.join(current).lower())
+            current = list()
+    if current:
+        runs.append(''.join(current).lower())
+    return runs
+
+
+class PatternCache(object):
+    """
+    LRU cache of compiled patterns and the literals they require.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self._cache = collections.OrderedDict()
+
+    def __getitem__(self, pattern):
+        try:
+            entry = self._cache.pop(pattern)
+        except KeyError:
+            entry = (re.compile(pattern), required_literals(pattern))
+            if len(self._cache) >= self.size:
+                self._cache.popitem(last=False)
+        self._cache[pattern] = entry
+        return entry
+
+
+class TorrentNameIndex(object):
+    """
+    In-memory infohash -> (name, handle) table with a trigram index over the
+    lowercased names.  Queries narrow the candidates with the trigrams of the
+    pattern's required literals and only run the regex over those.
+    """
+    def __init__(self, pattern_cache=None):
+        self._names = dict() # infohash -> name
+        self._handles = dict() # infohash -> torrent_handle
+        self._grams = collections.defaultdict(set) # trigram -> set(infohash)
+        self._patterns = pattern_cache or PatternCache()
+        self._ordered = None # sorted infohashes, until the next add or remove
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, infohash):
+        return infohash in self._names
+
+    def __iter__(self):
+        return self._names.iterkeys()
+
+    def add(self, infohash, name, handle=None):
+        if self._names.get(infohash) != name:
+            if infohash not in self._names:
+                self._ordered = None
+            self._unindex(infohash)
+            self._names[infohash] = name
+            for gram in ngrams(name.lower()):
+                self._grams[gram].add(infohash)
+        if handle is not None:
+            self._handles[infohash] = handle
+
+    def remove(self, infohash):
+        if infohash in self._names:
+            self._ordered = None
+        self._unindex(infohash)
+        self._names.pop(infohash, None)
+        self._handles.pop(infohash, None)
+
+    def _unindex(self, infohash):
+        name = self._names.get(infohash)
+        if name is None:
+            return
+        for gram in ngrams(name.lower()):
+            postings = self._grams.get(gram)
+            if postings is None:
+                continue
+            postings.discard(infohash)
+            if not postings:
+                del self._grams[gram]
+
+    def rebuild(self, handles):
+        self._names.clear()
+        self._handles.clear()
+        self._grams.clear()
+        self._ordered = None
+        for handle in handles:
+            self.add(str(handle.info_hash()), handle.name(), handle)
+
+    def name(self, infohash):
+        return self._names[infohash]
+
+    def compile(self, regexp):
+        return self._patterns[regexp][0]
+
+    def handle(self, infohash):
+        return self._handles.get(infohash)
+
+    def _candidates(self, literals):
+        grams = set()
+        for literal in literals:
+            grams.update(ngrams(literal))
+        if not grams:
+            return None
+        postings = sorted((self._grams.get(g, ()) for g in grams), key=len)
+        if not postings[0]:
+            return ()
+        candidates = set(postings[0])
+        for p in postings[1:]:
+            candidates.intersection_update(p)
+            if not candidates:
+                break
+        return candidates
+
+    def search(self, regexp):
+        """
+        returns the infohashes whose names match regexp (re.match semantics).
+        """
+        compiled, literals = self._patterns[regexp]
+        names = self._names
+        candidates = self._candidates(literals)
+        if candidates is None:
+            candidates = names.iterkeys()
+        return [ih for ih in candidates if compiled.match(names[ih])]
+
+    def ordered(self):
+        """
+        every infohash, sorted.
+        """
+        if self._ordered is None:
+            self._ordered = sorted(self._names)
+        return self._ordered
+
+    def iter_search(self, regexp=None, after=None):
+        """
+        yields the infohashes whose names match regexp, or every one, in
+        infohash order and starting past after.  matching is done as the
+        generator is consumed; torrents added meanwhile may be missed.
+        """
+        compiled, candidates = None, None
+        if regexp is not None:
+            compiled, literals = self._patterns[regexp]
+            candidates = self._candidates(literals)
+        if candidates is None:
+            candidates = self.ordered()
+        else:
+            candidates = sorted(candidates)
+        start = bisect.bisect_right(candidates, after) if after is not None else 0
+        for i in xrange(start, len(candidates)):
+            infohash = candidates[i]
+            name = self._names.get(infohash)
+            if name is not None and (compiled is None or compiled.match(name)):
+                yield infohash
@@ -0,0 +1,118 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Starts one Session with its DHT, journal and restore.  Run as a module it
+is a shard worker serving ClientRemote on localhost for a ShardRouter:
+
+    python -m rarity.node <state dir> <first listen port> <listen ports> <pb port> [volume ...]
+
+A worker only starts serving PB once its stored torrents are restored, so
+the router's first listing of it is complete.  It shuts down cleanly once
+its stdin is closed, which is how the router stops it and how it notices
+the router has gone away.
+"""
+import os
+import sys
+import errno
+import logging
+
+from twisted.internet import reactor, protocol, stdio
+from twisted.spread import pb
+
+from rarity.session import Session
+from rarity.dht import DHTStatePersister
+from rarity.journal import JournalWriter
+from rarity.remote import ClientRemote
+from rarity.storage import parse_volumes
+
+logger = logging.getLogger('ClientCore')
+
+def restore_session(session):
+    """
+    restores a Session's stored torrents.  returns a Deferred fired with
+    restore_progress() once every one is added.
+    """
+    def log_restore(progress):
+        logger.info("restored %(added)d of %(total)d torrents in %(seconds).1fs" % progress)
+        return progress
+    return session.restore().addCallback(log_restore)
+
+def start_session(state_dir=None, listen_port=23866, listen_ports=1,
+        country_db='/home/sell/dev/rarity/GeoIP.dat', volumes=None, restore=True):
+    """
+    returns a started Session, restoring its stored torrents unless restore
+    is false.  the session saves its resume data when the reactor shuts
+    down.
+    """
+    if state_dir is not None:
+        try:
+            os.makedirs(state_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    session = Session(state_dir, parse_volumes(volumes) if volumes else None)
+    session._ses.listen_on(listen_port, listen_port + listen_ports - 1)
+    session._ses.add_dht_router('router.bittorrent.com', 6881)
+    session._ses.load_country_db(country_db)
+    session._ses.start_lsd()
+
+    session._journal.writer = JournalWriter(session.state_path('rarity-alerts.jsonl'))
+    session._journal.writer.start()
+
+    dht_persister = DHTStatePersister(session._ses, session.state_path('dht-info.b'))
+    dht_state = dht_persister.load()
+    if dht_state is not None and 'nodes' in dht_state:
+        session._ses.start_dht(dht_state)
+        logger.info("started DHT with %d nodes" % len(dht_state['nodes']))
+    else:
+        session._ses.start_dht({})
+        logger.info("started DHT without any nodes.")
+    dht_persister.start()
+
+    if restore:
+        restore_session(session)
+
+    reactor.addSystemEventTrigger('before', 'shutdown', session.stop_session)
+    return session
+
+
+class StopOnClose(protocol.Protocol):
+    def connectionLost(self, reason):
+        if reactor.running:
+            reactor.stop()
+
+
+def main(argv):
+    state_dir, listen_port, listen_ports, pb_port = argv[:4]
+    session = start_session(state_dir, int(listen_port), int(listen_ports),
+            volumes=argv[4:], restore=False)
+    def serve(_):
+        # the router learns placement by listing us once connected, so
+        # only let it connect once every stored torrent is back
+        reactor.listenTCP(int(pb_port), pb.PBServerFactory(ClientRemote(session)),
+                interface='127.0.0.1')
+    def failed(reason):
+        logger.error("restore failed: %s" % reason.getErrorMessage())
+    restore_session(session).addErrback(failed).addCallback(serve)
+    stdio.StandardIO(StopOnClose())
+    reactor.run()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
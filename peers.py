@@ -0,0 +1,318 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import time
+import array
+import logging
+import collections
+
+from twisted.internet import task
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger('ClientCore')
+
+GROUP_FIELDS = ('peers', 'down', 'up', 'slow')
+NUMPY_MIN_PEERS = 64 # below this, summing in Python beats setting up numpy
+UNKNOWN = '--'
+NOT_PAUSED = {'paused': False} # status of torrents the cache has not seen yet
+
+def peer_country(peer):
+    country = getattr(peer, 'country', '') or ''
+    return country.upper() if country.isalnum() else UNKNOWN
+
+def client_family(client):
+    """
+    "uTorrent 3.2.3" -> "uTorrent": drops the trailing version words.
+    """
+    words = (client or '').split()
+    while len(words) > 1 and words[-1][:1].isdigit():
+        words.pop()
+    return ' '.join(words) or UNKNOWN
+
+
+class StringTable(object):
+    """
+    Interns strings as small integers, so columns hold indexes.
+    """
+    def __init__(self):
+        self.strings = list()
+        self._index = dict()
+
+    def index(self, string):
+        i = self._index.get(string)
+        if i is None:
+            i = self._index[string] = len(self.strings)
+            self.strings.append(string)
+        return i
+
+
+def group_sums(groups, columns):
+    """
+    groups is an array of group indexes, one per peer, and columns arrays
+    of the same length.  returns {group: [peers, sum of each column]}.
+    """
+    sums = dict()
+    if numpy is not None and len(groups) >= NUMPY_MIN_PEERS:
+        index = numpy.frombuffer(groups, dtype=groups.typecode)
+        counts = numpy.bincount(index)
+        totals = [numpy.bincount(index, weights=numpy.frombuffer(c, dtype=c.typecode))
+                for c in columns]
+        for group in numpy.flatnonzero(counts):
+            sums[int(group)] = [int(counts[group])] + [t[group] for t in totals]
+        return sums
+    for row, group in enumerate(groups):
+        entry = sums.get(group)
+        if entry is None:
+            entry = sums[group] = [0] + [0] * len(columns)
+        entry[0] += 1
+        for i, column in enumerate(columns):
+            entry[i + 1] += column[row]
+    return sums
+
+
+class TorrentPeers(object):
+    """
+    One torrent's last peer list sample as array columns, with its sums
+    per country and per client worked out once when sampled.  A peer is
+    slow once its combined rate stays under slow_rate for two samples in
+    a row.
+    """
+    def __init__(self, peers, countries, clients, slow_rate, previous=None):
+        self.sampled_at = time.time()
+        self.down = array.array('d')
+        self.up = array.array('d')
+        self.country = array.array('H')
+        self.client = array.array('H')
+        self.slow = array.array('d')
+        self.under = set() # hashes of the peers under slow_rate
+        was_under = previous.under if previous is not None else frozenset()
+        for peer in peers:
+            down, up = peer.down_speed, peer.up_speed
+            self.down.append(down)
+            self.up.append(up)
+            self.country.append(countries.index(peer_country(peer)))
+            self.client.append(clients.index(client_family(peer.client)))
+            key = hash(peer.ip)
+            if down + up < slow_rate:
+                self.under.add(key)
+                self.slow.append(1 if key in was_under else 0)
+            else:
+                self.slow.append(0)
+        rates = (self.down, self.up, self.slow)
+        self.by_country = group_sums(self.country, rates)
+        self.by_client = group_sums(self.client, rates)
+        self.totals = [len(self.down), sum(self.down), sum(self.up), sum(self.slow)]
+
+    def __len__(self):
+        return len(self.down)
+
+
+class GroupTotals(object):
+    """
+    peers, down, up and slow summed per group index, one array each, kept
+    up to date by adding new samples and subtracting the ones they replace.
+    """
+    def __init__(self, names):
+        self.names = names # StringTable
+        self.columns = [array.array('d') for _ in GROUP_FIELDS]
+
+    def add(self, sums, sign=1):
+        for group, values in sums.iteritems():
+            for column, value in zip(self.columns, values):
+                if group >= len(column):
+                    column.extend([0.0] * (group + 1 - len(column)))
+                column[group] += sign * value
+
+    def rows(self, count=None):
+        """
+        [(name, peers, down, up, slow)] with peers, most peers first.
+        """
+        peers = self.columns[0]
+        rows = [(self.names.strings[g], ) + tuple(int(c[g]) for c in self.columns)
+                for g in xrange(len(peers)) if peers[g] > 0]
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows[:count] if count is not None else rows
+
+
+class PeerSampler(object):
+    """
+    Samples the peer lists of a Session's running torrents, a few per
+    reactor tick, and keeps them as array columns.
+
+    Every interval up to per_tick torrents are sampled, round robin over
+    those the status cache does not show paused, or fewer if max_seconds run out
+    first.  Sums per country and per client across all torrents are
+    updated with each sample rather than recomputed, so summaries cost no
+    more than sorting the groups.  Samples are kept oldest first, and every
+    tick drops those older than max_age.
+    """
+    def __init__(self, session, per_tick=20, max_seconds=0.01, interval=1.0,
+            slow_rate=1024, max_age=300):
+        self._session = session
+        self.per_tick = per_tick
+        self.max_seconds = max_seconds
+        self.interval = interval
+        self.slow_rate = slow_rate
+        self.max_age = max_age
+        self._loop = task.LoopingCall(self._tick)
+        self._pending = collections.deque()
+        self._countries = StringTable()
+        self._clients = StringTable()
+        self.countries = GroupTotals(self._countries)
+        self.clients = GroupTotals(self._clients)
+        self.torrents = collections.OrderedDict() # infohash -> TorrentPeers, oldest first
+        self.totals = [0] * len(GROUP_FIELDS)
+        self.samples = 0
+        self.failures = 0
+
+    def start(self):
+        if not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def _replace(self, infohash, sample):
+        old = self.torrents.pop(infohash, None)
+        for entry, sign in ((old, -1), (sample, 1)):
+            if entry is None:
+                continue
+            self.countries.add(entry.by_country, sign)
+            self.clients.add(entry.by_client, sign)
+            self.totals = [t + sign * v for t, v in zip(self.totals, entry.totals)]
+        if sample is not None:
+            self.torrents[infohash] = sample
+
+    def discard(self, infohash):
+        self._replace(infohash, None)
+
+    def sample(self, infohash):
+        """
+        reads one torrent's peer list.  paused and unknown torrents lose
+        their sample.
+        """
+        status = self._session._status_cache.get(infohash)
+        handle = self._session._find_handle(infohash)
+        if (status is not None and status['paused']) or not handle.is_valid():
+            self.discard(infohash)
+            return
+        sample = TorrentPeers(handle.get_peer_info(), self._countries,
+                self._clients, self.slow_rate, self.torrents.get(infohash))
+        self._replace(infohash, sample)
+        self.samples += 1
+
+    def _tick(self):
+        started = time.time()
+        while self.torrents:
+            infohash, oldest = next(self.torrents.iteritems())
+            if started - oldest.sampled_at <= self.max_age:
+                break
+            self.discard(infohash)
+        if not self._pending:
+            cache = self._session._status_cache
+            self._pending.extend(ih for ih in self._session._name_index
+                    if not cache.get(ih, NOT_PAUSED)['paused'])
+        for _ in xrange(self.per_tick):
+            if not self._pending or time.time() - started > self.max_seconds:
+                break
+            infohash = self._pending.popleft()
+            try:
+                self.sample(infohash)
+            except Exception:
+                self.failures += 1
+                logger.exception("failed to sample peers of %s" % infohash)
+
+    def torrent_rows(self, count=None, key='peers'):
+        """
+        [(infohash, peers, down, up, slow)], largest key first.
+        """
+        column = GROUP_FIELDS.index(key) + 1
+        rows = [(ih, ) + tuple(int(v) for v in s.totals)
+                for ih, s in self.torrents.iteritems()]
+        rows.sort(key=lambda row: row[column], reverse=True)
+        return rows[:count] if count is not None else rows
+
+    def torrent_summary(self, infohash):
+        """
+        one torrent's totals and its peers by country and client.
+        """
+        sample = self.torrents[infohash]
+        def rows(sums, names):
+            rows = [(names.strings[g], ) + tuple(int(v) for v in values)
+                    for g, values in sums.iteritems()]
+            return sorted(rows, key=lambda row: row[1], reverse=True)
+        return {
+                'sampled_at': sample.sampled_at,
+                'totals': dict(zip(GROUP_FIELDS, (int(v) for v in sample.totals))),
+                'countries': rows(sample.by_country, self._countries),
+                'clients': rows(sample.by_client, self._clients),
+            }
+
+    def summary(self, count=20, torrent_count=None):
+        """
+        totals over every sampled torrent, and the count countries and
+        clients and torrent_count (default count) torrents with the most
+        peers; rows are (name, peers, down, up, slow).  count=None gives
+        every row.
+        """
+        if torrent_count is None:
+            torrent_count = count
+        totals = dict(zip(GROUP_FIELDS, (int(v) for v in self.totals)))
+        totals['torrents'] = len(self.torrents)
+        return {
+                'totals': totals,
+                'countries': self.countries.rows(count),
+                'clients': self.clients.rows(count),
+                'torrents': self.torrent_rows(torrent_count),
+                'samples': self.samples,
+                'failures': self.failures,
+            }
+
+
+def merge_summaries(summaries, count=20, torrent_count=None):
+    """
+    combines PeerSampler.summary()s of disjoint sets of torrents, e.g. one
+    per shard, as if one sampler had made it.
+    """
+    if torrent_count is None:
+        torrent_count = count
+    totals = collections.Counter()
+    merged = dict()
+    for key in ('countries', 'clients', 'torrents'):
+        groups = collections.OrderedDict()
+        for summary in summaries:
+            for row in summary[key]:
+                sums = groups.setdefault(row[0], [0] * len(GROUP_FIELDS))
+                for i, value in enumerate(row[1:]):
+                    sums[i] += value
+        rows = [(name, ) + tuple(values) for name, values in groups.iteritems()]
+        rows.sort(key=lambda row: row[1], reverse=True)
+        limit = torrent_count if key == 'torrents' else count
+        merged[key] = rows[:limit] if limit is not None else rows
+    for summary in summaries:
+        totals.update(summary['totals'])
+    merged['totals'] = dict(totals)
+    merged['samples'] = sum(s['samples'] for s in summaries)
+    merged['failures'] = sum(s['failures'] for s in summaries)
+    return merged
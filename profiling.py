@@ -0,0 +1,350 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import os
+import sys
+import time
+import thread
+import inspect
+import logging
+import tempfile
+import threading
+import traceback
+import collections
+
+from twisted.internet import reactor, defer, task
+
+logger = logging.getLogger('ClientCore')
+
+def collapse(frame):
+    """
+    the stack of frame, outermost first, as a collapsed-stack line for
+    flamegraph.pl: "file.py:function;file.py:function".
+    """
+    names = list()
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StallWatchdog(object):
+    """
+    Catches the reactor thread in the act when a turn runs long.
+
+    A heartbeat call runs on the reactor every interval; a watcher thread
+    checks it, and once it is more than threshold seconds late takes a
+    stack sample of the reactor thread, then another each further
+    threshold, up to max_stacks per stall.  When the heartbeat runs again
+    the stall's length is recorded.  The last max_stalls stalls are kept.
+    Nothing runs while the watchdog is stopped.
+    """
+    def __init__(self, threshold=0.1, interval=0.05, max_stalls=100,
+            max_stacks=10, metrics=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stalls = collections.deque(maxlen=max_stalls)
+        self._loop = task.LoopingCall(self._beat)
+        self._stopped = threading.Event()
+        self._thread = None
+        self._reactor_thread = None
+        self._last_beat = None
+        self._current = None # the stall being sampled, if any
+        self.count = 0
+        self._stall_times = None
+        if metrics is not None:
+            self._stall_times = metrics.histogram('reactor_stall_seconds',
+                    "Reactor turns longer than the watchdog threshold.")
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """
+        call from the reactor thread, e.g. in the manhole.
+        """
+        if self.running:
+            return
+        self._reactor_thread = thread.get_ident()
+        self._last_beat = time.time()
+        self._stopped.clear()
+        self._loop.start(self.interval, now=False)
+        self._thread = threading.Thread(target=self._watch, name='StallWatchdog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        if self._loop.running:
+            self._loop.stop()
+
+    def _beat(self):
+        now = time.time()
+        late = now - self._last_beat - self.interval
+        current = self._current
+        if late > self.threshold:
+            self.count += 1
+            if self._stall_times is not None:
+                self._stall_times.observe(late)
+            if current is not None and current['beat'] == self._last_beat:
+                current['seconds'] = late
+        self._current = None
+        self._last_beat = now
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval / 2):
+            beat = self._last_beat
+            late = time.time() - beat - self.interval
+            current = self._current
+            if current is None or current['beat'] != beat:
+                if late <= self.threshold:
+                    continue
+                current = {'beat': beat, 'seconds': None, 'stacks': list()}
+                self._current = current
+                self.stalls.append(current)
+            elif len(current['stacks']) >= min(self.max_stacks, late // self.threshold):
+                continue
+            frame = sys._current_frames().get(self._reactor_thread)
+            if frame is not None:
+                current['stacks'].append((late, traceback.extract_stack(frame)))
+            del frame
+
+    def report(self, count=5):
+        """
+        the last count stalls with their stack samples, for reading in the
+        manhole: print watchdog.report()
+        """
+        lines = list()
+        for stall in list(self.stalls)[-count:]:
+            seconds = stall['seconds']
+            lines.append("stall at %s, %s" % (
+                time.strftime('%H:%M:%S', time.localtime(stall['beat'])),
+                "%.3fs" % seconds if seconds is not None else "still running"))
+            for late, stack in stall['stacks']:
+                lines.append("  after %.3fs:" % late)
+                lines.extend('    ' + line.rstrip('\n').replace('\n', '\n    ')
+                        for line in traceback.format_list(stack))
+        return '\n'.join(lines)
+
+
+class SamplingProfiler(object):
+    """
+    Samples the reactor thread's stack (every thread's with all_threads)
+    from a separate thread every interval seconds for a while, and writes
+    the counts in the collapsed-stack format flamegraph.pl reads.  Nothing
+    runs between profiles.
+    """
+    def __init__(self, interval=0.005, all_threads=False):
+        self.interval = interval
+        self.all_threads = all_threads
+        self.counts = collections.Counter() # collapsed stack -> samples
+        self.samples = 0
+        self.path = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._deferred = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, duration=30, path=None):
+        """
+        call from the reactor thread.  returns a Deferred fired with the
+        path written once duration seconds have passed or stop() is called.
+        """
+        if self.running:
+            return defer.fail(RuntimeError("Already profiling into %s" % self.path))
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(),
+                    'rarity-%s.folded' % time.strftime('%Y%m%d-%H%M%S'))
+        self.path = path
+        self.counts = collections.Counter()
+        self.samples = 0
+        self._stopped.clear()
+        self._deferred = defer.Deferred()
+        self._thread = threading.Thread(target=self._run, name='SamplingProfiler',
+                args=(thread.get_ident(), time.time() + duration, path))
+        self._thread.daemon = True
+        self._thread.start()
+        return self._deferred
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self, target, deadline, path):
+        me = thread.get_ident()
+        while time.time() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == target or (self.all_threads and ident != me):
+                    self.counts[collapse(frame)] += 1
+            del frame
+            self.samples += 1
+            if self._stopped.wait(self.interval):
+                break
+        try:
+            with open(path, 'w') as f:
+                for stack, samples in self.counts.most_common():
+                    f.write('%s %d\n' % (stack, samples))
+        except IOError as e:
+            reactor.callFromThread(self._finished, e)
+        else:
+            reactor.callFromThread(self._finished, path)
+
+    def _finished(self, result):
+        self._thread.join()
+        self._thread = None
+        d, self._deferred = self._deferred, None
+        if isinstance(result, Exception):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def top(self, count=20):
+        """
+        the functions most often on top of the sampled stacks, as
+        (function, share of samples).
+        """
+        leaves = collections.Counter()
+        for stack, samples in self.counts.iteritems():
+            leaves[stack.rsplit(';', 1)[-1]] += samples
+        total = float(sum(leaves.itervalues())) or 1.0
+        return [(leaf, samples / total) for leaf, samples in leaves.most_common(count)]
+
+
+class CallStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.blocking = 0.0 # seconds spent in the call itself
+        self.blocking_max = 0.0
+        self.waits = 0 # calls that returned a Deferred
+        self.waiting = 0.0 # seconds until those Deferreds fired
+        self.waiting_max = 0.0
+
+    def returned(self, seconds):
+        self.calls += 1
+        self.blocking += seconds
+        self.blocking_max = max(self.blocking_max, seconds)
+
+    def fired(self, result, started):
+        seconds = time.time() - started
+        self.waits += 1
+        self.waiting += seconds
+        self.waiting_max = max(self.waiting_max, seconds)
+        return result
+
+    def as_dict(self):
+        return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'blocking': self.blocking,
+                'blocking_mean': self.blocking / self.calls if self.calls else 0.0,
+                'blocking_max': self.blocking_max,
+                'waits': self.waits,
+                'waiting_mean': self.waiting / self.waits if self.waits else 0.0,
+                'waiting_max': self.waiting_max,
+            }
+
+
+class CallTimers(object):
+    """
+    Times the methods of live objects, e.g. a Session or ClientRemote from
+    the manhole: timers.attach(session, ['torrent_state', 'find_torrents']).
+
+    Each method is shadowed by a timing wrapper set on the instance, so
+    detach() deleting the wrapper leaves nothing behind.  Time spent in the
+    call is counted as blocking; for calls returning a Deferred, the time
+    until it fires is counted as waiting.  References to the bound method
+    taken before attach(), such as callbacks already registered, are not
+    timed.
+    """
+    def __init__(self):
+        self.stats = dict() # 'Class.method' -> CallStats
+        self._attached = list() # (target, name)
+
+    def attach(self, target, names=None):
+        """
+        names defaults to every method of target's class.  returns the
+        names of the timers added.
+        """
+        cls = type(target)
+        if names is None:
+            names = [name for name, _ in inspect.getmembers(cls, inspect.ismethod)
+                    if not name.startswith('__')]
+        added = list()
+        for name in names:
+            if name in vars(target):
+                continue # already timed, or not a plain method
+            label = '%s.%s' % (cls.__name__, name)
+            stats = self.stats.setdefault(label, CallStats())
+            setattr(target, name, self._wrap(getattr(target, name), stats))
+            self._attached.append((target, name))
+            added.append(label)
+        return added
+
+    def _wrap(self, method, stats):
+        def timed(*args, **kwargs):
+            started = time.time()
+            try:
+                result = method(*args, **kwargs)
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                stats.returned(time.time() - started)
+            if isinstance(result, defer.Deferred):
+                result.addBoth(stats.fired, started)
+            return result
+        timed.__name__ = method.__name__
+        timed.__doc__ = method.__doc__
+        return timed
+
+    def detach(self, target=None):
+        """
+        removes the timers from target, or from everything.  the counts
+        are kept until reset().
+        """
+        kept = list()
+        for attached, name in self._attached:
+            if target is None or attached is target:
+                vars(attached).pop(name, None)
+            else:
+                kept.append((attached, name))
+        self._attached = kept
+
+    def reset(self):
+        for stats in self.stats.itervalues():
+            stats.__init__()
+
+    def report(self, key='blocking', count=20):
+        """
+        the count labels with the most key ('blocking', 'calls',
+        'blocking_max', 'waiting_max', ...), with their counts.
+        """
+        rows = [(label, stats.as_dict()) for label, stats in self.stats.iteritems()]
+        rows.sort(key=lambda row: row[1][key], reverse=True)
+        return rows[:count]
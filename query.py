@@ -0,0 +1,151 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import json
+import base64
+import binascii
+
+from twisted.spread import pb, util
+
+from rarity.columns import TorrentColumns
+
+MAX_PAGE_SIZE = 1000
+TOKEN_VERSION = 2
+
+def encode_token(query, fields, after):
+    """
+    a continuation token: everything needed to carry on a query past the
+    infohash after, so it survives reconnects and keeps no server state.
+    the query goes in as hex so its bytes come back as the same str.
+    """
+    if query is not None:
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        query = binascii.hexlify(query)
+    return base64.urlsafe_b64encode(json.dumps([TOKEN_VERSION, query, fields, after]))
+
+def decode_token(token):
+    """
+    returns (query, fields, after).  raises ValueError for bad tokens.
+    """
+    try:
+        version, query, fields, after = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError("Bad continuation token")
+    if version != TOKEN_VERSION:
+        raise ValueError("Continuation token version %r is not %d" % (version, TOKEN_VERSION))
+    if query is not None:
+        try:
+            query = binascii.unhexlify(query)
+        except (TypeError, UnicodeError, binascii.Error):
+            raise ValueError("Bad continuation token")
+    return query, fields, after
+
+
+class TorrentQuery(object):
+    """
+    Pages through the torrents matching query in infohash order, reading
+    their fields only as each page is built, so the first page costs the
+    same however many torrents match.
+
+    A page is {'torrents': [[infohash, fields]], 'token': token}, or with
+    encoded=True {'torrents': TorrentColumns.encode() string, 'token':
+    token}.  token is None on the last page; otherwise passing it back
+    resumes the query after that page, here or on a later connection.
+    """
+    def __init__(self, session, query=None, fields=None, page_size=100,
+            token=None, encoded=False):
+        after = None
+        if token is not None:
+            query, fields, after = decode_token(token)
+        self._session = session
+        self.query = query
+        self.fields = fields
+        self.page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        self.encoded = encoded
+        self._infohashes = session.iter_torrents(query, after)
+        self._next = None # read ahead to tell whether a page is the last
+        self.done = False
+        self.pages = 0
+
+    def _rows(self):
+        if self._next is not None:
+            yield self._next
+            self._next = None
+        for infohash in self._infohashes:
+            yield infohash
+
+    def next_page(self):
+        page = TorrentColumns(self.fields) if self.encoded else list()
+        wanted = frozenset(page.fields) if self.encoded else (
+                None if self.fields is None else frozenset(self.fields))
+        last, count = None, 0
+        rows = self._rows()
+        for infohash in rows:
+            if count == self.page_size:
+                self._next = infohash
+                break
+            try:
+                if self.encoded:
+                    page.append(infohash, *self._session._field_sources(infohash, wanted))
+                else:
+                    page.append([infohash, self._session.torrent_fields(infohash, self.fields)])
+            except (KeyError, ValueError):
+                continue # removed since the query started
+            last, count = infohash, count + 1
+        else:
+            self.done = True
+        self.pages += 1
+        token = None
+        if not self.done:
+            token = encode_token(self.query, self.fields, last)
+        return {
+                'torrents': page.encode() if self.encoded else page,
+                'token': token,
+            }
+
+
+class QueryCursor(pb.Referenceable):
+    """
+    A TorrentQuery handed to a PB caller, which pulls pages with
+    callRemote('next') until the page's token is None.
+    """
+    def __init__(self, query):
+        self._query = query
+
+    def remote_next(self):
+        if self._query.done:
+            return {'torrents': [], 'token': None}
+        return self._query.next_page()
+
+
+class QueryPager(util.Pager):
+    """
+    Pushes the pages of a TorrentQuery to a PB page collector, each one
+    as the broker's transport drains; see twisted.spread.util.getAllPages.
+    """
+    def __init__(self, collector, query, callback=None, *args, **kwargs):
+        self._query = query
+        util.Pager.__init__(self, collector, callback, *args, **kwargs)
+
+    def nextPage(self):
+        page = self._query.next_page()
+        if self._query.done:
+            self.stopPaging()
+        return page
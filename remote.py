@@ -0,0 +1,235 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import time
+import itertools
+
+from twisted.internet import defer
+from twisted.spread import pb, banana
+
+from rarity.metrics import SIZE_BUCKETS
+from rarity.utils import split_chunks
+from rarity.query import TorrentQuery, QueryCursor, QueryPager
+
+def alert_to_infohash(func):
+    def decorated(*args, **kwargs):
+        d = defer.Deferred()
+        def convert(item):
+            d.callback(str(item.handle.info_hash()))
+        tmp = func(*args, **kwargs)
+        tmp.addCallbacks(convert, d.errback)
+        return d
+    return decorated
+
+class TimedRoot(pb.Root):
+    """
+    A pb.Root recording the latency, errors and (sampled) answer size of
+    every remote_* call in a MetricsRegistry.
+    """
+    def __init__(self, metrics, payload_sample=10):
+        self._latency = metrics.histogram('remote_call_seconds',
+                "Time to answer a PB call, by method.", label='method')
+        self._payload = metrics.histogram('remote_response_bytes',
+                "Encoded size of sampled PB answers, by method.", SIZE_BUCKETS,
+                label='method')
+        self._errors = metrics.counter('remote_errors_total',
+                "PB calls that failed, by method.", label='method')
+        self._calls = itertools.count()
+        self.payload_sample = payload_sample
+
+    def remoteMessageReceived(self, broker, message, args, kw):
+        started = time.time()
+        sampled = next(self._calls) % self.payload_sample == 0
+        def answered(result):
+            self._latency.observe(time.time() - started, message)
+            if sampled:
+                self._payload.observe(len(banana.encode(result)), message)
+            return result
+        def failed(reason):
+            self._latency.observe(time.time() - started, message)
+            self._errors.inc(key=message)
+            return reason
+        try:
+            result = pb.Root.remoteMessageReceived(self, broker, message, args, kw)
+        except Exception:
+            failed(None)
+            raise
+        if isinstance(result, defer.Deferred):
+            return result.addCallbacks(answered, failed)
+        return answered(result)
+
+
+# View
+class ClientRemote(TimedRoot):
+    def __init__(self, session, payload_sample=10):
+        TimedRoot.__init__(self, session._metrics, payload_sample)
+        self.session = session
+
+    def remote_metrics(self):
+        return self.session.metrics()
+
+    def remote_alert_journal(self, infohash=None, since=None, until=None,
+            types=None, limit=100):
+        return self.session.journal(infohash, since, until, types, limit)
+
+    @alert_to_infohash
+    def remote_add_torrent(self, url):
+        return self.session.add_torrent(url)
+
+    @alert_to_infohash
+    def remote_add_torrent_data(self, torrent, resume=None):
+        """
+        torrent and resume are bencoded strings, each split into a list.
+        """
+        return self.session.add_torrent_data(''.join(torrent),
+                ''.join(resume) if resume else None)
+
+    def remote_export_torrent(self, infohash):
+        """
+        returns {'torrent': [string], 'resume': [string] or None}
+        """
+        def split(exported):
+            torrent, resume = exported
+            return {
+                    'torrent': split_chunks(torrent),
+                    'resume': split_chunks(resume) if resume else None,
+                }
+        return self.session.export_torrent(infohash).addCallback(split)
+
+    def remote_add_torrents(self, urls):
+        deferreds, aggregate = self.session.add_torrents(urls)
+        for d in deferreds:
+            d.addErrback(lambda _: None) # reported in the aggregate
+        return aggregate
+
+    @alert_to_infohash
+    def remote_pause_torrent(self, infohash):
+        return self.session.pause_torrent(infohash)
+
+    @alert_to_infohash
+    def remote_resume_torrent(self, infohash):
+        return self.session.resume_torrent(infohash)
+
+    @alert_to_infohash
+    def remote_remove_torrent(self, infohash, delete_files=False):
+        return self.session.remove_torrent(infohash, delete_files)
+
+    def remote_pause_torrents(self, infohashes=None, query=None, fields=None):
+        return self.session.batch('pause', infohashes, query, fields)
+
+    def remote_resume_torrents(self, infohashes=None, query=None, fields=None):
+        return self.session.batch('resume', infohashes, query, fields)
+
+    def remote_remove_torrents(self, infohashes=None, query=None, fields=None):
+        return self.session.batch('remove', infohashes, query, fields)
+
+    def remote_get_torrents(self, infohashes=None, query=None, fields=None):
+        return self.session.get_torrents(infohashes, query, fields)
+
+    def remote_get_torrent_columns(self, infohashes=None, query=None,
+            fields=None, encoded=True):
+        """
+        encoded answers are a list of strings; TorrentColumns.decode them
+        once joined.
+        """
+        columns = self.session.torrent_columns(infohashes, query, fields)
+        return columns.encode_chunks() if encoded else columns.to_dict()
+
+    def remote_subscribe(self, listener, infohashes=None, query=None,
+            max_rate=1.0, fields=None):
+        return self.session.subscribe(listener, infohashes, query, max_rate, fields)
+
+    def remote_unsubscribe(self, sid):
+        self.session.unsubscribe(sid)
+
+    def remote_get_torrent_info(self, infohash):
+        return self.session.torrent_status(infohash)
+
+    def remote_get_torrent_state_since(self, version):
+        return self.session.torrent_state_since(version)
+
+    def remote_get_torrent_metainfo(self, infohash):
+        return self.session.metainfo(infohash)
+
+    def remote_find_torrent(self, regexp):
+        return self.session.find_torrents(regexp)
+
+    def remote_query_page(self, query=None, fields=None, page_size=100,
+            token=None, encoded=False):
+        """
+        one page of matching torrents and the token for the next; pass the
+        token alone to resume.  see TorrentQuery.
+        """
+        return TorrentQuery(self.session, query, fields, page_size, token,
+                encoded).next_page()
+
+    def remote_open_query(self, query=None, fields=None, page_size=100,
+            token=None, encoded=False):
+        """
+        returns a QueryCursor; callRemote('next') on it for each page.
+        """
+        return QueryCursor(TorrentQuery(self.session, query, fields,
+            page_size, token, encoded))
+
+    def remote_page_torrents(self, collector, query=None, fields=None,
+            page_size=100, token=None, encoded=False):
+        """
+        pushes every page to collector's remote_gotPage, then calls its
+        remote_endedPaging.
+        """
+        QueryPager(collector, TorrentQuery(self.session, query, fields,
+            page_size, token, encoded))
+
+    def remote_restore_progress(self):
+        return self.session.restore_progress()
+
+    def remote_queue(self):
+        return self.session.queue()
+
+    def remote_set_queue_override(self, infohash, mode):
+        return self.session.set_queue_override(infohash, mode)
+
+    def remote_set_queue_limits(self, max_downloads=None, max_seeds=None):
+        return self.session.set_queue_limits(max_downloads, max_seeds)
+
+    def remote_storage(self):
+        return self.session.storage()
+
+    @alert_to_infohash
+    def remote_move_storage(self, infohash, path):
+        return self.session.move_storage(infohash, path)
+
+    def remote_streams(self):
+        return self.session.streams()
+
+    def remote_open_stream(self, infohash, file_index=0):
+        return self.session.open_stream(infohash, file_index).stats()
+
+    def remote_close_stream(self, infohash, file_index=0):
+        return self.session.close_stream(infohash, file_index)
+
+    def remote_peer_summary(self, count=20, torrent_count=None):
+        return self.session.peer_summary(count, torrent_count)
+
+    def remote_torrent_peers(self, infohash):
+        return self.session.torrent_peers(infohash)
+
+    def remote_get_torrent_name(self, infohash):
+        return self.session.metainfo(infohash)['name']
+
@@ -0,0 +1,208 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import time
+import logging
+
+import libtorrent
+from twisted.internet import defer, task, threads
+
+logger = logging.getLogger('ClientCore')
+
+class RestoreEntry(object):
+    def __init__(self, infohash, info, resume_data, resume):
+        self.infohash = infohash
+        self.info = info
+        self.resume_data = resume_data # raw bencoded, handed to libtorrent as is
+        resume = resume if isinstance(resume, dict) else dict()
+        self.paused = bool(resume.get('paused', 0))
+        self.save_path = resume.get('save_path')
+        self.progress = resume_progress(resume)
+
+    @property
+    def seeding(self):
+        return self.progress >= 1.0
+
+    def priority(self):
+        return (not self.seeding, -self.progress)
+
+def resume_progress(resume):
+    if resume.get('seed_mode'):
+        return 1.0
+    pieces = resume.get('pieces')
+    if not pieces:
+        return 0.0
+    return sum(ord(c) & 1 for c in pieces) / float(len(pieces))
+
+def parse_entries(chunk):
+    """
+    runs in a worker thread.  chunk is a list of (infohash, torrent, resume)
+    raw bencoded strings; returns the RestoreEntries and failed infohashes.
+    """
+    entries, failed = list(), list()
+    for infohash, torrent_raw, resume_raw in chunk:
+        try:
+            info = libtorrent.torrent_info(libtorrent.bdecode(torrent_raw))
+            resume = libtorrent.bdecode(resume_raw) if resume_raw else None
+        except (RuntimeError, TypeError) as e:
+            logger.warning("cannot restore %s: %s" % (infohash, e))
+            failed.append(infohash)
+            continue
+        entries.append(RestoreEntry(infohash, info, resume_raw, resume))
+    return entries, failed
+
+
+class SessionRestorer(object):
+    """
+    Re-adds every torrent found in a Session's torrent and resume storage.
+
+    Both stores are read in bulk off the reactor and parsed in chunks on the
+    reactor's thread pool.  Torrents are then added paused, add_batch per
+    reactor turn, and started in priority order -- seeds first, then by
+    progress -- at start_rate torrents per second, so the restart does not
+    open every connection and disk check at once.  Torrents that were paused
+    when saved stay paused.
+    """
+    def __init__(self, session, add_batch=200, parse_chunk=256, start_rate=50):
+        self._session = session
+        self.add_batch = add_batch
+        self.parse_chunk = parse_chunk
+        self.start_rate = start_rate
+        self._to_start = list()
+        self._start_loop = None
+        self.started_at = None
+        self.finished_at = None
+        self.total = 0
+        self.parsed = 0
+        self.added = 0
+        self.started = 0
+        self.failed = 0
+
+    def restore(self):
+        """
+        returns a Deferred fired with progress() once every torrent is added.
+        starting them continues afterwards at start_rate.
+        """
+        self.started_at = time.time()
+        d = defer.gatherResults([
+                self._session._torrent_storage.load_all(),
+                self._session._resume_storage.load_all(),
+            ])
+        d.addCallback(self._parse)
+        d.addCallback(self._add)
+        d.addCallback(lambda _: self.progress())
+        return d
+
+    def _parse(self, stores):
+        torrents, resumes = stores
+        known = self._session._name_index
+        work = [(ih, raw, resumes.get(ih)) for ih, raw in torrents.iteritems()
+                if ih not in known]
+        self.total = len(work)
+        chunks = [work[i:i + self.parse_chunk]
+                for i in xrange(0, len(work), self.parse_chunk)]
+        def parsed(result):
+            entries, failed = result
+            self.parsed += len(entries)
+            self.failed += len(failed)
+            return entries
+        return defer.gatherResults([
+            threads.deferToThread(parse_entries, chunk).addCallback(parsed)
+            for chunk in chunks])
+
+    def _add(self, parsed):
+        entries = [e for chunk in parsed for e in chunk]
+        entries.sort(key=RestoreEntry.priority)
+        def add_all():
+            for i, entry in enumerate(entries):
+                try:
+                    handle = self._session._add_parsed_torrent(entry.info,
+                            entry.save_path, entry.resume_data, paused=True)
+                except RuntimeError as e:
+                    logger.warning("cannot restore %s: %s" % (entry.infohash, e))
+                    self.failed += 1
+                    continue
+                self.added += 1
+                if not entry.paused and self._session._scheduler.admit(
+                        entry.infohash, entry.seeding):
+                    self._to_start.append(handle)
+                if (i + 1) % self.add_batch == 0:
+                    yield None
+        d = task.cooperate(add_all()).whenDone()
+        d.addCallback(lambda _: self._start_torrents())
+        return d
+
+    def restore_one(self, infohash):
+        """
+        returns a Deferred.  callback arg is the new torrent_handle
+        """
+        torrents = self._session._torrent_storage.backend
+        resumes = self._session._resume_storage.backend
+        def read():
+            resume_raw = resumes.read(infohash) if infohash in resumes else None
+            return parse_entries([(infohash, torrents.read(infohash), resume_raw)])
+        def add(result):
+            entries, _ = result
+            if not entries:
+                raise ValueError("Cannot parse stored torrent")
+            entry = entries[0]
+            scheduler = self._session._scheduler
+            admitted = not entry.paused and scheduler.admit(entry.infohash, entry.seeding)
+            try:
+                return self._session._add_parsed_torrent(entry.info,
+                        entry.save_path, entry.resume_data, not admitted)
+            except RuntimeError:
+                if not entry.paused:
+                    scheduler.discard(entry.infohash) # undo admit()
+                raise
+        return threads.deferToThread(read).addCallback(add)
+
+    def _start_torrents(self):
+        self._to_start.reverse() # pop() from the end keeps priority order
+        def start_some():
+            for _ in xrange(self.start_rate):
+                if not self._to_start:
+                    break
+                handle = self._to_start.pop()
+                try:
+                    if not handle.is_valid():
+                        raise RuntimeError("invalid torrent handle")
+                    handle.resume()
+                except RuntimeError as e:
+                    logger.info("not starting a restored torrent: %s" % e) # removed since
+                    continue
+                self.started += 1
+            if not self._to_start:
+                self.finished_at = time.time()
+                self._start_loop.stop()
+        self._start_loop = task.LoopingCall(start_some)
+        self._start_loop.start(1.0)
+
+    def progress(self):
+        end = self.finished_at or time.time()
+        return {
+                'total': self.total,
+                'parsed': self.parsed,
+                'added': self.added,
+                'started': self.started,
+                'pending_start': len(self._to_start),
+                'failed': self.failed,
+                'done': self.finished_at is not None,
+                'seconds': end - self.started_at if self.started_at else 0.0,
+            }
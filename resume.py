@@ -0,0 +1,364 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import os
+import struct
+import zlib
+import errno
+import logging
+import threading
+
+import libtorrent
+from twisted.internet import reactor, defer, threads
+from twisted.python import threadpool, failure
+
+logger = logging.getLogger('ClientCore')
+
+def write_atomically(path, data, sync=True):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+class DirectoryBackend(object):
+    """
+    One file per infohash, replaced atomically with write-to-temp + rename.
+    """
+    def __init__(self, basepath, sync=True):
+        self._basepath = basepath
+        self.sync = sync
+        try:
+            os.makedirs(basepath)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, infohash):
+        return os.path.join(self._basepath, str(infohash))
+
+    def __contains__(self, infohash):
+        return os.path.exists(self._path(infohash))
+
+    def keys(self):
+        return [name for name in os.listdir(self._basepath)
+                if not name.endswith('.tmp')]
+
+    def read(self, infohash):
+        try:
+            with open(self._path(infohash), 'rb') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(infohash)
+            raise
+
+    def read_all(self):
+        for infohash in self.keys():
+            try:
+                yield infohash, self.read(infohash)
+            except KeyError:
+                continue
+
+    def write(self, infohash, data):
+        write_atomically(self._path(infohash), data, self.sync)
+
+    def delete(self, infohash):
+        try:
+            os.unlink(self._path(infohash))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def close(self):
+        pass
+
+
+class LogBackend(object):
+    """
+    All resume data in one append-only file.
+
+    Each record is a header (hex infohash, payload length, crc32) followed by
+    the payload; a zero length marks a deletion.  An in-memory index maps
+    infohashes to the offset of their newest record.  On open the file is
+    scanned once and a torn or corrupt tail is cut off.  When dead records
+    outweigh live ones the file is rewritten with only live records and
+    renamed into place.
+    """
+    HEADER = struct.Struct('>40sII')
+
+    def __init__(self, path, sync=True, compact_ratio=1.0, compact_min=1 << 20):
+        self._path = path
+        self.sync = sync
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self._lock = threading.RLock()
+        self._index = dict() # infohash -> (offset, length)
+        self._live_bytes = 0
+        self._file = None
+        self._open()
+
+    def _open(self):
+        if not os.path.exists(self._path):
+            open(self._path, 'ab').close()
+        self._file = open(self._path, 'r+b')
+        self._index.clear()
+        self._live_bytes = 0
+        end = self._scan()
+        self._file.truncate(end)
+        self._file.seek(0, os.SEEK_END)
+
+    def _scan(self):
+        f = self._file
+        f.seek(0)
+        offset = 0
+        while True:
+            header = f.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                break
+            infohash, length, crc = self.HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                logger.warning("truncating resume log %s at %d" % (self._path, offset))
+                break
+            self._forget(infohash)
+            if length:
+                self._index[infohash] = (offset + self.HEADER.size, length)
+                self._live_bytes += self.HEADER.size + length
+            offset += self.HEADER.size + length
+        return offset
+
+    def _forget(self, infohash):
+        old = self._index.pop(infohash, None)
+        if old is not None:
+            self._live_bytes -= self.HEADER.size + old[1]
+
+    def _append(self, infohash, data):
+        f = self._file
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(self.HEADER.pack(infohash, len(data), zlib.crc32(data) & 0xffffffff))
+        f.write(data)
+        f.flush()
+        if self.sync:
+            os.fsync(f.fileno())
+        return offset + self.HEADER.size
+
+    def __contains__(self, infohash):
+        return str(infohash) in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def read(self, infohash):
+        with self._lock:
+            offset, length = self._index[str(infohash)]
+            self._file.seek(offset)
+            return self._file.read(length)
+
+    def read_all(self):
+        """
+        one sequential pass over the log, yielding the newest record of
+        every live infohash.
+        """
+        with self._lock:
+            records = sorted((offset, length, ih)
+                    for ih, (offset, length) in self._index.iteritems())
+            self._file.seek(0)
+            buf = self._file.read()
+        for offset, length, infohash in records:
+            yield infohash, buf[offset:offset + length]
+
+    def write(self, infohash, data):
+        infohash = str(infohash)
+        with self._lock:
+            offset = self._append(infohash, data)
+            self._forget(infohash)
+            self._index[infohash] = (offset, len(data))
+            self._live_bytes += self.HEADER.size + len(data)
+        self.maybe_compact()
+
+    def delete(self, infohash):
+        infohash = str(infohash)
+        with self._lock:
+            if infohash not in self._index:
+                return
+            self._append(infohash, '')
+            self._forget(infohash)
+        self.maybe_compact()
+
+    def dead_bytes(self):
+        with self._lock:
+            return os.fstat(self._file.fileno()).st_size - self._live_bytes
+
+    def maybe_compact(self):
+        dead = self.dead_bytes()
+        if dead > self.compact_min and dead > self.compact_ratio * self._live_bytes:
+            self.compact()
+
+    def compact(self):
+        with self._lock:
+            tmp = self._path + '.compact'
+            with open(tmp, 'wb') as out:
+                for infohash, data in self.read_all():
+                    out.write(self.HEADER.pack(infohash, len(data),
+                            zlib.crc32(data) & 0xffffffff))
+                    out.write(data)
+                out.flush()
+                os.fsync(out.fileno())
+            self._file.close()
+            os.rename(tmp, self._path)
+            self._open()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ResumeStorage(object):
+    """
+    Resume data keyed by infohash, written off the reactor thread.
+
+    Saves go to a small thread pool.  While a save for an infohash is in
+    flight further saves for it are coalesced: only the newest entry is
+    written next, and every caller's Deferred fires once it is on disk.
+    Reads through __getitem__ are synchronous and meant for startup.
+    """
+    def __init__(self, backend, max_threads=2):
+        if isinstance(backend, basestring):
+            backend = DirectoryBackend(backend)
+        self.backend = backend
+        self._pool = threadpool.ThreadPool(1, max_threads, 'ResumeStorage')
+        self._pool.start()
+        reactor.addSystemEventTrigger('after', 'shutdown', self._pool.stop)
+        self._pending = dict() # infohash -> newest entry not yet written
+        self._waiters = dict() # infohash -> [Deferred]
+        self._in_flight = dict() # infohash -> whether the write keeps data
+        self._idle_waiters = list()
+        self.writes = 0
+        self.coalesced = 0
+
+    def __setitem__(self, infohash, entry):
+        self.save(infohash, entry)
+
+    def __getitem__(self, infohash):
+        try:
+            return libtorrent.bdecode(self.backend.read(str(infohash)))
+        except KeyError:
+            raise KeyError(infohash)
+
+    def __delitem__(self, infohash):
+        self.save(infohash, None)
+
+    def __contains__(self, infohash):
+        infohash = str(infohash)
+        if infohash in self._pending:
+            return self._pending[infohash] is not None
+        if infohash in self._in_flight:
+            return self._in_flight[infohash]
+        return infohash in self.backend
+
+    def __iter__(self):
+        return iter(self.backend.keys())
+
+    def get_saver(self, infohash):
+        def saver(entry):
+            return self.save(infohash, entry)
+        return saver
+
+    def save(self, infohash, entry):
+        """
+        returns a Deferred fired once entry (or a newer one) is written.
+        an entry of None deletes the stored resume data.
+        """
+        infohash = str(infohash)
+        d = defer.Deferred()
+        if infohash in self._pending:
+            self.coalesced += 1
+        self._pending[infohash] = entry
+        self._waiters.setdefault(infohash, list()).append(d)
+        if infohash not in self._in_flight:
+            self._start(infohash)
+        return d
+
+    def _write(self, infohash, entry):
+        if entry is None:
+            self.backend.delete(infohash)
+        else:
+            self.backend.write(infohash, libtorrent.bencode(entry))
+
+    def _start(self, infohash):
+        entry = self._pending.pop(infohash)
+        waiters = self._waiters.pop(infohash)
+        self._in_flight[infohash] = entry is not None
+        d = threads.deferToThreadPool(reactor, self._pool, self._write, infohash, entry)
+        d.addBoth(self._finished, infohash, waiters)
+
+    def _finished(self, result, infohash, waiters):
+        del self._in_flight[infohash]
+        self.writes += 1
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(infohash)
+        if isinstance(result, failure.Failure):
+            logger.error("failed to save resume data for %s: %s" % (
+                infohash, result.getErrorMessage()))
+        if infohash in self._pending:
+            self._start(infohash)
+        elif not self._in_flight:
+            idle, self._idle_waiters = self._idle_waiters, list()
+            for d in idle:
+                d.callback(None)
+
+    def flush(self):
+        """
+        returns a Deferred fired when every save issued so far is written.
+        """
+        if not self._in_flight:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._idle_waiters.append(d)
+        return d
+
+    def load(self, infohash):
+        """
+        returns a Deferred.  callback arg is the decoded resume entry
+        """
+        return threads.deferToThreadPool(reactor, self._pool, self.__getitem__, infohash)
+
+    def load_all(self):
+        """
+        returns a Deferred.  callback arg is a dict of infohash -> raw
+        bencoded resume data, read in one pass where the backend allows.
+        """
+        return threads.deferToThreadPool(reactor, self._pool,
+                lambda: dict(self.backend.read_all()))
+
+    def stats(self):
+        return {
+                'pending': len(self._pending),
+                'in_flight': len(self._in_flight),
+                'writes': self.writes,
+                'coalesced': self.coalesced,
+            }
@@ -0,0 +1,265 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import time
+import logging
+import collections
+
+from twisted.internet import task
+
+logger = logging.getLogger('ClientCore')
+
+MODES = ('force', 'stop', None)
+KINDS = ('downloads', 'seeds')
+
+class QueueScheduler(object):
+    """
+    Keeps at most max_downloads downloading and max_seeds seeding torrents
+    running, and the rest paused in a queue.
+
+    Every interval seconds the running torrents' rates are read from the
+    status cache and smoothed.  A torrent that has run for stall_after
+    seconds without reaching stall_rate bytes a second gives its slot to a
+    queued one, and goes back in the queue remembering the rate it got.
+    Queued torrents are started never-tried first, then by the best rate
+    they had before, then oldest first.
+
+    The scheduler only touches torrents it admitted or queued itself, and
+    only those count against the limits: torrents already running when it
+    came along are left running, torrents paused by anyone else are left
+    alone, and a queued one resumed by anyone else is taken as forced.  An
+    override of 'force' keeps a torrent running outside the limits; 'stop'
+    keeps it paused.
+    """
+    def __init__(self, session, max_downloads=8, max_seeds=16, interval=15,
+            stall_after=300, stall_rate=2048, smoothing=0.3, history=500):
+        self._session = session
+        self.limits = {'downloads': max_downloads, 'seeds': max_seeds}
+        self.interval = interval
+        self.stall_after = stall_after
+        self.stall_rate = stall_rate
+        self.smoothing = smoothing
+        self.overrides = dict() # infohash -> 'force' | 'stop'
+        self.decisions = collections.deque(maxlen=history)
+        self._queued = collections.OrderedDict() # infohash -> time queued
+        self._started = dict() # infohash -> time started
+        self._rates = dict() # infohash -> smoothed rate while running
+        self._last_rate = dict() # infohash -> smoothed rate when last queued
+        self._active = dict((kind, set()) for kind in KINDS)
+        self._managed = set() # infohashes admitted or queued here
+        self._expected = dict() # infohash -> (paused, when) until the cache agrees
+        self._loop = task.LoopingCall(self._tick)
+
+    def start(self):
+        if not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def _decide(self, infohash, action, reason):
+        self.decisions.append((time.time(), infohash, action, reason))
+
+    def admit(self, infohash, seeding):
+        """
+        returns whether a torrent about to be added may start now; if not
+        it is queued and should be added paused.
+        """
+        kind = 'seeds' if seeding else 'downloads'
+        mode = self.overrides.get(infohash)
+        self._managed.add(infohash)
+        if mode == 'force' or (mode is None and len(self._active[kind]) < self.limits[kind]):
+            if mode is None:
+                self._active[kind].add(infohash)
+            self._started[infohash] = time.time()
+            return True
+        self._queued[infohash] = time.time()
+        self._decide(infohash, 'queue', 'stopped' if mode == 'stop' else 'no free slot')
+        return False
+
+    def discard(self, infohash):
+        self._queued.pop(infohash, None)
+        self._started.pop(infohash, None)
+        self._rates.pop(infohash, None)
+        self._last_rate.pop(infohash, None)
+        self.overrides.pop(infohash, None)
+        self._expected.pop(infohash, None)
+        self._managed.discard(infohash)
+        for active in self._active.itervalues():
+            active.discard(infohash)
+
+    def _pause(self, infohash, reason):
+        try:
+            handle = self._session._find_valid_handle(infohash)
+        except ValueError:
+            self.discard(infohash)
+            return
+        if hasattr(handle, 'auto_managed'):
+            handle.auto_managed(False)
+        handle.pause()
+        self._managed.add(infohash)
+        self._expected[infohash] = (True, time.time())
+        self._queued[infohash] = time.time()
+        self._started.pop(infohash, None)
+        self._last_rate[infohash] = self._rates.pop(infohash, 0.0)
+        for active in self._active.itervalues():
+            active.discard(infohash)
+        self._decide(infohash, 'pause', reason)
+
+    def _resume(self, infohash, kind, reason):
+        try:
+            handle = self._session._find_valid_handle(infohash)
+        except ValueError:
+            self.discard(infohash)
+            return
+        if hasattr(handle, 'auto_managed'):
+            handle.auto_managed(False)
+        handle.resume()
+        self._managed.add(infohash)
+        self._expected[infohash] = (False, time.time())
+        self._queued.pop(infohash, None)
+        self._started[infohash] = time.time()
+        if kind is not None:
+            self._active[kind].add(infohash)
+        self._decide(infohash, 'resume', reason)
+
+    def _smooth(self, infohash, rate):
+        previous = self._rates.get(infohash)
+        if previous is None:
+            self._rates[infohash] = float(rate)
+        else:
+            self._rates[infohash] = previous + self.smoothing * (rate - previous)
+        return self._rates[infohash]
+
+    def _paused(self, infohash, cached, now):
+        """
+        the status cache only learns of a pause or resume from its alert;
+        until then the scheduler trusts what it last did.
+        """
+        expected = self._expected.get(infohash)
+        if expected is None:
+            return cached
+        paused, when = expected
+        if paused == cached or now - when > self.interval:
+            del self._expected[infohash]
+            return cached
+        return paused
+
+    def _classify(self):
+        """
+        returns ({kind: [running infohash]}, {kind: [queued infohash]}).
+        """
+        now = time.time()
+        running = dict((kind, list()) for kind in KINDS)
+        waiting = dict((kind, list()) for kind in KINDS)
+        for infohash in list(self._session._name_index):
+            try:
+                status = self._session.torrent_status(infohash)
+            except (KeyError, ValueError):
+                continue
+            kind = 'seeds' if status['progress'] >= 1 else 'downloads'
+            paused = self._paused(infohash, status['paused'], now)
+            mode = self.overrides.get(infohash)
+            if mode == 'stop':
+                if not paused:
+                    self._pause(infohash, 'stopped')
+                continue
+            if mode == 'force':
+                if paused:
+                    self._resume(infohash, None, 'forced')
+                continue
+            if paused:
+                if infohash in self._queued:
+                    waiting[kind].append(infohash)
+                continue
+            if infohash not in self._managed:
+                continue # running before the scheduler knew of it
+            if infohash in self._queued:
+                del self._queued[infohash] # resumed by someone else
+                self.overrides[infohash] = 'force'
+                self._started[infohash] = now
+                self._decide(infohash, 'override', 'resumed elsewhere')
+                continue
+            self._started.setdefault(infohash, now)
+            rate = status['upload_rate'] if kind == 'seeds' else status['download_rate']
+            self._smooth(infohash, rate)
+            running[kind].append(infohash)
+        return running, waiting
+
+    def _queue_order(self, infohash):
+        tried = infohash in self._last_rate
+        return (tried, -self._last_rate.get(infohash, 0.0), self._queued.get(infohash, 0))
+
+    def _tick(self):
+        now = time.time()
+        running, waiting = self._classify()
+        for kind in KINDS:
+            limit = self.limits[kind]
+            active = sorted(running[kind], key=lambda ih: self._rates.get(ih, 0.0))
+            queue = sorted(waiting[kind], key=self._queue_order)
+            queue.reverse() # pop() from the end gives the best
+            self._active[kind] = set(active)
+            while len(active) > limit:
+                self._pause(active.pop(0), 'over limit')
+            for infohash in active:
+                if not queue:
+                    break
+                if (now - self._started.get(infohash, now) >= self.stall_after
+                        and self._rates.get(infohash, 0.0) < self.stall_rate):
+                    self._pause(infohash, 'stalled')
+                    self._resume(queue.pop(), kind, 'rotated in')
+            free = limit - len(self._active[kind])
+            while free > 0 and queue:
+                self._resume(queue.pop(), kind, 'free slot')
+                free -= 1
+
+    def set_override(self, infohash, mode):
+        if mode not in MODES:
+            raise ValueError("Unknown queue mode %r" % (mode, ))
+        self._managed.add(infohash)
+        if mode is None:
+            self.overrides.pop(infohash, None)
+            if infohash not in self._started:
+                self._queued.setdefault(infohash, time.time())
+        else:
+            self.overrides[infohash] = mode
+        self._decide(infohash, 'override', mode or 'auto')
+        self._tick()
+
+    def set_limits(self, max_downloads=None, max_seeds=None):
+        if max_downloads is not None:
+            self.limits['downloads'] = max_downloads
+        if max_seeds is not None:
+            self.limits['seeds'] = max_seeds
+        self._tick()
+
+    def state(self, decisions=50):
+        recent = list(self.decisions)[-decisions:] if decisions else []
+        return {
+                'limits': dict(self.limits),
+                'active': dict((kind, sorted(active))
+                    for kind, active in self._active.iteritems()),
+                'queued': sorted(self._queued, key=self._queue_order),
+                'overrides': dict(self.overrides),
+                'rates': dict(self._rates),
+                'decisions': [{'time': when, 'infohash': infohash,
+                    'action': action, 'reason': reason}
+                    for when, infohash, action, reason in recent],
+            }
@@ -17,20 +17,31 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
-import sys
-sys.path.append('/home/sell/dev/libsre/src')
-
-import libsre.python.functools as sre_ft
+import os
 import time
-import re
+import heapq
+import itertools
+import threading
 import operator
 import logging
-from twisted.internet import reactor, defer
-import twisted.web.client
-from twisted.python import failure
+from twisted.internet import reactor, defer, threads
 import libtorrent
-from rarity.utils import serialize_torrent_metainfo, \
-    serialize_torrent_status, serialize_torrent
+from rarity.utils import serialize_torrent_status, project, STATUS_FIELDS
+from rarity.nameindex import TorrentNameIndex
+from rarity.statuscache import StatusCache, status_infohash
+from rarity.metainfo import MetainfoStore
+from rarity.resume import ResumeStorage, DirectoryBackend
+from rarity.checkpoint import CheckpointScheduler
+from rarity.restore import SessionRestorer, RestoreEntry
+from rarity.ingest import TorrentFetcher, parse_torrent, tee
+from rarity.subscriptions import SubscriptionManager
+from rarity.metrics import MetricsRegistry, COUNT_BUCKETS
+from rarity.journal import AlertJournal
+from rarity.columns import TorrentColumns
+from rarity.scheduler import QueueScheduler
+from rarity.storage import StoragePlacer, Volume
+from rarity.stream import TorrentStream
+from rarity.peers import PeerSampler
 
 FORMAT = '%(asctime)-15s %(message)s'
 logging.basicConfig(format=FORMAT)
@@ -40,26 +51,6 @@ logger.setLevel(logging.INFO)
 class TimeoutError(RuntimeError):
     pass
 
-import os
-class ResumeStorage(object):
-    def __init__(self, basepath):
-        self._basepath = basepath
-
-    def __setitem__(self, infohash, entry):
-        return self.get_saver(infohash)(entry)
-
-    def get_saver(self, infohash):
-        def saver(entry):
-            ih = str(infohash)
-            with open(os.path.join(self._basepath, ih), 'w') as f:
-                f.write(libtorrent.bencode(entry))
-        return saver
-
-    def __getitem__(self, infohash):
-        infohash = str(infohash)
-        with open(os.path.join(self._basepath, infohash), 'r') as f:
-            return libtorrent.bdecode(f.read())
-
 class IStaticAlertHandler(object): pass # interface
 
 class AbstractAlertDeferred(object):
@@ -75,9 +66,318 @@ class AlertDeferred(AbstractAlertDeferred):
         super(AlertDeferred, self).__init__(match_func)
         self.created_at = time.time()
         self.expire_after = expire_after or 600
+        self.expires_at = self.created_at + self.expire_after
+        self.keys = ()
+        self.waiting = False
+
+    def is_expired(self, now=None):
+        return ((now or time.time()) - self.created_at) > self.expire_after
+
+def alert_piece(alert):
+    """
+    the piece index of piece alerts, which the bindings call piece or
+    piece_index depending on the alert.  None for other alerts.
+    """
+    piece = getattr(alert, 'piece', None)
+    if piece is None:
+        piece = getattr(alert, 'piece_index', None)
+    return piece
+
+class AlertDispatcher(object):
+    """
+    Holds the AlertDeferreds waiting on a Session.
+
+    Waiters registered against (alert class, infohash) keys, or (alert
+    class, infohash, piece) keys for piece alerts, are found with a dict
+    lookup per class in the alert's MRO, so dispatch cost does not grow
+    with the number of pending waiters.  Waiters with only a match function
+    are checked one by one, as before.  Expiry is driven off a heap and a
+    single reactor.callLater aimed at the earliest deadline.
+    """
+    def __init__(self, clock=reactor, wait_times=None):
+        self._clock = clock
+        self._wait_times = wait_times
+        self._indexed = dict() # (alert_cls, infohash) -> [AlertDeferred]
+        self._unindexed = list()
+        self._expiry_heap = list() # (expires_at, seq, AlertDeferred)
+        self._seq = itertools.count()
+        self._expiry_call = None
+        self._expiry_deadline = None
+        self._pending = 0
+        self.fired = 0
+        self.expired = 0
+
+    def __len__(self):
+        return self._pending
+
+    def waiting(self, alert_cls, infohash):
+        """
+        whether anything is waiting on an alert_cls alert for infohash.
+        """
+        return (alert_cls, infohash) in self._indexed
+
+    def add(self, ad, alert_classes=None, infohash=None, piece=None):
+        if alert_classes is not None:
+            if not isinstance(alert_classes, tuple):
+                alert_classes = (alert_classes, )
+            key = (infohash, ) if piece is None else (infohash, piece)
+            ad.keys = tuple(set((cls, ) + key for cls in alert_classes))
+            for key in ad.keys:
+                self._indexed.setdefault(key, list()).append(ad)
+        else:
+            self._unindexed.append(ad)
+        ad.waiting = True
+        self._pending += 1
+        heapq.heappush(self._expiry_heap, (ad.expires_at, next(self._seq), ad))
+        self._schedule_expiry()
+        return ad.deferred
+
+    def _discard(self, ad):
+        if not ad.waiting:
+            return False
+        ad.waiting = False
+        self._pending -= 1
+        if not ad.keys:
+            self._unindexed.remove(ad)
+            return True
+        for key in ad.keys:
+            waiters = self._indexed[key]
+            waiters.remove(ad)
+            if not waiters:
+                del self._indexed[key]
+        return True
+
+    def _candidates(self, alert):
+        matched = list()
+        if self._indexed and isinstance(alert, libtorrent.torrent_alert):
+            infohash = str(alert.handle.info_hash())
+            piece = alert_piece(alert)
+            for cls in type(alert).__mro__:
+                matched.extend(self._indexed.get((cls, infohash), ()))
+                if piece is not None:
+                    matched.extend(self._indexed.get((cls, infohash, piece), ()))
+        matched.extend(wd for wd in self._unindexed if wd.match(alert))
+        return matched
+
+    def dispatch(self, alert):
+        """
+        fires every waiter matching alert.  returns the number fired.
+        """
+        fired = 0
+        for wd in self._candidates(alert):
+            if not self._discard(wd):
+                continue # matched through more than one of its keys
+            if not wd.deferred.called:
+                if self._wait_times is not None:
+                    self._wait_times.observe(time.time() - wd.created_at)
+                wd.deferred.callback(alert)
+                fired += 1
+        self.fired += fired
+        return fired
+
+    def expire(self):
+        self._expiry_call = None
+        now = time.time()
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, _, wd = heapq.heappop(self._expiry_heap)
+            if not self._discard(wd) or wd.deferred.called:
+                continue
+            self.expired += 1
+            wd.deferred.errback(TimeoutError("The callback expired."))
+        if len(self._expiry_heap) > 2 * self._pending + 64:
+            self._compact_heap()
+        self._schedule_expiry()
+
+    def _compact_heap(self):
+        self._expiry_heap = [e for e in self._expiry_heap if e[2].waiting]
+        heapq.heapify(self._expiry_heap)
+
+    def _schedule_expiry(self):
+        deadline = self._expiry_heap[0][0] if self._expiry_heap else None
+        if self._expiry_call is not None and self._expiry_call.active():
+            if deadline is not None and self._expiry_deadline <= deadline:
+                return
+            self._expiry_call.cancel()
+        self._expiry_call = None
+        if deadline is not None:
+            self._expiry_deadline = deadline
+            self._expiry_call = self._clock.callLater(
+                    max(0, deadline - time.time()), self.expire)
 
-    def is_expired(self):
-        return (time.time() - self.created_at) > self.expire_after
+    def stats(self):
+        now = time.time()
+        waiters = list(self._unindexed)
+        by_class = dict()
+        seen = set()
+        for key, wds in self._indexed.iteritems():
+            cls = key[0]
+            for wd in wds:
+                if id(wd) in seen:
+                    continue
+                seen.add(id(wd))
+                waiters.append(wd)
+                by_class[cls.__name__] = by_class.get(cls.__name__, 0) + 1
+        ages = [now - wd.created_at for wd in waiters]
+        return {
+                'pending': self._pending,
+                'indexed_keys': len(self._indexed),
+                'unindexed': len(self._unindexed),
+                'by_alert_class': by_class,
+                'oldest_age': max(ages) if ages else 0.0,
+                'fired': self.fired,
+                'expired': self.expired,
+            }
+
+class AlertPump(object):
+    """
+    Moves alerts from a libtorrent session onto the reactor thread in batches.
+
+    A daemon thread blocks in session.wait_for_alert, drains everything that
+    is queued and hands the batch to process_batch with callFromThread.  It
+    does not pop again until the reactor has finished the batch, since newer
+    libtorrents free popped alerts on the next pop.  The wait timeout backs
+    off while idle, and after a full batch the thread lingers for min_wait so
+    bursts arrive as a few large batches rather than many small ones.
+
+    Bindings without wait_for_alert fall back to polling from the reactor,
+    with the interval shrinking during bursts and growing while idle.
+
+    tick, if given, is called from the pumping thread at most every
+    tick_interval seconds; it is meant for requests such as
+    post_torrent_updates whose answers come back as alerts.
+    """
+    def __init__(self, ses, process_batch, min_wait=0.005, max_wait=1.0,
+            max_batch=1000, tick=None, tick_interval=1.0):
+        self._ses = ses
+        self._process_batch = process_batch
+        self.min_wait = min_wait
+        self.max_wait = min(max_wait, tick_interval) if tick else max_wait
+        self.max_batch = max_batch
+        self._tick = tick
+        self.tick_interval = tick_interval
+        self._next_tick = 0
+        self._running = False
+        self._thread = None
+        self._finished = False
+        self._stopped = list() # Deferreds waiting for the thread to finish
+        self._exit_timeout = None
+        self._batch_done = threading.Event()
+        self._poll_call = None
+        self.batches = 0
+        self.alerts = 0
+        self.wakeups = 0
+
+    def start(self):
+        self._running = True
+        if hasattr(self._ses, 'wait_for_alert'):
+            self._thread = threading.Thread(target=self._run, name='AlertPump')
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._poll(self.min_wait)
+        reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        returns a Deferred fired once the pumping thread has finished, or
+        after 2 * max_wait seconds if it has not.  Session.stop_session waits
+        on it; the shutdown trigger only tells the thread to stop.
+        """
+        self._running = False
+        self._batch_done.set()
+        if self._poll_call is not None and self._poll_call.active():
+            self._poll_call.cancel()
+        if self._thread is None or self._finished:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._stopped.append(d)
+        if self._exit_timeout is None:
+            self._exit_timeout = reactor.callLater(self.max_wait * 2, self._exited)
+        return d
+
+    def _exited(self):
+        if self._exit_timeout is not None and self._exit_timeout.active():
+            self._exit_timeout.cancel()
+        self._exit_timeout = None
+        stopped, self._stopped = self._stopped, list()
+        for d in stopped:
+            d.callback(None)
+
+    def _pop_batch(self):
+        if hasattr(self._ses, 'pop_alerts'):
+            return self._ses.pop_alerts()
+        batch = list()
+        while len(batch) < self.max_batch:
+            alert = self._ses.pop_alert()
+            if alert is None:
+                break
+            batch.append(alert)
+        return batch
+
+    def _deliver(self, batch):
+        try:
+            self._process_batch(batch)
+        finally:
+            self.batches += 1
+            self.alerts += len(batch)
+            self._batch_done.set()
+
+    def _maybe_tick(self):
+        if self._tick is None:
+            return
+        now = time.time()
+        if now < self._next_tick:
+            return
+        self._next_tick = now + self.tick_interval
+        try:
+            self._tick()
+        except Exception:
+            logger.exception("alert pump tick failed")
+
+    def _run(self):
+        wait = self.min_wait
+        while self._running:
+            self.wakeups += 1
+            self._maybe_tick()
+            if self._ses.wait_for_alert(int(wait * 1000)) is None:
+                wait = min(wait * 2, self.max_wait)
+                continue
+            wait = self.min_wait
+            batch = self._pop_batch()
+            if not batch:
+                continue
+            self._batch_done.clear()
+            reactor.callFromThread(self._deliver, batch)
+            self._batch_done.wait()
+            if len(batch) >= self.max_batch:
+                time.sleep(self.min_wait)
+        self._finished = True
+        reactor.callFromThread(self._exited)
+
+    def _poll(self, interval):
+        self._poll_call = None
+        if not self._running:
+            return
+        self.wakeups += 1
+        self._maybe_tick()
+        batch = self._pop_batch()
+        if batch:
+            self._deliver(batch)
+        if len(batch) >= self.max_batch:
+            interval = self.min_wait
+        elif batch:
+            interval = max(self.min_wait, interval / 2)
+        else:
+            interval = min(self.max_wait, interval * 2)
+        self._poll_call = reactor.callLater(interval, self._poll, interval)
+
+    def stats(self):
+        return {
+                'batches': self.batches,
+                'alerts': self.alerts,
+                'wakeups': self.wakeups,
+                'mean_batch': float(self.alerts) / self.batches if self.batches else 0.0,
+            }
 
 def signature_match(*sig_args):
     def decorator(func):
@@ -97,8 +397,27 @@ def maybe_handle(func):
         return func(self, infohash, *args, **kwargs)
     return decorated
 
+def alert_infohash(alert):
+    """
+    removal alerts carry info_hash because their handle may already be gone.
+    """
+    infohash = getattr(alert, 'info_hash', None)
+    if infohash is None:
+        infohash = alert.handle.info_hash()
+    return str(infohash)
+
 
 class Session(object):
+    DEFAULT_SAVE_PATH = "/tmp"
+    DEFAULT_STATE_DIR = "/tmp"
+    LIFECYCLE_EVENTS = {
+            libtorrent.torrent_added_alert: 'added',
+            libtorrent.torrent_finished_alert: 'finished',
+            libtorrent.torrent_paused_alert: 'paused',
+            libtorrent.torrent_resumed_alert: 'resumed',
+            libtorrent.torrent_removed_alert: 'removed',
+            libtorrent.torrent_error_alert: 'error',
+        }
     MONITOR_ALERTS = reduce(operator.or_, (
         libtorrent.alert.category_t.error_notification,
         libtorrent.alert.category_t.status_notification,
@@ -106,45 +425,116 @@ class Session(object):
         libtorrent.alert.category_t.progress_notification,
         ))
 
-    def __init__(self):
-        self._waiting_deferreds = list()
+    def __init__(self, state_dir=None, volumes=None):
+        self.state_dir = state_dir or self.DEFAULT_STATE_DIR
+        self._metrics = MetricsRegistry()
+        self._dispatcher = AlertDispatcher(wait_times=self._metrics.histogram(
+            'alert_wait_seconds', "Time from adding an alert waiter to its alert."))
+        self._add_metrics()
+        self._journal = AlertJournal(alert_infohash)
+        self._name_index = TorrentNameIndex()
+        self._status_cache = StatusCache()
+        self._metainfo = MetainfoStore()
+        self._subscriptions = SubscriptionManager(self)
         self._static_alert_handlers = list()
         self._add_static_handlers()
 
         self._ses = libtorrent.session()
         self._ses.set_alert_mask(self.MONITOR_ALERTS)
-        self._pop_alerts() # start alert popping loop
-        self._resume_storage = ResumeStorage("/tmp/resume")
+        self._resume_storage = ResumeStorage(DirectoryBackend(self.state_path('resume')))
+        self._torrent_storage = ResumeStorage(DirectoryBackend(self.state_path('torrents')))
+        self._restorer = SessionRestorer(self)
+        self._fetcher = TorrentFetcher(self.state_path('torrent-cache'))
+        self._alert_pump = AlertPump(self._ses, self._process_alerts,
+                tick=getattr(self._ses, 'post_torrent_updates', None))
+        self._alert_pump.start()
+        self._stopping = False
+        self._checkpoints = CheckpointScheduler(self)
+        self._checkpoints.start()
+        self._scheduler = QueueScheduler(self)
+        self._scheduler.start()
+        self._storage = StoragePlacer(self, volumes or [Volume(self.DEFAULT_SAVE_PATH)])
+        self._storage.start()
+        self._streams = dict() # (infohash, file index) -> TorrentStream
+        self._peers = PeerSampler(self)
+        self._peers.start()
+        self._metrics.start()
 
-    def _pop_alerts(self):
-        try:
-            while True:
-                alert = self._ses.pop_alert()
-                if alert is None: break
+    def state_path(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def _add_metrics(self):
+        metrics = self._metrics
+        self._alert_counts = metrics.counter('alerts_total',
+                "Alerts processed, by alert type.", label='type')
+        self._batch_sizes = metrics.histogram('alert_batch_size',
+                "Alerts per batch handed to the reactor.", COUNT_BUCKETS)
+        self._batch_times = metrics.histogram('alert_batch_seconds',
+                "Time taken to process one batch of alerts.")
+        metrics.gauge('alert_waiters', "Deferreds waiting on an alert.",
+                lambda: len(self._dispatcher))
+        metrics.gauge('alert_waiter_oldest_seconds', "Age of the oldest alert waiter.",
+                lambda: self._dispatcher.stats()['oldest_age'])
+        metrics.gauge('torrents', "Torrents in the session.",
+                lambda: len(self._name_index))
+        metrics.gauge('journal_suppressed', "Alerts left out of the journal, by alert type.",
+                lambda: dict(self._journal.suppressed), label='type')
+        metrics.gauge('subscriptions', "Active status subscriptions.",
+                lambda: len(self._subscriptions))
+
+    def metrics(self):
+        return self._metrics.snapshot()
+
+    def journal(self, infohash=None, since=None, until=None, types=None, limit=100):
+        return self._journal.query(infohash, since, until, types, limit)
+
+    def _process_alerts(self, alerts):
+        started = time.time()
+        for alert in alerts:
+            self._alert_counts.inc(key=type(alert).__name__)
+            try:
                 self._process_alert(alert)
-        finally:
-            reactor.callLater(1, self._pop_alerts)
+            except Exception:
+                logger.exception("failed to process %s" % type(alert))
+        self._batch_sizes.observe(len(alerts))
+        self._batch_times.observe(time.time() - started)
 
     def _process_alert(self, alert):
-        logger.info("%s: %s" % (type(alert), alert.message()))
+        self._journal.record(alert)
         for sah in self._static_alert_handlers:
             sah(alert)
 
-        for wd in self._waiting_deferreds:
-            if wd.match(alert):
-                wd.deferred.callback(alert)
-                self._waiting_deferreds.remove(wd)
+        self._dispatcher.dispatch(alert)
 
     def _expire_deferreds(self):
-        for wd in self._waiting_deferreds:
-            if wd.is_expired():
-                wd.deferred.errback(TimeoutError("The callback expired."))
-                self._waiting_deferreds.remove(wd)
+        self._dispatcher.expire()
 
     def _add_deferred(self, alert_match_func):
-        ad = AlertDeferred(alert_match_func)
-        self._waiting_deferreds.append(ad)
-        return ad.deferred
+        return self._dispatcher.add(AlertDeferred(alert_match_func))
+
+    def _add_indexed_deferred(self, infohash, alert_cls, expire_after=None):
+        """
+        returns a Deferred fired by the first alert_cls (a class or tuple of
+        classes) alert for infohash.
+        """
+        match_func = lambda alert: (isinstance(alert, alert_cls)
+                and infohash == str(alert.handle.info_hash()))
+        ad = AlertDeferred(match_func, expire_after)
+        return self._dispatcher.add(ad, alert_cls, infohash)
+
+    def _add_piece_deferred(self, infohash, piece, alert_cls, expire_after=None):
+        """
+        returns a Deferred fired by the first alert_cls alert for one piece
+        of infohash.
+        """
+        match_func = lambda alert: (isinstance(alert, alert_cls)
+                and infohash == str(alert.handle.info_hash())
+                and piece == alert_piece(alert))
+        ad = AlertDeferred(match_func, expire_after)
+        return self._dispatcher.add(ad, alert_cls, infohash, piece)
+
+    def waiter_stats(self):
+        return self._dispatcher.stats()
 
     def add_static_handler(self):
         def decorator(func):
@@ -161,67 +551,322 @@ class Session(object):
         @self.add_static_handler()
         @signature_match(libtorrent.torrent_paused_alert)
         def save_resume_data_on_pause(alert):
-            alert.handle.save_resume_data()
+            if not self._stopping:
+                self._checkpoints.request(alert_infohash(alert), alert.handle
+                        ).addErrback(lambda f: None)
+
+        @self.add_static_handler()
+        @signature_match(libtorrent.torrent_added_alert)
+        def index_added_torrent(alert):
+            self._name_index.add(alert_infohash(alert), alert.handle.name(), alert.handle)
+            if alert.handle.has_metadata():
+                self._metainfo.add(alert_infohash(alert), alert.handle.get_torrent_info())
+
+        @self.add_static_handler()
+        @signature_match(libtorrent.metadata_received_alert)
+        def index_received_metadata(alert):
+            self._name_index.add(alert_infohash(alert), alert.handle.name(), alert.handle)
+            self._metainfo.add(alert_infohash(alert), alert.handle.get_torrent_info())
+            self._subscriptions.forget(alert_infohash(alert))
+            if alert_infohash(alert) not in self._torrent_storage:
+                self._torrent_storage[alert_infohash(alert)] = libtorrent.create_torrent(
+                        alert.handle.get_torrent_info()).generate()
+
+        # after indexing added torrents but before unindexing removed ones,
+        # so query subscriptions can still match the torrent's name
+        @self.add_static_handler()
+        @signature_match(tuple(self.LIFECYCLE_EVENTS))
+        def publish_lifecycle_event(alert):
+            for cls in type(alert).__mro__:
+                if cls in self.LIFECYCLE_EVENTS:
+                    self._subscriptions.event(alert_infohash(alert),
+                            self.LIFECYCLE_EVENTS[cls])
+                    break
+
+        @self.add_static_handler()
+        @signature_match(libtorrent.torrent_removed_alert)
+        def unindex_removed_torrent(alert):
+            self._name_index.remove(alert_infohash(alert))
+            self._status_cache.remove(alert_infohash(alert))
+            self._metainfo.remove(alert_infohash(alert))
+            self._checkpoints.discard(alert_infohash(alert))
+            self._scheduler.discard(alert_infohash(alert))
+            self._storage.discard(alert_infohash(alert))
+            self._peers.discard(alert_infohash(alert))
+            for key in [k for k in self._streams if k[0] == alert_infohash(alert)]:
+                del self._streams[key]
+            if alert_infohash(alert) in self._resume_storage:
+                del self._resume_storage[alert_infohash(alert)]
+            if alert_infohash(alert) in self._torrent_storage:
+                del self._torrent_storage[alert_infohash(alert)]
+
+        @self.add_static_handler()
+        @signature_match(libtorrent.torrent_paused_alert)
+        def cache_paused(alert):
+            self._status_cache.patch(alert_infohash(alert), paused=True)
+
+        @self.add_static_handler()
+        @signature_match(libtorrent.torrent_resumed_alert)
+        def cache_resumed(alert):
+            self._status_cache.patch(alert_infohash(alert), paused=False)
+
+        @self.add_static_handler()
+        @signature_match(libtorrent.state_update_alert)
+        def cache_state_updates(alert):
+            self._status_cache.update(alert.status)
+            changed = map(status_infohash, alert.status)
+            for infohash in changed:
+                self._checkpoints.mark_dirty(infohash)
+            self._subscriptions.status_changed(changed)
 
     def _make_torrent_alert_handler(self, infohash, alert_cls):
         """
         returns a Deferred.  callback arg is a alert_cls
         """
-        def alert_match_func(alert):
-            if isinstance(alert, alert_cls):
-                return infohash == str(alert.handle.info_hash())
-            return False
-        return self._add_deferred(alert_match_func)
+        return self._add_indexed_deferred(infohash, alert_cls)
 
     def add_torrent(self, url):
         """
         returns Deferred.  callback arg is a libtorrent.torrent_alert
         """
+        return self._fetcher.fetch(url).addCallback(self.add_torrent_data)
+
+    def add_torrent_data(self, buf, resume_data=None):
+        """
+        adds a bencoded .torrent file, along with its bencoded resume data
+        if given.  returns Deferred.  callback arg is a libtorrent.torrent_alert
+        """
         deferred = defer.Deferred()
-        def _add_torrent(buf):
-            try:
-                info = libtorrent.torrent_info(libtorrent.bdecode(buf))
-            except RuntimeError as e:
-                deferred.errback(e)
+        def parse():
+            entry, info = parse_torrent(buf)
+            resume = libtorrent.bdecode(resume_data) if resume_data else None
+            return entry, RestoreEntry(str(info.info_hash()), info, resume_data, resume)
+        def _add_torrent(parsed):
+            entry, torrent = parsed
+            if torrent.infohash in self._name_index:
+                deferred.errback(RuntimeError("Torrent %s already added" % torrent.infohash))
                 return
-            def wait_for_event(alert):
-                if isinstance(alert, libtorrent.torrent_alert):
-                    return info.info_hash() == alert.handle.info_hash()
-                return False
-            self._add_deferred(wait_for_event).chainDeferred(deferred)
+            admitted = not torrent.paused and self._scheduler.admit(
+                    torrent.infohash, torrent.seeding)
             try:
-                self._ses.add_torrent(info, "/tmp")
+                self._add_parsed_torrent(torrent.info, torrent.save_path,
+                        torrent.resume_data, not admitted)
             except RuntimeError as e:
+                if not torrent.paused:
+                    self._scheduler.discard(torrent.infohash) # undo admit()
                 deferred.errback(e)
                 return
-        twisted.web.client.getPage(url).addCallbacks(_add_torrent, deferred.errback)
+            # the added alert is only processed on a later reactor turn
+            self._add_indexed_deferred(torrent.infohash,
+                    libtorrent.torrent_alert).chainDeferred(deferred)
+            self._torrent_storage[torrent.infohash] = entry
+        d = threads.deferToThread(parse)
+        d.addCallbacks(_add_torrent, deferred.errback)
         return deferred
 
-    def load_torrent(self, infohash):
-        d = self._make_torrent_alert_handler(infohash, (
-                # libtorrent.torrent_loaded_alert,
-                type('AnonymousType', (object, ), {}),
-            ))
-        handle = self._ses.find_torrent(libtorrent.big_number(infohash.decode('hex')))
-        try:
-            handle.infohash()
-        except RuntimeError as e:
-            d.errback(failure.Failure(ValueError("Invalid handle")))
+    def export_torrent(self, infohash, timeout=60):
+        """
+        saves resume data for a torrent and removes it, leaving its files
+        in place, so another session can add_torrent_data it.  returns a
+        Deferred.  callback arg is (bencoded torrent, bencoded resume data
+        or None).
+        """
+        handle = self._find_valid_handle(infohash)
+        if infohash not in self._torrent_storage:
+            return defer.fail(ValueError("No stored torrent for %s" % infohash))
+        handle.pause()
+        d = self._checkpoints.request(infohash, handle, expire_after=timeout)
+        d.addBoth(lambda _: self._resume_storage.flush())
+        def read():
+            resumes = self._resume_storage.backend
+            resume_raw = resumes.read(infohash) if infohash in resumes else None
+            return self._torrent_storage.backend.read(infohash), resume_raw
+        d.addCallback(lambda _: threads.deferToThread(read))
+        def remove(exported):
+            removed = self.remove_torrent(infohash, delete_files=False)
+            return removed.addCallback(lambda _: exported)
+        d.addCallback(remove)
+        return d
+
+    def add_torrents(self, urls):
+        """
+        returns (deferreds, aggregate).  deferreds holds one add_torrent
+        Deferred per url, whose failures are the caller's to consume;
+        aggregate fires once all are done with a list, in the order of
+        urls, of {'url', 'infohash'} or {'url', 'error'} dicts.
+        """
+        deferreds = map(self.add_torrent, urls)
+        def aggregate(results):
+            summary = list()
+            for url, (ok, result) in zip(urls, results):
+                if ok:
+                    summary.append({'url': url, 'infohash': str(result.handle.info_hash())})
+                else:
+                    summary.append({'url': url, 'error': result.getErrorMessage()})
+            return summary
+        d = defer.DeferredList(map(tee, deferreds), consumeErrors=True)
+        d.addCallback(aggregate)
+        return deferreds, d
 
-        if infohash not in self._metainfo_torrent:
-            d.errback(failure.Failure(ValueError("Unknown infohash")))
+    def _add_parsed_torrent(self, info, save_path=None, resume_data=None, paused=False):
+        """
+        adds a torrent_info to the session and the indexes.  returns the
+        torrent_handle.
+        """
+        infohash = str(info.info_hash())
+        if infohash in self._name_index:
+            raise RuntimeError("Torrent %s already added" % infohash)
+        if save_path is None:
+            volume = self._storage.place(infohash, info.total_size())
+            params = {'ti': info, 'save_path': volume.path,
+                    'storage_mode': volume.storage_mode}
         else:
-            if infohash in self._resume_storage:
-                pass
+            volume = self._storage.track(infohash, save_path, info.total_size())
+            params = {'ti': info, 'save_path': save_path}
+        if resume_data:
+            params['resume_data'] = resume_data
+        # the QueueScheduler does the queueing; libtorrent's own queue would
+        # pause and resume torrents behind its back
+        params['auto_managed'] = False
+        if paused:
+            params['paused'] = True
+        try:
+            handle = self._ses.add_torrent(params)
+        except RuntimeError:
+            if volume is not None:
+                self._storage.untrack(volume, infohash)
+            raise
+        self._name_index.add(infohash, info.name(), handle)
+        self._metainfo.add(infohash, info)
+        return handle
+
+    def load_torrent(self, infohash):
+        """
+        re-adds a torrent from torrent and resume storage.
+        returns a Deferred.  callback arg is a libtorrent.torrent_added_alert
+        """
+        if infohash in self._name_index:
+            return defer.fail(ValueError("Torrent already loaded"))
+        if infohash not in self._torrent_storage:
+            return defer.fail(ValueError("Unknown infohash"))
+        d = self._make_torrent_alert_handler(infohash, libtorrent.torrent_added_alert)
+        self._restorer.restore_one(infohash).addErrback(d.errback)
         return d
 
+    def subscribe(self, listener, infohashes=None, query=None, max_rate=1.0,
+            fields=None):
+        """
+        pushes status changes and lifecycle events for the listed torrents,
+        or those matching query, to listener.  returns a subscription id.
+        see SubscriptionManager.
+        """
+        return self._subscriptions.subscribe(listener, infohashes, query,
+                max_rate, fields)
+
+    def unsubscribe(self, sid):
+        self._subscriptions.unsubscribe(sid)
+
+    def restore(self):
+        """
+        re-adds every stored torrent.  returns a Deferred fired with
+        restore_progress() once all are added; see SessionRestorer.
+        """
+        return self._restorer.restore()
+
+    def restore_progress(self):
+        return self._restorer.progress()
+
+    def storage(self):
+        """
+        volume usage and load, and the rebalancer's progress; see
+        StoragePlacer.
+        """
+        return self._storage.state()
+
+    def move_storage(self, infohash, path):
+        """
+        moves a torrent to the volume at path.  returns a Deferred.
+        callback arg is a libtorrent.storage_moved_alert
+        """
+        return self._storage.move(infohash, path)
+
+    def open_stream(self, infohash, file_index=0, hold=True):
+        """
+        returns the TorrentStream reading one file of infohash, opening it
+        if need be.  a held stream stays open until close_stream; one opened
+        with hold=False closes once release_stream lets go of its last reader.
+        """
+        key = (infohash, file_index)
+        if key not in self._streams:
+            self._streams[key] = TorrentStream(self, infohash, file_index)
+        stream = self._streams[key]
+        stream.held = stream.held or hold
+        return stream
+
+    def release_stream(self, infohash, file_index, reader):
+        stream = self._streams.get((infohash, file_index))
+        if stream is None:
+            return
+        stream.close_reader(reader)
+        if not (stream.held or stream.readers):
+            self.close_stream(infohash, file_index)
+
+    def close_stream(self, infohash, file_index=0):
+        """
+        lets go of a held stream, closing it unless readers still use it.
+        """
+        stream = self._streams.get((infohash, file_index))
+        if stream is None:
+            return
+        stream.held = False
+        if not stream.readers:
+            del self._streams[(infohash, file_index)]
+            stream.close()
+
+    def streams(self):
+        return [stream.stats() for stream in self._streams.itervalues()]
+
+    def peer_summary(self, count=20, torrent_count=None):
+        """
+        peers, rates and slow peers in total and by country, client and
+        torrent, from the latest peer list samples; see PeerSampler.
+        """
+        return self._peers.summary(count, torrent_count)
+
+    def torrent_peers(self, infohash):
+        """
+        one torrent's sampled peers by country and client.  raises KeyError
+        for torrents not sampled yet.
+        """
+        return self._peers.torrent_summary(infohash)
+
+    def queue(self):
+        """
+        the active torrent scheduler's limits, choices and recent
+        decisions; see QueueScheduler.
+        """
+        return self._scheduler.state()
+
+    def set_queue_override(self, infohash, mode):
+        """
+        mode is 'force' to keep a torrent running, 'stop' to keep it
+        paused or None to leave it to the scheduler.
+        """
+        self._find_valid_handle(infohash)
+        self._scheduler.set_override(infohash, mode)
+        return self._scheduler.state(decisions=0)
+
+    def set_queue_limits(self, max_downloads=None, max_seeds=None):
+        self._scheduler.set_limits(max_downloads, max_seeds)
+        return self._scheduler.state(decisions=0)
+
     @maybe_handle # : args=(self, infohash | handle) -> args=(self, infohash)
     def resume_torrent(self, infohash):
         """
         returns a Deferred.  callback arg is a libtorrent.torrent_resumed_alert
         """
+        torrent = self._find_valid_handle(infohash)
         retval = self._make_torrent_alert_handler(infohash, libtorrent.torrent_resumed_alert)
-        torrent = self._ses.find_torrent(libtorrent.big_number(infohash.encode('hex')))
         torrent.resume()
         return retval
 
@@ -230,44 +875,252 @@ class Session(object):
         """
         returns a Deferred.  callback arg is a libtorrent.torrent_paused_alert
         """
+        torrent = self._find_valid_handle(infohash)
         retval = self._make_torrent_alert_handler(infohash, libtorrent.torrent_paused_alert)
-        torrent = self._ses.find_torrent(libtorrent.big_number(infohash.decode('hex')))
         torrent.pause()
         return retval
 
     @maybe_handle # : args=(self, infohash | handle) -> args=(self, infohash)
-    def remove_torrent(self, infohash):
+    def remove_torrent(self, infohash, delete_files=False):
+        """
+        returns a Deferred.  callback arg is a libtorrent.torrent_removed_alert,
+        or a torrent_deleted_alert once the files are deleted too.  Files are
+        only deleted when delete_files is given.
+        """
+        torrent = self._find_valid_handle(infohash)
+        if not delete_files:
+            retval = self._make_torrent_alert_handler(infohash, libtorrent.torrent_removed_alert)
+            self._ses.remove_torrent(torrent)
+            return retval
+        retval = self._make_torrent_alert_handler(infohash, libtorrent.torrent_deleted_alert)
+        self._ses.remove_torrent(torrent, libtorrent.options_t.delete_files)
+        return retval
+
+    BATCH_ACTIONS = {
+            'pause': pause_torrent,
+            'resume': resume_torrent,
+            'remove': remove_torrent,
+        }
+
+    def _select(self, infohashes=None, query=None):
+        if infohashes is None:
+            return self._name_index.search(query) if query is not None else list(self._name_index)
+        return list(infohashes)
+
+    def batch(self, action, infohashes=None, query=None, fields=None):
         """
-        returns a Deferred.  callback arg is a libtorrent.torrent_deleted_alert
+        runs 'pause', 'resume' or 'remove' on every listed infohash, or on
+        every torrent whose name matches query.  returns a Deferred.
+        callback arg is {'results': {infohash: fields}, 'errors': {infohash:
+        message}}, fields being projected as in torrent_fields.  removed
+        torrents report the fields they had before removal.  torrents the
+        status cache already shows paused (or running), with no resume (or
+        pause) still on its way, are reported without pausing (or resuming)
+        them again, as libtorrent posts no alert then.
         """
-        return self._make_torrent_alert_handler(
-                libtorrent.torrent_deleted_alert, lambda a: self._ses.remove_torrent(a.handle))
+        op = self.BATCH_ACTIONS[action]
+        already, opposite = {
+                'pause': (True, libtorrent.torrent_resumed_alert),
+                'resume': (False, libtorrent.torrent_paused_alert),
+            }.get(action, (None, None))
+        selected = self._select(infohashes, query)
+        before = dict()
+        if action == 'remove':
+            for infohash in selected:
+                try:
+                    before[infohash] = self.torrent_fields(infohash, fields)
+                except (KeyError, ValueError):
+                    pass
+        deferreds = list()
+        for infohash in selected:
+            try:
+                if (already is not None and self.torrent_status(infohash)['paused'] == already
+                        and not self._dispatcher.waiting(opposite, infohash)):
+                    deferreds.append(defer.succeed(None))
+                    continue
+                deferreds.append(op(self, infohash))
+            except (ValueError, RuntimeError) as e:
+                deferreds.append(defer.fail(e))
+        def collect(outcomes):
+            results, errors = dict(), dict()
+            for infohash, (ok, result) in zip(selected, outcomes):
+                if not ok:
+                    errors[infohash] = result.getErrorMessage()
+                elif infohash in before:
+                    results[infohash] = before[infohash]
+                else:
+                    try:
+                        results[infohash] = self.torrent_fields(infohash, fields)
+                    except KeyError:
+                        errors[infohash] = "Unknown infohash %s" % infohash
+                    except ValueError as e:
+                        errors[infohash] = str(e)
+            return {'results': results, 'errors': errors}
+        d = defer.DeferredList(deferreds, consumeErrors=True)
+        d.addCallback(collect)
+        return d
+
+    def _field_sources(self, infohash, wanted=None):
+        """
+        the cached status and metainfo dicts holding the wanted fields
+        of one torrent.
+        """
+        sources = list()
+        if wanted is None or wanted & STATUS_FIELDS:
+            sources.append(self.torrent_status(infohash))
+        if wanted is None or wanted - STATUS_FIELDS:
+            try:
+                sources.append(self.metainfo(infohash))
+            except KeyError:
+                if infohash not in self._name_index:
+                    raise
+                sources.append({'name': self._name_index.name(infohash)})
+        return sources
+
+    def torrent_fields(self, infohash, fields=None):
+        """
+        status and metainfo fields of one torrent, limited to fields (a
+        list of keys) when given.  reads only the caches the fields need.
+        """
+        wanted = None if fields is None else frozenset(fields)
+        record = dict()
+        for source in self._field_sources(infohash, wanted):
+            record.update(source)
+        return project(record, fields)
+
+    def torrent_columns(self, infohashes=None, query=None, fields=None):
+        """
+        returns a TorrentColumns of the selected torrents, as get_torrents
+        selects them, holding fields or every column field.
+        """
+        columns = TorrentColumns(fields)
+        wanted = frozenset(columns.fields)
+        for infohash in self._select(infohashes, query):
+            try:
+                sources = self._field_sources(infohash, wanted)
+            except KeyError:
+                columns.errors[infohash] = "Unknown infohash %s" % infohash
+            except ValueError as e:
+                columns.errors[infohash] = str(e)
+            else:
+                columns.append(infohash, *sources)
+        return columns
+
+    def get_torrents(self, infohashes=None, query=None, fields=None):
+        """
+        returns {'results': {infohash: fields}, 'errors': {infohash: message}}
+        """
+        results, errors = dict(), dict()
+        for infohash in self._select(infohashes, query):
+            try:
+                results[infohash] = self.torrent_fields(infohash, fields)
+            except KeyError:
+                errors[infohash] = "Unknown infohash %s" % infohash
+            except ValueError as e:
+                errors[infohash] = str(e)
+        return {'results': results, 'errors': errors}
+
+    def _find_handle(self, infohash):
+        handle = self._name_index.handle(infohash)
+        if handle is None:
+            try:
+                raw = infohash.decode('hex')
+            except TypeError:
+                raise ValueError("Invalid infohash %s" % infohash)
+            handle = self._ses.find_torrent(libtorrent.big_number(raw))
+        return handle
+
+    def _find_valid_handle(self, infohash):
+        handle = self._find_handle(infohash)
+        if not handle.is_valid():
+            raise ValueError("Unknown infohash %s" % infohash)
+        return handle
 
     def _find_torrents_re(self, regexp):
-        print regexp
-        print map(libtorrent.torrent_handle.name, self._ses.get_torrents())
-        regexp = re.compile(regexp)
-        torrent_filter = sre_ft.compose(regexp.match, libtorrent.torrent_handle.name)
-        return filter(torrent_filter, self._ses.get_torrents())
+        return map(self._find_handle, self._name_index.search(regexp))
 
     def find_torrents(self, regexp):
-        torrents = self._find_torrents_re(regexp)
-        get_torrent_key = lambda t: str(t.info_hash())
-        return dict((get_torrent_key(t), serialize_torrent(t)) for t in torrents)
+        return self.torrent_columns(query=regexp).rows()
+
+    def iter_torrents(self, query=None, after=None):
+        """
+        yields the infohashes of the torrents whose names match query, or
+        of every torrent, in infohash order and past after; see TorrentQuery
+        for paging through them.
+        """
+        return self._name_index.iter_search(query, after)
+
+    def metainfo(self, infohash):
+        """
+        serialized metainfo for one torrent.  raises KeyError for unknown
+        torrents and ones still waiting for their metadata.
+        """
+        metainfo = self._metainfo.get(infohash)
+        if metainfo is None:
+            handle = self._find_handle(infohash)
+            if not (handle.is_valid() and handle.has_metadata()):
+                raise KeyError(infohash)
+            metainfo = self._metainfo.add(infohash, handle.get_torrent_info())
+        return metainfo
 
     def torrent_metainfo(self):
-        def get_torrent_key(torrent):
-            return str(torrent.info_hash())
-        return dict((get_torrent_key(torrent), serialize_torrent_metainfo(torrent))
-                for torrent in self._ses.get_torrents())
+        return self._metainfo.snapshot()
+
+    def torrent_status(self, infohash):
+        """
+        serialized status for one torrent, from the status cache.  torrents
+        that post_torrent_updates has not reported yet are read once from
+        their handle.
+        """
+        status = self._status_cache.get(infohash)
+        if status is None:
+            status = self._status_cache.set(infohash,
+                    serialize_torrent_status(self._find_valid_handle(infohash)))
+        return status
 
     def torrent_state(self):
-        def get_torrent_key(torrent):
-            return str(torrent.info_hash())
-        return dict( (get_torrent_key(torrent), serialize_torrent_status(torrent))
-                for torrent in self._ses.get_torrents())
+        for infohash in self._name_index:
+            if infohash not in self._status_cache:
+                self.torrent_status(infohash)
+        return self._status_cache.snapshot()
 
-    def stop_session(self):
-        pass
+    def torrent_state_since(self, version):
+        """
+        returns the status changes after version; see StatusCache.changed_since
+        """
+        return self._status_cache.changed_since(version)
+
+    def stop_session(self, timeout=60):
+        """
+        pauses the session, saves resume data for every torrent and then
+        stops the alert pump.  returns a Deferred.  callback arg is a dict
+        with the number of torrents saved and failed and the seconds it took.
+        """
+        started = time.time()
+        self._stopping = True
+        self._checkpoints.stop()
+        self._ses.pause()
+        saves = list()
+        for handle in self._ses.get_torrents():
+            if not (handle.is_valid() and handle.has_metadata()):
+                continue
+            saves.append(self._checkpoints.request(
+                str(handle.info_hash()), handle, expire_after=timeout))
+        def flush(results):
+            saved = sum(1 for ok, alert in results
+                    if ok and isinstance(alert, libtorrent.save_resume_data_alert))
+            d = self._resume_storage.flush()
+            d.addCallback(lambda _: {
+                'saved': saved,
+                'failed': len(results) - saved,
+                'seconds': time.time() - started,
+            })
+            return d
+        def stop_pump(summary):
+            return self._alert_pump.stop().addCallback(lambda _: summary)
+        d = defer.DeferredList(saves, consumeErrors=True)
+        d.addCallback(flush)
+        d.addCallback(stop_pump)
+        return d
 
 
@@ -0,0 +1,613 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import os
+import sys
+import hashlib
+import logging
+
+from twisted.internet import reactor, defer, protocol, threads
+from twisted.spread import pb
+
+from rarity.remote import TimedRoot
+from rarity.metrics import MetricsRegistry
+from rarity.columns import TorrentColumns
+from rarity.peers import merge_summaries
+from rarity.query import MAX_PAGE_SIZE, encode_token, decode_token
+from rarity.ingest import TorrentFetcher, parse_torrent
+from rarity.utils import split_chunks
+
+logger = logging.getLogger('ClientCore')
+
+def shard_ranking(infohash, shards):
+    """
+    rendezvous hashing: shards in the order infohash prefers them.  losing
+    or regaining a shard only moves the torrents that prefer it.
+    """
+    return sorted(shards, reverse=True,
+            key=lambda shard: hashlib.sha1('%s:%d' % (infohash, shard)).digest())
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    One shard: a `python -m rarity.node` child with its own state directory,
+    listen ports and localhost PB port.  It is restarted with a growing
+    delay whenever it exits, until stop() is called.
+    """
+    def __init__(self, router, shard, state_dir, listen_port, listen_ports, pb_port,
+            volumes=(), max_restart_delay=60):
+        self.router = router
+        self.shard = shard
+        self.state_dir = state_dir
+        self.listen_port = listen_port
+        self.listen_ports = listen_ports
+        self.pb_port = pb_port
+        self.volumes = list(volumes)
+        self.max_restart_delay = max_restart_delay
+        self.root = None
+        self.pid = None
+        self.restarts = 0
+        self._restart_delay = 1
+        self._stopping = False
+        self._ended = None
+
+    @property
+    def up(self):
+        return self.root is not None
+
+    def spawn(self):
+        args = [sys.executable, '-m', 'rarity.node', self.state_dir,
+                str(self.listen_port), str(self.listen_ports), str(self.pb_port)
+                ] + self.volumes
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        reactor.spawnProcess(self, sys.executable, args, env=env,
+                childFDs={0: 'w', 1: 1, 2: 2})
+
+    def connectionMade(self):
+        self.pid = self.transport.pid
+        self._ended = defer.Deferred()
+        self._connect()
+
+    def _connect(self):
+        if self._stopping or self.transport is None or self.transport.pid is None:
+            return
+        factory = pb.PBClientFactory()
+        reactor.connectTCP('127.0.0.1', self.pb_port, factory)
+        def connected(root):
+            self.root = root
+            self._restart_delay = 1
+            root.notifyOnDisconnect(self._disconnected)
+            self.router.worker_up(self)
+        def retry(reason):
+            reactor.callLater(1, self._connect)
+        factory.getRootObject().addCallbacks(connected, retry)
+
+    def _disconnected(self, _):
+        if self.root is not None:
+            self.root = None
+            self.router.worker_down(self)
+
+    def processEnded(self, reason):
+        logger.warning("shard %d (pid %s) exited: %s" % (
+            self.shard, self.pid, reason.getErrorMessage()))
+        self._disconnected(None)
+        self.pid = None
+        ended, self._ended = self._ended, None
+        if ended is not None:
+            ended.callback(None)
+        if not self._stopping:
+            self.restarts += 1
+            reactor.callLater(self._restart_delay, self.spawn)
+            self._restart_delay = min(self._restart_delay * 2, self.max_restart_delay)
+
+    def stop(self):
+        """
+        closes the worker's stdin so it saves its state and exits.  returns
+        a Deferred fired once it has.
+        """
+        self._stopping = True
+        if self._ended is None:
+            return defer.succeed(None)
+        ended = self._ended
+        self.transport.closeStdin()
+        return ended
+
+
+class SubscriptionRelay(pb.Referenceable):
+    """
+    Passes the updates of every shard's subscription on to the router's
+    listener, returning its answer so each shard's flow control still
+    waits on the real listener.
+    """
+    def __init__(self, listener, options):
+        self.listener = listener
+        self.options = options # subscribe() keyword arguments
+        self.sids = dict() # shard -> subscription id on that shard
+
+    def remote_update(self, update):
+        return self.listener.callRemote('update', update)
+
+
+class RouterCursor(pb.Referenceable):
+    """
+    A QueryCursor over every shard: each next() is one query_page on the
+    router, carrying the token of the page before.
+    """
+    def __init__(self, router, query, fields, page_size, token, encoded):
+        self._router = router
+        self._args = (query, fields, page_size)
+        self._token = token
+        self._encoded = encoded
+        self.done = False
+
+    def remote_next(self):
+        if self.done:
+            return {'torrents': [], 'token': None}
+        query, fields, page_size = self._args
+        d = self._router.remote_query_page(query, fields, page_size,
+                self._token, self._encoded)
+        def advance(page):
+            self._token = page['token']
+            self.done = self._token is None
+            return page
+        return d.addCallback(advance)
+
+
+class ShardRouter(TimedRoot):
+    """
+    Serves the ClientRemote calls in front of count worker processes, each
+    running its own Session.
+
+    Torrents are placed by rendezvous hashing of their infohash over the
+    shards that are up, and the router learns where every torrent lives
+    from the shards themselves whenever one comes up.  Calls on one torrent
+    go to its shard; queries, batches and snapshots go to every shard (or
+    only those holding the listed infohashes) at once and are merged.  When
+    a shard comes back, torrents that were placed elsewhere while it was
+    down are migrated back to it, at most max_migrations at a time.
+    Every shard spreads its torrents over the same volumes.
+    """
+    def __init__(self, count, state_dir='/tmp', listen_port=23866,
+            listen_ports=10, pb_port=8810, max_migrations=4, volumes=()):
+        self._metrics = MetricsRegistry()
+        TimedRoot.__init__(self, self._metrics)
+        self.workers = dict((shard, WorkerProcess(self, shard,
+                os.path.join(state_dir, 'shard-%d' % shard),
+                listen_port + shard * listen_ports, listen_ports, pb_port + shard,
+                volumes))
+            for shard in xrange(count))
+        self._placement = dict() # infohash -> shard
+        self._subscriptions = dict() # sid -> SubscriptionRelay
+        self._next_sid = 1
+        self._fetcher = TorrentFetcher(os.path.join(state_dir, 'torrent-cache'))
+        self._migrations = defer.DeferredSemaphore(max_migrations)
+        self._migrated = self._metrics.counter('shard_migrations_total',
+                "Torrents moved back to their preferred shard.")
+        self._metrics.gauge('shards_up', "Shard workers connected.",
+                lambda: len(self._live()))
+        self._metrics.gauge('shard_torrents', "Torrents placed on each shard.",
+                self._shard_sizes, label='shard')
+
+    def start(self):
+        for worker in self.workers.itervalues():
+            worker.spawn()
+        self._metrics.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        return defer.DeferredList([w.stop() for w in self.workers.itervalues()])
+
+    def _live(self):
+        return [w for w in self.workers.itervalues() if w.up]
+
+    def _shard_sizes(self):
+        sizes = dict((shard, 0) for shard in self.workers)
+        for shard in self._placement.itervalues():
+            sizes[shard] += 1
+        return sizes
+
+    # placement
+
+    def _preferred(self, infohash, live_only=True):
+        shards = [w.shard for w in self._live()] if live_only else list(self.workers)
+        if not shards:
+            raise RuntimeError("No shards are up")
+        return self.workers[shard_ranking(infohash, shards)[0]]
+
+    def _worker_for(self, infohash):
+        shard = self._placement.get(infohash)
+        if shard is None:
+            raise ValueError("Unknown infohash %s" % infohash)
+        worker = self.workers[shard]
+        if not worker.up:
+            raise RuntimeError("Shard %d is down" % shard)
+        return worker
+
+    def _route(self, infohash, method, *args, **kwargs):
+        try:
+            worker = self._worker_for(infohash)
+        except (ValueError, RuntimeError) as e:
+            return defer.fail(e)
+        return worker.root.callRemote(method, infohash, *args, **kwargs)
+
+    def _spread(self, infohashes):
+        """
+        returns ({worker: [infohash]}, {infohash: error}) for the listed
+        infohashes, or every live worker if infohashes is None.
+        """
+        if infohashes is None:
+            return dict((w, None) for w in self._live()), dict()
+        shares, errors = dict(), dict()
+        for infohash in infohashes:
+            try:
+                shares.setdefault(self._worker_for(infohash), list()).append(infohash)
+            except (ValueError, RuntimeError) as e:
+                errors[infohash] = str(e)
+        return shares, errors
+
+    def _gather(self, shares, method, **kwargs):
+        """
+        calls method on every worker in shares, with its infohashes.
+        returns a Deferred.  callback arg is [(worker, share, ok, result)]
+        """
+        calls = list()
+        for worker, share in shares.iteritems():
+            calls.append(worker.root.callRemote(method, infohashes=share, **kwargs))
+        d = defer.DeferredList(calls, consumeErrors=True)
+        d.addCallback(lambda results: [(worker, share, ok, result)
+            for (worker, share), (ok, result) in zip(shares.iteritems(), results)])
+        return d
+
+    def _gather_all(self, method, *args, **kwargs):
+        """
+        calls method on every shard.  returns a Deferred.  callback arg is
+        {shard: result}; fails with a RuntimeError naming each shard that
+        is down or failed, rather than leave its part out.
+        """
+        down = ["shard %d is down" % shard for shard, worker
+                in sorted(self.workers.iteritems()) if not worker.up]
+        workers = self._live()
+        d = defer.DeferredList([w.root.callRemote(method, *args, **kwargs)
+            for w in workers], consumeErrors=True)
+        def gathered(results):
+            errors = ["shard %d: %s" % (w.shard, result.getErrorMessage())
+                    for w, (ok, result) in zip(workers, results) if not ok]
+            if down or errors:
+                raise RuntimeError('; '.join(errors + down))
+            return dict((w.shard, result) for w, (_, result) in zip(workers, results))
+        return d.addCallback(gathered)
+
+    def _merge(self, gathered, errors):
+        results = dict()
+        for worker, share, ok, result in gathered:
+            if ok:
+                results.update(result['results'])
+                errors.update(result['errors'])
+                continue
+            message = "shard %d: %s" % (worker.shard, result.getErrorMessage())
+            for infohash in share or ('shard %d' % worker.shard, ):
+                errors[infohash] = message
+        return {'results': results, 'errors': errors}
+
+    def worker_up(self, worker):
+        logger.info("shard %d is up" % worker.shard)
+        d = worker.root.callRemote('get_torrents', fields=[])
+        def learn(torrents):
+            for infohash, shard in self._placement.items():
+                if shard == worker.shard:
+                    del self._placement[infohash]
+            for infohash in torrents['results']:
+                self._placement[infohash] = worker.shard
+            for relay in self._subscriptions.itervalues():
+                self._subscribe_shard(relay, worker)
+            self.rebalance(worker)
+        d.addCallback(learn)
+        d.addErrback(lambda reason: logger.error("cannot list shard %d: %s" % (
+            worker.shard, reason.getErrorMessage())))
+
+    def worker_down(self, worker):
+        logger.warning("shard %d is down" % worker.shard)
+        for relay in self._subscriptions.itervalues():
+            relay.sids.pop(worker.shard, None)
+
+    def rebalance(self, worker):
+        """
+        moves torrents that prefer worker, out of all shards, back onto it.
+        returns a Deferred fired with the number moved.
+        """
+        moves = list()
+        for infohash, shard in self._placement.items():
+            if shard == worker.shard or not self.workers[shard].up:
+                continue
+            if self._preferred(infohash, live_only=False) is worker:
+                moves.append(self._migrations.run(self.migrate, infohash, worker))
+        d = defer.DeferredList(moves, consumeErrors=True)
+        d.addCallback(lambda results: sum(1 for ok, _ in results if ok))
+        return d
+
+    def migrate(self, infohash, destination):
+        """
+        exports a torrent from its shard and adds it to destination.  if
+        that fails it is added back where it came from.
+        """
+        try:
+            source = self._worker_for(infohash)
+        except (ValueError, RuntimeError) as e:
+            return defer.fail(e)
+        d = source.root.callRemote('export_torrent', infohash)
+        def add(exported):
+            def moved(_):
+                self._placement[infohash] = destination.shard
+                self._migrated.inc()
+            def put_back(reason):
+                logger.error("cannot move %s to shard %d: %s" % (infohash,
+                    destination.shard, reason.getErrorMessage()))
+                d = source.root.callRemote('add_torrent_data',
+                        exported['torrent'], exported['resume'])
+                d.addCallback(lambda _: reason)
+                return d
+            d = destination.root.callRemote('add_torrent_data',
+                    exported['torrent'], exported['resume'])
+            return d.addCallbacks(moved, put_back)
+        d.addCallback(add)
+        return d
+
+    # adding
+
+    def _add_data(self, body):
+        d = threads.deferToThread(parse_torrent, body)
+        def place(parsed):
+            _, info = parsed
+            infohash = str(info.info_hash())
+            worker = self.workers.get(self._placement.get(infohash))
+            if worker is None or not worker.up:
+                worker = self._preferred(infohash)
+            d = worker.root.callRemote('add_torrent_data', split_chunks(body))
+            def placed(infohash):
+                self._placement[infohash] = worker.shard
+                return infohash
+            return d.addCallback(placed)
+        return d.addCallback(place)
+
+    def remote_add_torrent(self, url):
+        return self._fetcher.fetch(url).addCallback(self._add_data)
+
+    def remote_add_torrent_data(self, torrent, resume=None):
+        if resume:
+            return defer.fail(ValueError(
+                "The router places torrents itself; add resume data on a shard"))
+        return self._add_data(''.join(torrent))
+
+    def remote_add_torrents(self, urls):
+        def aggregate(results):
+            summary = list()
+            for url, (ok, result) in zip(urls, results):
+                if ok:
+                    summary.append({'url': url, 'infohash': result})
+                else:
+                    summary.append({'url': url, 'error': result.getErrorMessage()})
+            return summary
+        d = defer.DeferredList(map(self.remote_add_torrent, urls), consumeErrors=True)
+        return d.addCallback(aggregate)
+
+    # one torrent
+
+    def remote_pause_torrent(self, infohash):
+        return self._route(infohash, 'pause_torrent')
+
+    def remote_resume_torrent(self, infohash):
+        return self._route(infohash, 'resume_torrent')
+
+    def remote_remove_torrent(self, infohash, delete_files=False):
+        def removed(result):
+            self._placement.pop(infohash, None)
+            return result
+        return self._route(infohash, 'remove_torrent', delete_files).addCallback(removed)
+
+    def remote_get_torrent_info(self, infohash):
+        return self._route(infohash, 'get_torrent_info')
+
+    def remote_get_torrent_metainfo(self, infohash):
+        return self._route(infohash, 'get_torrent_metainfo')
+
+    def remote_get_torrent_name(self, infohash):
+        return self._route(infohash, 'get_torrent_name')
+
+    # many torrents
+
+    def _batch(self, method, infohashes=None, query=None, fields=None):
+        shares, errors = self._spread(infohashes)
+        d = self._gather(shares, method, query=query, fields=fields)
+        d.addCallback(self._merge, errors)
+        return d
+
+    def remote_pause_torrents(self, infohashes=None, query=None, fields=None):
+        return self._batch('pause_torrents', infohashes, query, fields)
+
+    def remote_resume_torrents(self, infohashes=None, query=None, fields=None):
+        return self._batch('resume_torrents', infohashes, query, fields)
+
+    def remote_remove_torrents(self, infohashes=None, query=None, fields=None):
+        def removed(batch):
+            for infohash in batch['results']:
+                self._placement.pop(infohash, None)
+            return batch
+        return self._batch('remove_torrents', infohashes, query, fields).addCallback(removed)
+
+    def remote_get_torrents(self, infohashes=None, query=None, fields=None):
+        return self._batch('get_torrents', infohashes, query, fields)
+
+    def remote_get_torrent_columns(self, infohashes=None, query=None,
+            fields=None, encoded=True):
+        shares, errors = self._spread(infohashes)
+        d = self._gather(shares, 'get_torrent_columns', query=query, fields=fields)
+        def merge(gathered):
+            merged = TorrentColumns(fields)
+            merged.errors.update(errors)
+            for worker, share, ok, result in gathered:
+                if ok:
+                    merged.extend(TorrentColumns.decode(''.join(result)))
+                    continue
+                message = "shard %d: %s" % (worker.shard, result.getErrorMessage())
+                for infohash in share or ('shard %d' % worker.shard, ):
+                    merged.errors[infohash] = message
+            return merged.encode_chunks() if encoded else merged.to_dict()
+        return d.addCallback(merge)
+
+    def remote_find_torrent(self, regexp):
+        def merge(found):
+            torrents = dict()
+            for result in found.itervalues():
+                torrents.update(result)
+            return torrents
+        return self._gather_all('find_torrent', regexp).addCallback(merge)
+
+    def remote_query_page(self, query=None, fields=None, page_size=100,
+            token=None, encoded=False):
+        """
+        asks every shard for a page past the same infohash and keeps the
+        lowest page_size infohashes, so pages come in one global order.
+        """
+        if token is not None:
+            try:
+                query, fields, after = decode_token(token)
+            except ValueError as e:
+                return defer.fail(e)
+        page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        d = self._gather_all('query_page', query, fields, page_size, token)
+        def merge(pages):
+            rows = sorted(row for page in pages.itervalues() for row in page['torrents'])
+            more = len(rows) > page_size or any(
+                    page['token'] is not None for page in pages.itervalues())
+            rows = rows[:page_size]
+            next_token = None
+            if more and rows:
+                next_token = encode_token(query, fields, rows[-1][0])
+            if encoded:
+                columns = TorrentColumns(fields)
+                for infohash, record in rows:
+                    columns.append(infohash, record)
+                rows = columns.encode()
+            return {'torrents': rows, 'token': next_token}
+        return d.addCallback(merge)
+
+    def remote_open_query(self, query=None, fields=None, page_size=100,
+            token=None, encoded=False):
+        return RouterCursor(self, query, fields, page_size, token, encoded)
+
+    def remote_get_torrent_state_since(self, versions=None):
+        """
+        versions is {shard: version} as last returned; returns {shard:
+        changes}, see StatusCache.changed_since.
+        """
+        versions = versions or dict()
+        workers = self._live()
+        d = defer.DeferredList([w.root.callRemote('get_torrent_state_since',
+            versions.get(w.shard, 0)) for w in workers], consumeErrors=True)
+        d.addCallback(lambda results: dict((w.shard, result)
+            for w, (ok, result) in zip(workers, results) if ok))
+        return d
+
+    # subscriptions
+
+    def _subscribe_shard(self, relay, worker):
+        d = worker.root.callRemote('subscribe', relay, **relay.options)
+        def subscribed(sid):
+            relay.sids[worker.shard] = sid
+        d.addCallback(subscribed)
+        d.addErrback(lambda reason: logger.error("cannot subscribe on shard %d: %s" % (
+            worker.shard, reason.getErrorMessage())))
+        return d
+
+    def remote_subscribe(self, listener, infohashes=None, query=None,
+            max_rate=1.0, fields=None):
+        relay = SubscriptionRelay(listener, {'infohashes': infohashes,
+            'query': query, 'max_rate': max_rate, 'fields': fields})
+        sid = self._next_sid
+        self._next_sid += 1
+        self._subscriptions[sid] = relay
+        listener.notifyOnDisconnect(lambda _: self.remote_unsubscribe(sid))
+        d = defer.DeferredList([self._subscribe_shard(relay, w) for w in self._live()])
+        return d.addCallback(lambda _: sid)
+
+    def remote_unsubscribe(self, sid):
+        relay = self._subscriptions.pop(sid, None)
+        if relay is None:
+            return
+        for shard, shard_sid in relay.sids.items():
+            worker = self.workers[shard]
+            if worker.up:
+                worker.root.callRemote('unsubscribe', shard_sid)
+
+    # introspection
+
+    def remote_shards(self):
+        sizes = self._shard_sizes()
+        return dict((shard, {
+                'up': worker.up,
+                'pid': worker.pid,
+                'restarts': worker.restarts,
+                'torrents': sizes[shard],
+            }) for shard, worker in self.workers.iteritems())
+
+    def remote_metrics(self):
+        d = self._gather_all('metrics')
+        return d.addCallback(lambda shards: {
+            'router': self._metrics.snapshot(), 'shards': shards})
+
+    def remote_alert_journal(self, infohash=None, since=None, until=None,
+            types=None, limit=100):
+        if infohash is not None:
+            return self._route(infohash, 'alert_journal', since=since,
+                    until=until, types=types, limit=limit)
+        d = self._gather_all('alert_journal', since=since, until=until,
+                types=types, limit=limit)
+        def merge(journals):
+            records = [r for journal in journals.itervalues() for r in journal]
+            records.sort(key=lambda r: r['time'])
+            return records[-limit:] if limit else records
+        return d.addCallback(merge)
+
+    def remote_restore_progress(self):
+        return self._gather_all('restore_progress')
+
+    def remote_storage(self):
+        return self._gather_all('storage')
+
+    def remote_move_storage(self, infohash, path):
+        return self._route(infohash, 'move_storage', path)
+
+    def remote_peer_summary(self, count=20, torrent_count=None):
+        d = self._gather_all('peer_summary', None, torrent_count or count)
+        return d.addCallback(lambda shards: merge_summaries(shards.values(),
+            count, torrent_count))
+
+    def remote_torrent_peers(self, infohash):
+        return self._route(infohash, 'torrent_peers')
+
+    # queueing; limits apply to each shard
+
+    def remote_queue(self):
+        return self._gather_all('queue')
+
+    def remote_set_queue_override(self, infohash, mode):
+        return self._route(infohash, 'set_queue_override', mode)
+
+    def remote_set_queue_limits(self, max_downloads=None, max_seeds=None):
+        return self._gather_all('set_queue_limits', max_downloads, max_seeds)
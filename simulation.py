@@ -0,0 +1,591 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+An in-process stand-in for the part of the libtorrent bindings rarity
+uses, for benchmarks: sessions, handles, statuses, torrent_info, the alert
+classes and bencoding.  Torrents never touch the network or the disk; a
+simulated torrent only holds the progress, rates and flags it reports.
+
+install() has to run before any rarity module imports libtorrent.
+"""
+import sys
+import time
+import random
+import hashlib
+import threading
+import collections
+
+def install():
+    """
+    makes "import libtorrent" return this module.
+    """
+    loaded = sys.modules.get('libtorrent')
+    if loaded is not None and loaded is not sys.modules[__name__]:
+        raise RuntimeError("libtorrent is already imported")
+    sys.modules['libtorrent'] = sys.modules[__name__]
+
+
+def _encode(value, out):
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, (int, long)):
+        out.append('i%de' % value)
+    elif isinstance(value, unicode):
+        _encode(value.encode('utf-8'), out)
+    elif isinstance(value, str):
+        out.append('%d:' % len(value))
+        out.append(value)
+    elif isinstance(value, (list, tuple)):
+        out.append('l')
+        for item in value:
+            _encode(item, out)
+        out.append('e')
+    elif isinstance(value, dict):
+        out.append('d')
+        for key in sorted(value):
+            _encode(str(key), out)
+            _encode(value[key], out)
+        out.append('e')
+    else:
+        raise TypeError("Cannot bencode %r" % type(value))
+
+def bencode(value):
+    out = list()
+    _encode(value, out)
+    return ''.join(out)
+
+def _decode(buf, i):
+    kind = buf[i]
+    if kind == 'i':
+        end = buf.index('e', i)
+        return int(buf[i + 1:end]), end + 1
+    if kind == 'l':
+        items, i = list(), i + 1
+        while buf[i] != 'e':
+            item, i = _decode(buf, i)
+            items.append(item)
+        return items, i + 1
+    if kind == 'd':
+        items, i = dict(), i + 1
+        while buf[i] != 'e':
+            key, i = _decode(buf, i)
+            items[key], i = _decode(buf, i)
+        return items, i + 1
+    colon = buf.index(':', i)
+    end = colon + 1 + int(buf[i:colon])
+    if end > len(buf):
+        raise ValueError("truncated string")
+    return buf[colon + 1:end], end
+
+def bdecode(buf):
+    """
+    returns the decoded value, or None if buf is not bencoded, as the
+    bindings do.
+    """
+    try:
+        value, end = _decode(buf, 0)
+    except (IndexError, ValueError):
+        return None
+    return value if end == len(buf) else None
+
+
+class big_number(object):
+    def __init__(self, digest):
+        self._digest = digest
+
+    def to_bytes(self):
+        return self._digest
+
+    def __str__(self):
+        return self._digest.encode('hex')
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._digest)
+
+
+class options_t(object):
+    delete_files = 1
+
+class storage_mode_t(object):
+    storage_mode_allocate = 0
+    storage_mode_sparse = 1
+
+class deadline_flags(object):
+    alert_when_available = 1
+
+class _category_t(object):
+    error_notification = 0x1
+    peer_notification = 0x2
+    port_mapping_notification = 0x4
+    storage_notification = 0x8
+    tracker_notification = 0x10
+    debug_notification = 0x20
+    status_notification = 0x40
+    progress_notification = 0x80
+    ip_block_notification = 0x100
+    performance_warning = 0x200
+    dht_notification = 0x400
+    stats_notification = 0x800
+    all_categories = 0x7fffffff
+
+
+class alert(object):
+    category_t = _category_t
+    _category = _category_t.status_notification
+
+    def __init__(self):
+        self.posted = time.time()
+
+    def what(self):
+        return type(self).__name__[:-len('_alert')]
+
+    def message(self):
+        return self.what()
+
+    def category(self):
+        return self._category
+
+
+class torrent_alert(alert):
+    def __init__(self, handle):
+        alert.__init__(self)
+        self.handle = handle
+
+    def message(self):
+        return "%s %s" % (self.handle.name(), self.what())
+
+class torrent_added_alert(torrent_alert): pass
+class torrent_removed_alert(torrent_alert):
+    def __init__(self, handle):
+        torrent_alert.__init__(self, handle)
+        self.info_hash = handle.info_hash()
+class torrent_deleted_alert(torrent_removed_alert):
+    _category = _category_t.storage_notification
+class torrent_paused_alert(torrent_alert): pass
+class torrent_resumed_alert(torrent_alert): pass
+class torrent_finished_alert(torrent_alert): pass
+class torrent_error_alert(torrent_alert):
+    _category = _category_t.error_notification
+class metadata_received_alert(torrent_alert): pass
+class state_changed_alert(torrent_alert): pass
+class save_resume_data_alert(torrent_alert):
+    _category = _category_t.storage_notification
+    def __init__(self, handle, resume_data):
+        torrent_alert.__init__(self, handle)
+        self.resume_data = resume_data
+class save_resume_data_failed_alert(torrent_alert):
+    _category = _category_t.storage_notification | _category_t.error_notification
+class storage_moved_alert(torrent_alert):
+    _category = _category_t.storage_notification
+class storage_moved_failed_alert(torrent_alert):
+    _category = _category_t.storage_notification | _category_t.error_notification
+class piece_finished_alert(torrent_alert):
+    _category = _category_t.progress_notification
+    def __init__(self, handle, piece_index):
+        torrent_alert.__init__(self, handle)
+        self.piece_index = piece_index
+class read_piece_alert(torrent_alert):
+    _category = _category_t.storage_notification
+    def __init__(self, handle, piece, buffer):
+        torrent_alert.__init__(self, handle)
+        self.piece = piece
+        self.buffer = buffer
+        self.size = len(buffer)
+class state_update_alert(alert):
+    def __init__(self, status):
+        alert.__init__(self)
+        self.status = status
+
+
+class file_entry(object):
+    def __init__(self, path, size, offset):
+        self.path = path
+        self.size = size
+        self.offset = offset
+
+
+class torrent_info(object):
+    def __init__(self, entry):
+        info = entry['info']
+        self._entry = entry
+        self._name = info['name']
+        self._piece_length = info['piece length']
+        self._pieces = len(info['pieces']) // 20
+        self._private = bool(info.get('private'))
+        if 'files' in info:
+            sizes = [(f['path'], f['length']) for f in info['files']]
+        else:
+            sizes = [([self._name], info['length'])]
+        self._files, offset = list(), 0
+        for path, size in sizes:
+            self._files.append(file_entry('/'.join(path), size, offset))
+            offset += size
+        self._info_hash = big_number(hashlib.sha1(bencode(info)).digest())
+
+    def name(self):
+        return self._name
+
+    def info_hash(self):
+        return self._info_hash
+
+    def num_pieces(self):
+        return self._pieces
+
+    def piece_length(self):
+        return self._piece_length
+
+    def total_size(self):
+        return sum(f.size for f in self._files)
+
+    def priv(self):
+        return self._private
+
+    def files(self):
+        return list(self._files)
+
+
+class create_torrent(object):
+    def __init__(self, info):
+        self._info = info
+
+    def generate(self):
+        return self._info._entry
+
+
+class torrent_status(object):
+    def __init__(self, handle):
+        self.handle = handle
+        self.info_hash = handle.info_hash()
+        self.name = handle.name()
+        self.paused = handle._paused
+        self.auto_managed = handle._auto_managed
+        self.progress = handle._progress
+        self.upload_rate = handle._upload_rate
+        self.download_rate = handle._download_rate
+        self.is_seeding = handle._progress >= 1.0
+        self.save_path = handle._save_path
+
+
+class peer_info(object):
+    def __init__(self, ip, client, country, down_speed, up_speed, progress):
+        self.ip = ip
+        self.client = client
+        self.country = country
+        self.down_speed = down_speed
+        self.up_speed = up_speed
+        self.payload_down_speed = down_speed
+        self.payload_up_speed = up_speed
+        self.progress = progress
+
+PEER_CLIENTS = ('libtorrent 0.16.13.0', 'uTorrent 3.3.2', 'Transmission 2.82',
+        'Deluge 1.3.6', 'Vuze 5.2.0.0', 'qBittorrent 3.1.9')
+PEER_COUNTRIES = ('US', 'DE', 'FR', 'GB', 'NL', 'SE', 'CA', 'RU', 'BR', 'JP')
+
+def make_peers(seed, count):
+    """
+    count synthetic peers; the same seed gives the same addresses.
+    """
+    rand = random.Random(seed)
+    return [peer_info(('10.%d.%d.%d' % (rand.randrange(256), rand.randrange(256),
+                rand.randrange(256)), rand.randrange(1024, 65536)),
+            rand.choice(PEER_CLIENTS), rand.choice(PEER_COUNTRIES),
+            rand.randrange(1 << 18), rand.randrange(1 << 16), rand.random())
+            for _ in xrange(count)]
+
+
+class torrent_handle(object):
+    def __init__(self, ses, info, save_path, paused=False, auto_managed=True):
+        self._ses = ses
+        self._info = info
+        self._valid = True
+        self._save_path = save_path
+        self._paused = paused
+        self._auto_managed = auto_managed
+        self._progress = 0.0
+        self._upload_rate = 0
+        self._download_rate = 0
+        self._have = set()
+        self._deadlines = dict()
+        self.sequential_download = False
+
+    def _changed(self):
+        self._ses._dirty.add(self)
+
+    def info_hash(self):
+        return self._info.info_hash()
+
+    def name(self):
+        return self._info.name()
+
+    def is_valid(self):
+        return self._valid
+
+    def has_metadata(self):
+        return True
+
+    def get_torrent_info(self):
+        return self._info
+
+    def status(self):
+        return torrent_status(self)
+
+    def is_paused(self):
+        return self._paused
+
+    def save_path(self):
+        return self._save_path
+
+    def pause(self):
+        if not self._paused:
+            self._paused = True
+            self._changed()
+            self._ses._post(torrent_paused_alert(self))
+
+    def resume(self):
+        if self._paused:
+            self._paused = False
+            self._changed()
+            self._ses._post(torrent_resumed_alert(self))
+
+    def auto_managed(self, value):
+        self._auto_managed = value
+
+    def save_resume_data(self, flags=0):
+        self._ses._post(save_resume_data_alert(self, {
+                'file-format': 'libtorrent resume file',
+                'info-hash': self.info_hash().to_bytes(),
+                'save_path': self._save_path,
+                'paused': int(self._paused),
+                'pieces': ''.join(chr(p in self._have)
+                    for p in xrange(self._info.num_pieces())),
+            }))
+
+    def move_storage(self, path, flags=0):
+        self._save_path = path
+        self._ses._post(storage_moved_alert(self))
+
+    def set_sequential_download(self, value):
+        self.sequential_download = value
+
+    def file_priority(self, index, priority):
+        pass
+
+    def get_peer_info(self):
+        if self._paused:
+            return []
+        seed = self.info_hash().to_bytes()
+        return make_peers(seed, ord(seed[0]) % 40)
+
+    def have_piece(self, piece):
+        return piece in self._have
+
+    def read_piece(self, piece):
+        self._ses._post(read_piece_alert(self, piece,
+                '\0' * self._info.piece_length()))
+
+    def set_piece_deadline(self, piece, deadline, flags=0):
+        self._deadlines[piece] = deadline
+        if flags & deadline_flags.alert_when_available:
+            self.download_piece(piece)
+            self.read_piece(piece)
+
+    def reset_piece_deadline(self, piece):
+        self._deadlines.pop(piece, None)
+
+    def download_piece(self, piece):
+        """
+        marks piece as downloaded, as if the swarm had sent it.
+        """
+        if piece not in self._have:
+            self._have.add(piece)
+            self._progress = len(self._have) / float(self._info.num_pieces())
+            self._changed()
+            self._ses._post(piece_finished_alert(self, piece))
+            if len(self._have) == self._info.num_pieces():
+                self._ses._post(torrent_finished_alert(self))
+
+
+class session(object):
+    """
+    Holds simulated torrents and an alert queue that drops alerts past
+    alert_queue_size, as libtorrent does.
+    """
+    def __init__(self, *args, **kwargs):
+        self._torrents = collections.OrderedDict() # infohash -> torrent_handle
+        self._alerts = collections.deque()
+        self._lock = threading.Condition()
+        self._dirty = set()
+        self._mask = 0
+        self.alert_queue_size = 100000
+        self.dropped_alerts = 0
+        self.posted_alerts = 0
+
+    def _post(self, alert):
+        with self._lock:
+            if len(self._alerts) >= self.alert_queue_size:
+                self.dropped_alerts += 1
+                return
+            self._alerts.append(alert)
+            self.posted_alerts += 1
+            self._lock.notify()
+
+    def set_alert_mask(self, mask):
+        self._mask = mask
+
+    def wait_for_alert(self, timeout_ms):
+        with self._lock:
+            if not self._alerts:
+                self._lock.wait(timeout_ms / 1000.0)
+            return self._alerts[0] if self._alerts else None
+
+    def pop_alert(self):
+        with self._lock:
+            return self._alerts.popleft() if self._alerts else None
+
+    def pop_alerts(self):
+        with self._lock:
+            alerts = list(self._alerts)
+            self._alerts.clear()
+            return alerts
+
+    def post_torrent_updates(self):
+        dirty, self._dirty = self._dirty, set()
+        statuses = [h.status() for h in dirty if h._valid]
+        if statuses:
+            self._post(state_update_alert(statuses))
+
+    def add_torrent(self, params):
+        info = params['ti']
+        infohash = str(info.info_hash())
+        if infohash in self._torrents:
+            raise RuntimeError("torrent already exists in session")
+        handle = self._torrents[infohash] = torrent_handle(self, info,
+                params.get('save_path', '.'), params.get('paused', False),
+                params.get('auto_managed', True))
+        self._post(torrent_added_alert(handle))
+        return handle
+
+    def remove_torrent(self, handle, option=0):
+        self._torrents.pop(str(handle.info_hash()), None)
+        handle._valid = False
+        self._post(torrent_removed_alert(handle))
+        if option & options_t.delete_files:
+            self._post(torrent_deleted_alert(handle))
+
+    def find_torrent(self, infohash):
+        handle = self._torrents.get(str(infohash))
+        if handle is None:
+            handle = torrent_handle(self, None, None)
+            handle._valid = False
+        return handle
+
+    def get_torrents(self):
+        return self._torrents.values()
+
+    def pause(self):
+        for handle in self._torrents.itervalues():
+            handle.pause()
+
+    def listen_on(self, low, high):
+        pass
+
+    def add_dht_router(self, host, port):
+        pass
+
+    def load_country_db(self, path):
+        pass
+
+    def start_lsd(self):
+        pass
+
+    def start_dht(self, state=None):
+        pass
+
+    def dht_state(self):
+        return {'nodes': []}
+
+
+def make_torrent(number, pieces=16, piece_length=16384, private=False):
+    """
+    returns the bdecoded entry of synthetic torrent number; each number
+    gives a different infohash.
+    """
+    info = {
+            'name': 'synthetic torrent %06d' % number,
+            'piece length': piece_length,
+            'pieces': hashlib.sha1(str(number)).digest() * pieces,
+            'length': pieces * piece_length,
+        }
+    if private:
+        info['private'] = 1
+    return {'info': info}
+
+
+STORM_ALERTS = (state_changed_alert, piece_finished_alert, torrent_finished_alert,
+        torrent_error_alert)
+
+class AlertStorm(object):
+    """
+    Posts alerts for random torrents of a session from a thread, at rate
+    alerts per second (as fast as possible when rate is None), until count
+    have been posted.  Alerts carry their post time in alert.posted.
+    """
+    def __init__(self, ses, count, rate=None, kinds=STORM_ALERTS, seed=0):
+        self._ses = ses
+        self.count = count
+        self.rate = rate
+        self.kinds = kinds
+        self._random = random.Random(seed)
+        self._thread = None
+        self.posted = 0
+
+    def _make(self, handle):
+        kind = self._random.choice(self.kinds)
+        if kind is piece_finished_alert:
+            alert = kind(handle, self._random.randrange(handle._info.num_pieces()))
+        else:
+            alert = kind(handle)
+        alert.storm = self
+        return alert
+
+    def _run(self):
+        handles = self._ses.get_torrents()
+        started = time.time()
+        for i in xrange(self.count):
+            if self.rate is not None:
+                delay = started + float(i) / self.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self._ses._post(self._make(self._random.choice(handles)))
+            self.posted += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='AlertStorm')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
@@ -0,0 +1,120 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import collections
+
+from rarity.utils import serialize_status
+
+def status_infohash(status):
+    infohash = getattr(status, 'info_hash', None)
+    if infohash is None:
+        infohash = status.handle.info_hash()
+    return str(infohash)
+
+
+class StatusCache(object):
+    """
+    Serialized torrent status, keyed by infohash and versioned.
+
+    Entries are kept in the order they last changed, so changed_since only
+    walks the entries newer than the version asked for.  Removals leave a
+    tombstone so delta readers learn about them too.
+    """
+    def __init__(self, max_tombstones=4096):
+        self.version = 0
+        self._entries = collections.OrderedDict() # infohash -> (version, status)
+        self._tombstones = collections.OrderedDict() # infohash -> version
+        self.max_tombstones = max_tombstones
+        self._forgotten = 0 # newest version of a dropped tombstone
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, infohash):
+        return infohash in self._entries
+
+    def _put(self, infohash, serialized):
+        self._entries.pop(infohash, None)
+        self._tombstones.pop(infohash, None)
+        self._entries[infohash] = (self.version, serialized)
+
+    def update(self, statuses):
+        """
+        takes libtorrent.torrent_status objects, as carried by a
+        state_update_alert.  returns the new version.
+        """
+        self.version += 1
+        for status in statuses:
+            self._put(status_infohash(status), serialize_status(status))
+        return self.version
+
+    def set(self, infohash, serialized):
+        self.version += 1
+        self._put(infohash, serialized)
+        return serialized
+
+    def patch(self, infohash, **fields):
+        """
+        updates some fields of a cached entry ahead of the next
+        post_torrent_updates, e.g. 'paused' right after a paused alert.
+        """
+        status = self.get(infohash)
+        if status is not None:
+            status = dict(status)
+            status.update(fields)
+            self.set(infohash, status)
+
+    def remove(self, infohash):
+        if self._entries.pop(infohash, None) is None:
+            return
+        self.version += 1
+        self._tombstones[infohash] = self.version
+        while len(self._tombstones) > self.max_tombstones:
+            _, self._forgotten = self._tombstones.popitem(last=False)
+
+    def get(self, infohash, default=None):
+        entry = self._entries.get(infohash)
+        return default if entry is None else entry[1]
+
+    def snapshot(self):
+        return dict((ih, status) for ih, (_, status) in self._entries.iteritems())
+
+    def changed_since(self, version):
+        """
+        returns {'version', 'changed', 'removed', 'complete'}.  complete is
+        False when tombstones newer than version were dropped and the reader
+        should fall back to a full snapshot.
+        """
+        changed = dict()
+        for infohash in reversed(self._entries):
+            entry_version, status = self._entries[infohash]
+            if entry_version <= version:
+                break
+            changed[infohash] = status
+        removed = list()
+        for infohash in reversed(self._tombstones):
+            if self._tombstones[infohash] <= version:
+                break
+            removed.append(infohash)
+        return {
+                'version': self.version,
+                'changed': changed,
+                'removed': removed,
+                'complete': version >= self._forgotten,
+            }
@@ -0,0 +1,341 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import os
+import time
+import logging
+
+import libtorrent
+from twisted.internet import defer, task
+
+logger = logging.getLogger('ClientCore')
+
+STORAGE_MODES = {
+        'sparse': libtorrent.storage_mode_t.storage_mode_sparse,
+        'allocate': libtorrent.storage_mode_t.storage_mode_allocate,
+    }
+LOAD_STEP = 1 << 20 # loads within 1MB/s of each other count as equal
+
+def disk_usage(path):
+    """
+    returns (free bytes, total bytes) of the filesystem holding path.
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize, st.f_blocks * st.f_frsize
+
+
+def parse_volumes(specs):
+    """
+    specs are 'path' or 'path:mode' strings; returns the Volumes.
+    """
+    volumes = list()
+    for spec in specs:
+        path, _, mode = spec.partition(':')
+        volumes.append(Volume(path, mode or 'sparse'))
+    return volumes
+
+
+class Volume(object):
+    """
+    A directory torrents can be saved in.  reserve bytes are kept free;
+    weight scales how much I/O the volume is expected to take, e.g. by its
+    number of spindles.
+    """
+    def __init__(self, path, mode='sparse', reserve=0, weight=1.0, usage=disk_usage):
+        if mode not in STORAGE_MODES:
+            raise ValueError("Unknown storage mode %r" % (mode, ))
+        self.path = path
+        self.mode = mode
+        self.reserve = reserve
+        self.weight = weight
+        self._usage = usage
+        self._checked = 0
+        self._free = self._total = 0
+        self.torrents = dict() # infohash -> expected size
+
+    @property
+    def storage_mode(self):
+        return STORAGE_MODES[self.mode]
+
+    def usage(self, max_age=5):
+        """
+        (free, total) bytes, statted at most every max_age seconds.
+        """
+        now = time.time()
+        if now - self._checked > max_age:
+            self._free, self._total = self._usage(self.path)
+            self._checked = now
+        return self._free, self._total
+
+    def holds(self, save_path):
+        path = os.path.normpath(save_path)
+        return path == os.path.normpath(self.path) or path.startswith(
+                os.path.normpath(self.path) + os.sep)
+
+
+class StoragePlacer(object):
+    """
+    Chooses a Volume for each new torrent and moves torrents between
+    volumes in the background.
+
+    A torrent goes to the volume with the least I/O load per weight, as
+    the sum of the up and down rates of its torrents in the status cache,
+    among those with room for it; equal loads go to the volume with the
+    most room.  Room is free space less the reserve and less what torrents
+    already placed on sparse volumes have yet to write.  Both sums are
+    redone at most every few seconds, so placing many torrents at once
+    does not walk every volume's torrents for each of them.
+
+    Every interval the rebalancer compares how full the volumes are and
+    moves the largest torrent that fits in half the gap from the fullest
+    volume more than threshold ahead of the emptiest, with move_storage.
+    One move runs at a time and moves stop once max_bytes_per_hour have
+    been moved in the last hour.
+    """
+    def __init__(self, session, volumes, interval=60, threshold=0.1,
+            max_bytes_per_hour=200 << 30, move_timeout=6 * 3600):
+        self._session = session
+        self.volumes = list(volumes)
+        self.interval = interval
+        self.threshold = threshold
+        self.max_bytes_per_hour = max_bytes_per_hour
+        self.move_timeout = move_timeout
+        self._loop = task.LoopingCall(self._tick)
+        self._moves = list() # (finished at, bytes) in the last hour
+        self._totals_cache = dict() # Volume -> [summed at, remaining, load]
+        self.moving = None
+        self.moved = 0
+        self.failed = 0
+
+    def start(self):
+        if len(self.volumes) > 1 and not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def volume_of(self, infohash):
+        for volume in self.volumes:
+            if infohash in volume.torrents:
+                return volume
+        return None
+
+    def _find_volume(self, path):
+        for volume in self.volumes:
+            if volume.holds(path):
+                return volume
+        raise ValueError("No volume at %s" % path)
+
+    def _totals(self, volume, max_age=5):
+        """
+        (bytes its sparse torrents have yet to write, I/O load) of a
+        volume, summed over its torrents at most every max_age seconds.
+        """
+        now = time.time()
+        totals = self._totals_cache.get(volume)
+        if totals is None or now - totals[0] > max_age:
+            remaining = load = 0
+            for infohash, size in volume.torrents.iteritems():
+                status = self._session._status_cache.get(infohash)
+                if status is None:
+                    remaining += size
+                    continue
+                remaining += size * (1 - status['progress'])
+                if not status['paused']:
+                    load += status['upload_rate'] + status['download_rate']
+            if volume.mode == 'allocate':
+                remaining = 0 # written out in full when added
+            totals = self._totals_cache[volume] = [now, remaining, load]
+        return totals[1], totals[2]
+
+    def _remaining(self, volume):
+        return self._totals(volume)[0]
+
+    def room(self, volume):
+        free, _ = volume.usage()
+        return free - volume.reserve - self._remaining(volume)
+
+    def load(self, volume):
+        return self._totals(volume)[1]
+
+    def fullness(self, volume):
+        free, total = volume.usage()
+        if not total:
+            return 1.0
+        return 1 - (free - self._remaining(volume)) / float(total)
+
+    def place(self, infohash, size):
+        """
+        returns the Volume a new torrent of size bytes should be saved on,
+        and records it there.
+        """
+        candidates = list()
+        for volume in self.volumes:
+            room = self.room(volume)
+            if room >= size:
+                candidates.append((int(self.load(volume) / volume.weight / LOAD_STEP),
+                    -room, volume))
+        if not candidates:
+            raise RuntimeError("No volume has room for %d bytes" % size)
+        volume = min(candidates, key=lambda c: c[:2])[2]
+        volume.torrents[infohash] = size
+        if volume.mode != 'allocate':
+            self._totals_cache[volume][1] += size
+        return volume
+
+    def track(self, infohash, save_path, size):
+        """
+        records a torrent added with its own save_path.  returns its Volume,
+        or None if save_path is on none of them.
+        """
+        for volume in self.volumes:
+            if volume.holds(save_path):
+                volume.torrents[infohash] = size
+                return volume
+        return None
+
+    def discard(self, infohash):
+        for volume in self.volumes:
+            volume.torrents.pop(infohash, None)
+
+    def untrack(self, volume, infohash):
+        """
+        undoes the place() or track() that put infohash on volume.
+        """
+        size = volume.torrents.pop(infohash, None)
+        totals = self._totals_cache.get(volume)
+        if size is not None and totals is not None and volume.mode != 'allocate':
+            totals[1] -= size
+
+    def _tick(self):
+        d = self.rebalance()
+        if d is not None:
+            d.addErrback(lambda _: None) # logged by move()
+
+    def _budget(self):
+        cutoff = time.time() - 3600
+        self._moves = [m for m in self._moves if m[0] > cutoff]
+        return self.max_bytes_per_hour - sum(size for _, size in self._moves)
+
+    def rebalance(self):
+        """
+        starts at most one move.  returns its Deferred, or None.
+        """
+        if self.moving is not None or len(self.volumes) < 2:
+            return None
+        ranked = sorted(self.volumes, key=self.fullness)
+        emptiest = ranked[0]
+        budget = min(self.room(emptiest), self._budget())
+        for source in reversed(ranked[1:]):
+            gap = self.fullness(source) - self.fullness(emptiest)
+            if gap <= self.threshold:
+                break
+            _, total = source.usage()
+            target = min(gap / 2 * total, budget)
+            fitting = [(size, infohash) for infohash, size in source.torrents.iteritems()
+                    if size <= target]
+            if fitting:
+                size, infohash = max(fitting)
+                return self.move(infohash, emptiest.path)
+        return None
+
+    def move(self, infohash, path):
+        """
+        moves a torrent's files to the volume at path, if it has room for
+        them as place() reckons it.  returns a Deferred fired with the
+        storage_moved_alert.
+        """
+        if self.moving is not None:
+            return defer.fail(RuntimeError("Already moving %s" % self.moving['infohash']))
+        try:
+            destination = self._find_volume(path)
+            handle = self._session._find_valid_handle(infohash)
+        except ValueError as e:
+            return defer.fail(e)
+        source = self.volume_of(infohash)
+        if source is destination:
+            return defer.fail(ValueError("%s is already on %s" % (infohash, path)))
+        if source is not None:
+            size = source.torrents[infohash]
+        elif handle.has_metadata():
+            size = handle.get_torrent_info().total_size()
+        else:
+            size = 0
+        room = self.room(destination)
+        if room < size:
+            return defer.fail(RuntimeError("%s has room for %d bytes, %s needs %d" % (
+                destination.path, max(room, 0), infohash, size)))
+        self.moving = {
+                'infohash': infohash,
+                'from': source.path if source is not None else None,
+                'to': destination.path,
+                'size': size,
+                'started': time.time(),
+            }
+        d = self._session._add_indexed_deferred(infohash, (libtorrent.storage_moved_alert,
+            libtorrent.storage_moved_failed_alert), expire_after=self.move_timeout)
+        handle.move_storage(destination.path)
+        def finished(alert):
+            self.moving = None
+            if isinstance(alert, libtorrent.storage_moved_failed_alert):
+                raise RuntimeError(alert.message())
+            if source is not None:
+                source.torrents.pop(infohash, None)
+            destination.torrents[infohash] = size
+            # the stored resume data still names the old save_path
+            self._session._checkpoints.request(infohash).addErrback(lambda _: None)
+            self._moves.append((time.time(), size))
+            self.moved += 1
+            logger.info("moved %s to %s" % (infohash, destination.path))
+            return alert
+        def failed(reason):
+            self.moving = None
+            self.failed += 1
+            logger.error("cannot move %s to %s: %s" % (infohash, destination.path,
+                reason.getErrorMessage()))
+            return reason
+        d.addCallback(finished)
+        d.addErrback(failed)
+        return d
+
+    def state(self):
+        volumes = list()
+        for volume in self.volumes:
+            free, total = volume.usage()
+            volumes.append({
+                'path': volume.path,
+                'mode': volume.mode,
+                'free': free,
+                'total': total,
+                'room': self.room(volume),
+                'fullness': self.fullness(volume),
+                'load': self.load(volume),
+                'torrents': len(volume.torrents),
+            })
+        moving = None
+        if self.moving is not None:
+            moving = dict(self.moving, seconds=time.time() - self.moving['started'])
+        return {
+                'volumes': volumes,
+                'moving': moving,
+                'moved': self.moved,
+                'failed': self.failed,
+                'budget': self._budget(),
+            }
@@ -0,0 +1,363 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import time
+import itertools
+import mimetypes
+import collections
+
+import libtorrent
+from twisted.internet import defer
+from twisted.web import resource, http, server
+
+from rarity.ingest import tee
+
+# set_piece_deadline flag asking for a read_piece_alert once the piece is in
+ALERT_WHEN_AVAILABLE = getattr(getattr(libtorrent, 'deadline_flags', None),
+        'alert_when_available', 1)
+
+class TorrentStream(object):
+    """
+    Reads one file of a torrent while it downloads.
+
+    Opening a stream turns on sequential download and raises the file's
+    priority.  Each reader (see open_reader) has its own playhead: every
+    read moves it to the piece the read starts in and gives the window
+    pieces from there on deadlines step milliseconds apart, so the pieces
+    nearest a playhead are requested first.  Pieces no playhead wants lose
+    their deadlines, except those a read is still waiting for.  Pieces are
+    read with read_piece, or, if missing, with a deadline that posts the
+    read_piece_alert once they arrive; either way readers wait for it on
+    the session's alert Deferreds.  The last cache_pieces pieces read are
+    kept.
+    """
+    def __init__(self, session, infohash, file_index=0, window=8, step=200,
+            cache_pieces=8, timeout=300):
+        handle = session._find_valid_handle(infohash)
+        if not handle.has_metadata():
+            raise ValueError("No metadata for %s yet" % infohash)
+        info = handle.get_torrent_info()
+        files = list(info.files())
+        if not 0 <= file_index < len(files):
+            raise ValueError("No file %d in %s" % (file_index, infohash))
+        self._session = session
+        self._handle = handle
+        self.infohash = infohash
+        self.file_index = file_index
+        self.path = files[file_index].path
+        self.size = files[file_index].size
+        self._file_offset = files[file_index].offset
+        self.piece_length = info.piece_length()
+        self.first_piece = self._file_offset // self.piece_length
+        self.last_piece = (self._file_offset + max(self.size, 1) - 1) // self.piece_length
+        self.window = window
+        self.step = step
+        self.cache_pieces = cache_pieces
+        self.timeout = timeout
+        self._cache = collections.OrderedDict() # piece -> data
+        self._pending = dict() # piece -> Deferred
+        self._deadlines = set()
+        self._playheads = dict() # reader -> piece; None is the default reader
+        self._readers = itertools.count(1)
+        self.held = False # opened for its own sake, not only for readers
+        self.position = None
+        self.opened_at = time.time()
+        self.first_byte = None
+        self.reads = 0
+        self.seeks = 0
+        metrics = session._metrics
+        self._first_byte = metrics.histogram('stream_first_byte_seconds',
+                "Time from opening a stream to its first read.")
+        self._seek_times = metrics.histogram('stream_seek_seconds',
+                "Time taken by reads outside the window.")
+        self._read_times = metrics.histogram('stream_read_seconds',
+                "Time taken by stream reads.")
+        handle.set_sequential_download(True)
+        if hasattr(handle, 'file_priority'):
+            handle.file_priority(file_index, 7)
+
+    @property
+    def readers(self):
+        return len([reader for reader in self._playheads if reader is not None])
+
+    def open_reader(self):
+        """
+        returns a key for read() giving its caller a playhead of its own.
+        """
+        reader = next(self._readers)
+        self._playheads[reader] = None
+        return reader
+
+    def close_reader(self, reader):
+        if self._playheads.pop(reader, None) is not None:
+            self._update_deadlines(())
+
+    def _pieces(self, offset, length):
+        start = self._file_offset + offset
+        return start // self.piece_length, (start + length - 1) // self.piece_length
+
+    def _window(self, piece):
+        return range(piece, min(piece + self.window, self.last_piece + 1))
+
+    def _move_playhead(self, piece, reader=None):
+        """
+        returns whether this is a seek, i.e. the piece is outside the
+        reader's window.
+        """
+        previous = self._playheads.get(reader)
+        if piece == previous:
+            return False
+        seek = previous is not None and not (previous <= piece <= previous + self.window)
+        self._playheads[reader] = self.position = piece
+        self._update_deadlines(self._window(piece))
+        return seek
+
+    def _update_deadlines(self, moved):
+        """
+        sets deadlines on the pieces moved to, and drops them from pieces
+        no playhead wants any more.
+        """
+        wanted = set()
+        for head in self._playheads.itervalues():
+            if head is not None:
+                wanted.update(self._window(head))
+        for behind in self._deadlines.difference(wanted):
+            if behind not in self._pending: # its reader is still waiting
+                self._handle.reset_piece_deadline(behind)
+        for i, ahead in enumerate(moved):
+            if ahead not in self._pending:
+                self._handle.set_piece_deadline(ahead, (i + 1) * self.step, 0)
+        self._deadlines = wanted
+
+    def _piece(self, piece):
+        data = self._cache.get(piece)
+        if data is not None:
+            return defer.succeed(data)
+        pending = self._pending.get(piece)
+        if pending is None:
+            pending = self._pending[piece] = self._session._add_piece_deferred(
+                    self.infohash, piece, libtorrent.read_piece_alert, self.timeout)
+            def read(alert):
+                del self._pending[piece]
+                if not alert.buffer:
+                    raise IOError("Cannot read piece %d of %s" % (piece, self.infohash))
+                self._cache[piece] = alert.buffer
+                while len(self._cache) > self.cache_pieces:
+                    self._cache.popitem(last=False)
+                return alert.buffer
+            def failed(reason):
+                self._pending.pop(piece, None)
+                return reason
+            pending.addCallbacks(read, failed)
+            if self._handle.have_piece(piece):
+                self._handle.read_piece(piece)
+            else:
+                self._handle.set_piece_deadline(piece, 0, ALERT_WHEN_AVAILABLE)
+        return tee(pending)
+
+    def read(self, offset, length, reader=None):
+        """
+        returns a Deferred.  callback arg is up to length bytes of the file
+        from offset; an empty string past its end.  reader is a key from
+        open_reader, or None to share the stream's own playhead.
+        """
+        length = min(length, self.size - offset)
+        if length <= 0:
+            return defer.succeed('')
+        first, last = self._pieces(offset, length)
+        started = time.time()
+        seek = self._move_playhead(first, reader)
+        d = defer.gatherResults([self._piece(p) for p in xrange(first, last + 1)],
+                consumeErrors=True)
+        def join(pieces):
+            now = time.time()
+            self.reads += 1
+            self._read_times.observe(now - started)
+            if seek:
+                self.seeks += 1
+                self._seek_times.observe(now - started)
+            if self.first_byte is None:
+                self.first_byte = now - self.opened_at
+                self._first_byte.observe(self.first_byte)
+            start = self._file_offset + offset - first * self.piece_length
+            return ''.join(pieces)[start:start + length]
+        d.addCallback(join)
+        d.addErrback(lambda reason: reason.value.subFailure
+                if isinstance(reason.value, defer.FirstError) else reason)
+        return d
+
+    def wait_for_piece(self, piece):
+        """
+        returns a Deferred fired once piece is downloaded and checked.
+        """
+        if self._handle.have_piece(piece):
+            return defer.succeed(piece)
+        d = self._session._add_piece_deferred(self.infohash, piece,
+                libtorrent.piece_finished_alert, self.timeout)
+        return d.addCallback(lambda _: piece)
+
+    def close(self):
+        if not self._handle.is_valid():
+            return
+        for piece in self._deadlines:
+            self._handle.reset_piece_deadline(piece)
+        self._deadlines = set()
+        self._playheads = dict()
+        self._handle.set_sequential_download(False)
+
+    def stats(self):
+        return {
+                'infohash': self.infohash,
+                'file': self.file_index,
+                'path': self.path,
+                'size': self.size,
+                'position': self.position,
+                'readers': self.readers,
+                'window': self.window,
+                'cached': len(self._cache),
+                'pending': len(self._pending),
+                'reads': self.reads,
+                'seeks': self.seeks,
+                'first_byte': self.first_byte,
+                'url': '/%s/%d' % (self.infohash, self.file_index),
+            }
+
+
+def parse_range(header, size):
+    """
+    returns (start, end) for the first range of a Range header, end
+    exclusive, or None if it is missing or unsatisfiable.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    first = header[len('bytes='):].split(',')[0].strip()
+    start, _, end = first.partition('-')
+    try:
+        if not start:
+            start, end = max(0, size - int(end)), size
+        else:
+            start = int(start)
+            end = min(int(end) + 1, size) if end else size
+    except ValueError:
+        return None
+    if start >= end:
+        return None
+    return start, end
+
+
+class RangeProducer(object):
+    """
+    Writes bytes [start, end) of a TorrentStream to a request, one read of
+    at most chunk bytes at a time, as the transport asks for them, with the
+    playhead of reader.
+    """
+    def __init__(self, stream, reader, request, start, end, chunk):
+        self._stream = stream
+        self._reader = reader
+        self._request = request
+        self._offset = start
+        self._end = end
+        self._chunk = chunk
+        self._reading = False
+        self._stopped = False
+
+    def start(self):
+        self._request.registerProducer(self, False)
+        self._request.notifyFinish().addErrback(lambda _: self.stopProducing())
+
+    def resumeProducing(self):
+        if self._reading or self._stopped:
+            return
+        if self._offset >= self._end:
+            self._finish()
+            return
+        self._reading = True
+        length = min(self._chunk, self._end - self._offset)
+        d = self._stream.read(self._offset, length, self._reader)
+        d.addCallbacks(self._write, self._failed)
+
+    def _write(self, data):
+        self._reading = False
+        if self._stopped:
+            return
+        if not data:
+            self._finish()
+            return
+        self._offset += len(data)
+        self._request.write(data)
+
+    def _failed(self, reason):
+        self._reading = False
+        if not self._stopped:
+            self._stopped = True
+            self._request.unregisterProducer()
+            self._request.loseConnection()
+
+    def _finish(self):
+        self._stopped = True
+        self._request.unregisterProducer()
+        self._request.finish()
+
+    def stopProducing(self):
+        self._stopped = True
+
+
+class StreamResource(resource.Resource):
+    """
+    Serves /<infohash>/<file index> from Session.open_stream, with Range
+    support.  Every request reads with a playhead of its own and lets go of
+    the stream when it finishes, which closes it once nobody else holds it.
+    """
+    isLeaf = True
+
+    def __init__(self, session):
+        resource.Resource.__init__(self)
+        self._session = session
+
+    def render_GET(self, request):
+        try:
+            infohash, file_index = request.postpath[:2]
+            file_index = int(file_index)
+            stream = self._session.open_stream(infohash, file_index, hold=False)
+        except (ValueError, KeyError):
+            request.setResponseCode(http.NOT_FOUND)
+            return "No such torrent file"
+        reader = stream.open_reader()
+        request.notifyFinish().addBoth(lambda _: self._session.release_stream(
+            infohash, file_index, reader))
+        size = stream.size
+        request.setHeader('Accept-Ranges', 'bytes')
+        request.setHeader('Content-Type',
+                mimetypes.guess_type(stream.path)[0] or 'application/octet-stream')
+        start, end = 0, size
+        header = request.getHeader('Range')
+        if header is not None:
+            byte_range = parse_range(header, size)
+            if byte_range is None:
+                request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+                request.setHeader('Content-Range', 'bytes */%d' % size)
+                return ''
+            start, end = byte_range
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+        request.setHeader('Content-Length', str(end - start))
+        if request.method == 'HEAD' or start == end:
+            return ''
+        RangeProducer(stream, reader, request, start, end, stream.piece_length).start()
+        return server.NOT_DONE_YET
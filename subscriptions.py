@@ -0,0 +1,197 @@
+# Copyright (C) 2011 by Stacey Ell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import time
+import logging
+import itertools
+import collections
+
+from twisted.internet import reactor
+from twisted.spread import pb
+
+logger = logging.getLogger('ClientCore')
+
+class Subscription(object):
+    """
+    One listener's view of the session.
+
+    Changed infohashes are only marked; their fields are read when the
+    update is sent, so a torrent that changes ten times between sends costs
+    one entry carrying its latest state.  At most one update is in flight
+    per listener and updates go out at most max_rate times a second.
+    Lifecycle events are kept in order, up to max_events; older ones are
+    dropped and counted.
+    """
+    def __init__(self, sid, listener, infohashes=None, regexp=None,
+            max_rate=1.0, fields=None, max_events=1000):
+        self.sid = sid
+        self.listener = listener
+        self.infohashes = frozenset(infohashes) if infohashes is not None else None
+        self.regexp = regexp
+        self.interval = 1.0 / max_rate if max_rate else 0
+        self.fields = fields
+        self._matches = dict()
+        self.changed = set()
+        self.events = collections.deque(maxlen=max_events)
+        self.dropped = 0
+        self.in_flight = False
+        self.last_sent = 0
+        self.call = None
+        self.sent = 0
+
+    def wants(self, infohash, name_of):
+        if self.infohashes is not None:
+            return infohash in self.infohashes
+        if self.regexp is None:
+            return True
+        wanted = self._matches.get(infohash)
+        if wanted is None:
+            try:
+                name = name_of(infohash)
+            except KeyError:
+                return False
+            wanted = self._matches[infohash] = bool(self.regexp.match(name))
+        return wanted
+
+    def forget(self, infohash):
+        self._matches.pop(infohash, None)
+
+    def add_event(self, event):
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(event)
+
+    def has_pending(self):
+        return bool(self.changed or self.events)
+
+
+class SubscriptionManager(object):
+    """
+    Pushes status deltas and lifecycle events to PB listeners.  A listener
+    is any pb.Referenceable with remote_update(update), where update is
+    {'status': {infohash: fields}, 'removed': [infohash], 'events':
+    [(time, infohash, event)], 'dropped': count}.
+    """
+    def __init__(self, session):
+        self._session = session
+        self._subs = dict()
+        self._ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self._subs)
+
+    def subscribe(self, listener, infohashes=None, query=None, max_rate=1.0,
+            fields=None):
+        regexp = None
+        if query is not None:
+            regexp = self._session._name_index.compile(query)
+        sub = Subscription(next(self._ids), listener, infohashes, regexp,
+                max_rate, fields)
+        self._subs[sub.sid] = sub
+        if hasattr(listener, 'notifyOnDisconnect'):
+            listener.notifyOnDisconnect(lambda _: self.unsubscribe(sub.sid))
+        return sub.sid
+
+    def unsubscribe(self, sid):
+        sub = self._subs.pop(sid, None)
+        if sub is not None and sub.call is not None and sub.call.active():
+            sub.call.cancel()
+
+    def status_changed(self, infohashes):
+        if not self._subs:
+            return
+        name_of = self._session._name_index.name
+        for sub in self._subs.itervalues():
+            marked = False
+            for infohash in infohashes:
+                if sub.wants(infohash, name_of):
+                    sub.changed.add(infohash)
+                    marked = True
+            if marked:
+                self._schedule(sub)
+
+    def event(self, infohash, event):
+        if not self._subs:
+            return
+        name_of = self._session._name_index.name
+        record = (time.time(), infohash, event)
+        for sub in self._subs.itervalues():
+            if sub.wants(infohash, name_of):
+                sub.add_event(record)
+                self._schedule(sub)
+        if event == 'removed':
+            self.forget(infohash)
+
+    def forget(self, infohash):
+        """
+        drops what every subscription remembers of whether infohash's name
+        matches, e.g. once a magnet's metadata gives it its real name.
+        """
+        for sub in self._subs.itervalues():
+            sub.forget(infohash)
+
+    def _schedule(self, sub):
+        if sub.in_flight or (sub.call is not None and sub.call.active()):
+            return
+        delay = max(0, sub.last_sent + sub.interval - time.time())
+        sub.call = reactor.callLater(delay, self._send, sub)
+
+    def _send(self, sub):
+        sub.call = None
+        if sub.sid not in self._subs or not sub.has_pending():
+            return
+        status, removed = dict(), list()
+        for infohash in sub.changed:
+            try:
+                status[infohash] = self._session.torrent_fields(infohash, sub.fields)
+            except (KeyError, ValueError):
+                removed.append(infohash)
+        update = {
+                'status': status,
+                'removed': removed,
+                'events': list(sub.events),
+                'dropped': sub.dropped,
+            }
+        sub.changed = set()
+        sub.events.clear()
+        sub.dropped = 0
+        sub.in_flight = True
+        sub.last_sent = time.time()
+        try:
+            d = sub.listener.callRemote('update', update)
+        except pb.DeadReferenceError:
+            self.unsubscribe(sub.sid)
+            return
+        def sent(_):
+            sub.in_flight = False
+            sub.sent += 1
+            if sub.has_pending():
+                self._schedule(sub)
+        def failed(reason):
+            logger.info("dropping subscription %d: %s" % (sub.sid, reason.getErrorMessage()))
+            self.unsubscribe(sub.sid)
+        d.addCallbacks(sent, failed)
+
+    def stats(self):
+        return dict((sid, {
+                'pending_status': len(sub.changed),
+                'pending_events': len(sub.events),
+                'in_flight': sub.in_flight,
+                'sent': sub.sent,
+            }) for sid, sub in self._subs.iteritems())
@@ -19,25 +19,53 @@
 # THE SOFTWARE.
 import itertools
 
-def serialize_torrent_metainfo(handle):
-    torrent_info = handle.get_torrent_info()
-    return {
-            'name': handle.name(),
+STATUS_FIELDS = frozenset(('paused', 'progress', 'upload_rate', 'download_rate'))
+METAINFO_FIELDS = frozenset(('name', 'pieces', 'private'))
+PB_CHUNK_SIZE = 512 * 1024 # stays under banana's 640k string limit
+
+def serialize_metainfo(torrent_info, detailed=False):
+    metainfo = {
+            'name': torrent_info.name(),
             'pieces': torrent_info.num_pieces(),
             'private': torrent_info.priv(),
         }
+    if detailed:
+        metainfo.update({
+            'total_size': torrent_info.total_size(),
+            'piece_length': torrent_info.piece_length(),
+            'files': [{'path': f.path, 'size': f.size} for f in torrent_info.files()],
+        })
+    return metainfo
 
+def serialize_torrent_metainfo(handle):
+    metainfo = serialize_metainfo(handle.get_torrent_info())
+    metainfo['name'] = handle.name()
+    return metainfo
 
-def serialize_torrent_status(handle):
-    status = handle.status()
+
+def serialize_status(status):
     return {
-            'paused': handle.is_paused(),
+            'paused': status.paused,
             'progress': status.progress,
             'upload_rate': status.upload_rate,
             'download_rate': status.download_rate
         }
 
+def serialize_torrent_status(handle):
+    return serialize_status(handle.status())
+
 def serialize_torrent(handle):
     return dict(itertools.chain(
         serialize_torrent_status(handle).iteritems(),
         serialize_torrent_metainfo(handle).iteritems()))
+
+def project(record, fields):
+    if fields is None:
+        return record
+    return dict((k, record[k]) for k in fields if k in record)
+
+def split_chunks(buf, size=PB_CHUNK_SIZE):
+    """
+    splits a string too long for one PB string into a list of them.
+    """
+    return [buf[i:i + size] for i in xrange(0, len(buf), size)]